@@ -1,3 +1,4 @@
+import contextlib
 import logging
 import os
 from urllib.parse import urlparse
@@ -5,15 +6,132 @@ from urllib.parse import urlparse
 import jwt
 from dotenv import load_dotenv
 from fastapi import Depends, FastAPI, HTTPException, Request
-from fastapi.responses import JSONResponse
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import (
+    HTMLResponse,
+    JSONResponse,
+    PlainTextResponse,
+    Response,
+    StreamingResponse,
+)
 from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
 
 import server.constants as constants
-from server.deployer import Deployer, DeploymentConfig
+from server.admission import get_admission_controller
+from server.collector import GarbageCollectionPolicy, GarbageCollector
+from server.deployer import DeploymentConfig
+from server.hibernation import HibernationManager
+from server.jobs import AsyncDeploymentQueue, DeploymentQueue
+from server.logs import build_logs
+from server.reconciler import Reconciler
+from server.state import get_deployment_store
+from server.teardown import BulkTeardown
+from server.utils import get_env_flag
+from server.vault import get_secrets_cache
 
 load_dotenv()
 
-app = FastAPI()
+deployment_pipeline = (
+    os.environ.get("DEPLOYMENT_PIPELINE") or constants.DEPLOYMENT_PIPELINE_THREADS
+).lower()
+deployment_queue_class = (
+    AsyncDeploymentQueue
+    if deployment_pipeline == constants.DEPLOYMENT_PIPELINE_ASYNC
+    else DeploymentQueue
+)
+deployment_queue = deployment_queue_class(
+    max_workers=int(
+        os.environ.get("DEPLOYMENT_WORKERS") or constants.DEFAULT_DEPLOYMENT_WORKERS
+    ),
+    history_size=int(
+        os.environ.get("JOB_HISTORY_SIZE") or constants.DEFAULT_JOB_HISTORY_SIZE
+    ),
+    cancel_running=get_env_flag("CANCEL_SUPERSEDED_DEPLOYMENTS"),
+)
+
+bulk_teardown = BulkTeardown(
+    os.environ.get("DEPLOYMENTS_MOUNT_DIR") or "",
+    max_workers=int(
+        os.environ.get("BULK_DELETE_WORKERS") or constants.DEFAULT_BULK_DELETE_WORKERS
+    ),
+)
+
+hibernation_manager = HibernationManager(
+    os.environ.get("DEPLOYMENTS_MOUNT_DIR") or "",
+    idle_seconds=float(os.environ.get("HIBERNATE_IDLE_MINUTES") or 0) * 60,
+    check_interval_seconds=float(
+        os.environ.get("HIBERNATION_CHECK_SECONDS")
+        or constants.DEFAULT_HIBERNATION_CHECK_SECONDS
+    ),
+    wake_timeout_seconds=float(
+        os.environ.get("WAKE_TIMEOUT_SECONDS") or constants.DEFAULT_WAKE_TIMEOUT_SECONDS
+    ),
+    is_busy=deployment_queue.is_active,
+)
+
+reconciler = Reconciler(
+    os.environ.get("DEPLOYMENTS_MOUNT_DIR") or "",
+    os.environ.get("NGINX_PROXY_CONF_LOCATION") or "/etc/nginx/conf.d",
+    interval_seconds=float(
+        os.environ.get("RECONCILE_INTERVAL_SECONDS")
+        or constants.DEFAULT_RECONCILE_INTERVAL_SECONDS
+    ),
+    is_busy=deployment_queue.is_active,
+)
+
+garbage_collector = GarbageCollector(
+    os.environ.get("DEPLOYMENTS_MOUNT_DIR") or "",
+    os.environ.get("NGINX_PROXY_CONF_LOCATION") or "/etc/nginx/conf.d",
+    GarbageCollectionPolicy(
+        max_age_seconds=float(os.environ.get("GC_MAX_AGE_HOURS") or 0) * 3600,
+        max_idle_seconds=float(os.environ.get("GC_MAX_IDLE_HOURS") or 0) * 3600,
+        max_previews_per_project=int(
+            os.environ.get("GC_MAX_PREVIEWS_PER_PROJECT") or 0
+        ),
+        disk_high_water_percent=float(
+            os.environ.get("GC_DISK_HIGH_WATER_PERCENT") or 0
+        ),
+        exclude_branches=[
+            pattern.strip()
+            for pattern in (os.environ.get("GC_EXCLUDE_BRANCHES") or "").split(",")
+            if pattern.strip()
+        ],
+    ),
+    interval_seconds=float(
+        os.environ.get("GC_INTERVAL_SECONDS") or constants.DEFAULT_GC_INTERVAL_SECONDS
+    ),
+    batch_size=int(os.environ.get("GC_BATCH_SIZE") or constants.DEFAULT_GC_BATCH_SIZE),
+    is_busy=deployment_queue.is_active,
+)
+
+WAKE_PAGE = f"""<!DOCTYPE html>
+<html>
+<head>
+<meta http-equiv="refresh" content="{constants.WAKE_RETRY_AFTER_SECONDS}">
+<title>Waking up preview environment</title>
+</head>
+<body>
+<p>This preview environment was stopped because nobody used it for a while.
+It is starting up again, this page reloads once it is ready.</p>
+</body>
+</html>
+"""
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app: FastAPI):
+    reconciler.start()
+    hibernation_manager.start()
+    garbage_collector.start()
+    yield
+    garbage_collector.stop()
+    hibernation_manager.stop()
+    reconciler.stop()
+    deployment_queue.shutdown(wait=False)
+
+
+app = FastAPI(lifespan=lifespan)
 security = HTTPBearer()
 app.config = {"SECRET_TEXT": os.environ.get("SECRET_TEXT")}
 
@@ -61,24 +179,203 @@ async def deploy(request: Request):
         compose_file_location=data.get("compose_file_location"),
         gh_token=data.get("gh_token"),
         rest_action=request.method,
+        force_rebuild=bool(data.get("force_rebuild")),
     )
-    deployer = Deployer(config)
 
-    if request.method == constants.POST:
-        urls = deployer.deploy_preview_environment()
-        return JSONResponse(content=urls)
-    elif request.method == constants.DELETE:
-        deployer.delete_preview_environment()
-        return JSONResponse(
-            status_code=200,
-            content={"message": "Removed preview environment"},
-        )
-    else:
+    if request.method not in [constants.POST, constants.DELETE]:
         return JSONResponse(
             status_code=405,
             content={"error": "Invalid HTTP method. Supported methods: POST, DELETE"},
         )
 
+    job = deployment_queue.submit(config)
+    return JSONResponse(
+        status_code=202,
+        content={
+            "job_id": job.id,
+            "status": job.status,
+            "status_url": f"/jobs/{job.id}",
+            "queue_position": deployment_queue.queue_position(job),
+        },
+    )
+
+
+@app.delete("/deployments", dependencies=[Depends(verify_token)])
+async def bulk_delete(request: Request):
+    data = await request.json()
+    namespaces = data.get("namespaces")
+    branch_pattern = data.get("branch")
+    project_name = None
+    if data.get("project_git_url"):
+        project_git_url = urlparse(data.get("project_git_url")).path
+        if not project_git_url.endswith(".git"):
+            return JSONResponse(
+                status_code=400,
+                content={"message": "Project URL should end with .git"},
+            )
+        project_name = DeploymentConfig(
+            project_name=project_git_url[:-4],
+            branch_name="",
+            project_git_url=data.get("project_git_url"),
+        ).project_name
+
+    if not namespaces and not project_name and not branch_pattern:
+        return JSONResponse(
+            status_code=400,
+            content={
+                "message": "Pass namespaces, a project_git_url and/or a branch pattern to delete"
+            },
+        )
+
+    configs = await run_in_threadpool(
+        bulk_teardown.select, namespaces, project_name, branch_pattern
+    )
+    if not configs:
+        return JSONResponse(
+            status_code=404,
+            content={"message": "No deployments matched"},
+        )
+    # Deployments with queued or running jobs are deleted by a job queued after them, so a
+    # pending deploy can't recreate them right after the teardown
+    queued = {
+        namespace: deployment_queue.submit(config).id
+        for namespace, config in configs.items()
+        if config and deployment_queue.is_active(namespace)
+    }
+    configs = {
+        namespace: config
+        for namespace, config in configs.items()
+        if namespace not in queued
+    }
+    result = (
+        await run_in_threadpool(bulk_teardown.delete, configs)
+        if configs
+        else {"deleted": [], "failed": {}}
+    )
+    return JSONResponse(content={**result, "queued": queued})
+
+
+@app.get("/deployments", dependencies=[Depends(verify_token)])
+async def list_deployments(
+    project: str = None,
+    branch: str = None,
+    status: str = None,
+    limit: int = constants.DEFAULT_DEPLOYMENTS_PAGE_SIZE,
+    offset: int = 0,
+):
+    if not 0 < limit <= constants.MAX_DEPLOYMENTS_PAGE_SIZE or offset < 0:
+        return JSONResponse(
+            status_code=400,
+            content={
+                "message": f"limit should be between 1 and {constants.MAX_DEPLOYMENTS_PAGE_SIZE} and offset positive"
+            },
+        )
+    # Same normalisation as the project names derived from git URLs, e.g. for owner/repo
+    project_name = (
+        DeploymentConfig(
+            project_name=project, branch_name="", project_git_url=""
+        ).project_name
+        if project
+        else None
+    )
+    deployments, total = await run_in_threadpool(
+        get_deployment_store().list, project_name, branch, status, limit, offset
+    )
+    return JSONResponse(
+        content={
+            "deployments": deployments,
+            "total": total,
+            "limit": limit,
+            "offset": offset,
+        }
+    )
+
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    job = deployment_queue.get(job_id)
+    if not job:
+        return JSONResponse(
+            status_code=404,
+            content={"message": f"No deployment job found with id {job_id}"},
+        )
+    return JSONResponse(
+        content={
+            **job.to_dict(),
+            "queue_position": deployment_queue.queue_position(job),
+            "build_queue_position": get_admission_controller().build_queue_position(
+                job.namespace
+            )
+            if job.status == constants.JOB_RUNNING
+            else None,
+        }
+    )
+
+
+# Build output can echo env values and secrets, so it needs a token like the other /deployments routes
+@app.get("/deployments/{namespace}/logs", dependencies=[Depends(verify_token)])
+async def get_build_logs(namespace: str, follow: bool = True):
+    build_log = build_logs.get(namespace)
+    if not build_log:
+        return JSONResponse(
+            status_code=404,
+            content={"message": f"No build logs found for {namespace}"},
+        )
+    if not follow:
+        return PlainTextResponse("\n".join(build_log.lines()))
+
+    async def events():
+        # Followers wait on the event loop, so they don't hold threads of the shared pool
+        async for line in build_log.follow_async():
+            yield ": keep-alive\n\n" if line is None else f"data: {line}\n\n"
+        yield "event: end\ndata: \n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+
+@app.get("/deployments/{namespace}/wake")
+async def wake_deployment(namespace: str):
+    # Requests for hibernated deployments are routed here by the outer nginx
+    if not await run_in_threadpool(hibernation_manager.wake, namespace):
+        return JSONResponse(
+            status_code=404,
+            content={"message": f"No deployment found for {namespace}"},
+        )
+    return HTMLResponse(
+        WAKE_PAGE,
+        status_code=503,
+        headers={
+            "Retry-After": str(constants.WAKE_RETRY_AFTER_SECONDS),
+            "Cache-Control": "no-store",
+        },
+    )
+
+
+@app.delete("/admin/secrets-cache", dependencies=[Depends(verify_token)])
+async def flush_secrets_cache():
+    flushed = get_secrets_cache().clear()
+    return JSONResponse(
+        content={"message": "Flushed secrets cache", "flushed_entries": flushed}
+    )
+
+
+@app.get("/admin/gc", dependencies=[Depends(verify_token)])
+async def garbage_collection_report():
+    # Dry run, lists what the next pass would delete
+    report = await run_in_threadpool(garbage_collector.collect, True)
+    return JSONResponse(content=report)
+
+
+@app.post("/admin/gc", dependencies=[Depends(verify_token)])
+async def collect_garbage():
+    report = await run_in_threadpool(garbage_collector.collect)
+    return JSONResponse(content=report)
+
+
+@app.get("/metrics")
+async def metrics():
+    return Response(content=generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
 
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,51 @@
+import shutil
+
+import pytest
+
+from benchmarks.conftest import compose_file_content
+from server.utils import ComposeHelper
+
+SERVICE_COUNTS = [10, 100, 300]
+
+
+@pytest.fixture(params=SERVICE_COUNTS, ids=lambda services: f"{services}-services")
+def compose_file(request, tmp_path):
+    path = tmp_path / "source-compose.yml"
+    path.write_text(compose_file_content(request.param))
+    return path, request.param
+
+
+@pytest.mark.benchmark(group="compose_load")
+def bench_load_compose_file(benchmark, compose_file):
+    # Given
+    path, services = compose_file
+
+    # When
+    ports = benchmark(lambda: ComposeHelper(str(path)).get_service_ports_config())
+
+    # Then
+    assert len(ports) == services
+
+
+@pytest.mark.benchmark(group="compose_process")
+def bench_process_compose_file(benchmark, compose_file, tmp_path):
+    # Given
+    path, services = compose_file
+    processed_path = tmp_path / "docker-compose.yml"
+    namespace = "bench_feature_0123456789"
+
+    def setup():
+        # Processing overwrites the compose file
+        shutil.copy(path, processed_path)
+        return (ComposeHelper(str(processed_path)),), {}
+
+    def process(compose_helper: ComposeHelper):
+        compose_helper.get_service_ports_config()
+        compose_helper.get_service_proxy_settings()
+        compose_helper.prepare_services("40000", "nginx.conf", namespace)
+
+    # When
+    benchmark.pedantic(process, setup=setup, rounds=20)
+
+    # Then
+    assert processed_path.read_text().count("restart: unless-stopped") == services + 1
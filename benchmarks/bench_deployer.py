@@ -0,0 +1,76 @@
+import os
+import threading
+import typing
+
+import pytest
+
+from benchmarks.conftest import PREVIEW_COUNTS, preview_config
+from server.deployer import Deployer
+from server.utils import DeploymentConfig
+
+CONCURRENCY = [1, 4, 16]
+
+
+def deploy(config: DeploymentConfig) -> typing.List[str]:
+    return Deployer(config).deploy_preview_environment()
+
+
+def deploy_concurrently(configs: typing.List[DeploymentConfig]):
+    errors = []
+
+    def run(config: DeploymentConfig):
+        try:
+            deploy(config)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=run, args=(config,)) for config in configs]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not errors
+
+
+@pytest.mark.benchmark(group="deploy")
+@pytest.mark.parametrize("previews", PREVIEW_COUNTS)
+def bench_deploy(benchmark, live_previews, previews):
+    # Given
+    live_previews(previews)
+    config = preview_config(0)
+
+    # When
+    urls = benchmark.pedantic(deploy, args=(config,), rounds=5)
+
+    # Then
+    assert len(urls) == 5
+    assert os.path.exists(
+        os.path.join(
+            os.environ["DEPLOYMENTS_MOUNT_DIR"],
+            config.get_deployment_namespace(),
+            ".env",
+        )
+    )
+
+
+@pytest.mark.benchmark(group="deploy_concurrent")
+@pytest.mark.parametrize("concurrency", CONCURRENCY)
+def bench_concurrent_deploys(benchmark, live_previews, concurrency):
+    # Given
+    live_previews(100)
+    configs = [preview_config(index) for index in range(concurrency)]
+
+    # When / Then
+    benchmark.pedantic(deploy_concurrently, args=(configs,), rounds=3)
+
+
+@pytest.mark.benchmark(group="deploy_same_namespace")
+@pytest.mark.parametrize("concurrency", CONCURRENCY)
+def bench_concurrent_deploys_of_one_preview(benchmark, live_previews, concurrency):
+    # Given
+    live_previews(100)
+    # Deploys of one namespace are serialized by its deployment lock
+    configs = [preview_config(0)] * concurrency
+
+    # When / Then
+    benchmark.pedantic(deploy_concurrently, args=(configs,), rounds=3)
@@ -0,0 +1,36 @@
+import os
+
+import pytest
+
+from benchmarks.conftest import PREVIEW_COUNTS, preview_config
+from server.routing import RoutingTable
+from server.utils import NginxHelper
+
+
+@pytest.mark.benchmark(group="nginx_confs")
+@pytest.mark.parametrize("previews", PREVIEW_COUNTS)
+def bench_generate_nginx_confs(benchmark, live_previews, previews):
+    # Given
+    live_previews(previews)
+    config = preview_config(0)
+    project_path = os.path.join(
+        os.environ["DEPLOYMENTS_MOUNT_DIR"], config.get_deployment_namespace()
+    )
+    os.makedirs(project_path)
+    services = {f"service{index}": [(10000 + index, 8080)] for index in range(20)}
+    routing_table = RoutingTable(os.environ["NGINX_PROXY_CONF_LOCATION"])
+
+    def generate():
+        # What a deploy does before nginx -t and the reload
+        nginx_helper = NginxHelper(
+            config, os.environ["NGINX_PROXY_CONF_LOCATION"], project_path
+        )
+        nginx_helper.generate_project_proxy_conf_file(services)
+        nginx_helper.generate_outer_proxy_conf_file(nginx_helper.find_free_port())
+        return routing_table.write()
+
+    # When
+    conf = benchmark(generate)
+
+    # Then
+    assert conf.count(".localhost ") == previews + 20
@@ -0,0 +1,40 @@
+import os
+
+import pytest
+
+from benchmarks.conftest import PORT_RANGE_START, PREVIEW_COUNTS, preview_config
+from benchmarks.fakes import PortListener
+from server.utils import NginxHelper
+
+
+@pytest.mark.benchmark(group="find_free_port")
+@pytest.mark.parametrize("previews", PREVIEW_COUNTS)
+def bench_find_free_port(benchmark, live_previews, previews):
+    # Given
+    live_previews(previews)
+    # The next ports in the range are taken by processes Sarthi does not manage
+    listener = PortListener(
+        range(PORT_RANGE_START + previews, PORT_RANGE_START + previews + 5)
+    )
+    config = preview_config(0)
+    nginx_helper = NginxHelper(
+        config,
+        os.environ["NGINX_PROXY_CONF_LOCATION"],
+        os.path.join(
+            os.environ["DEPLOYMENTS_MOUNT_DIR"], config.get_deployment_namespace()
+        ),
+    )
+
+    def allocate():
+        port = nginx_helper.find_free_port()
+        nginx_helper.release_port()
+        return port
+
+    # When
+    try:
+        port = benchmark(allocate)
+    finally:
+        listener.close()
+
+    # Then
+    assert int(port) >= PORT_RANGE_START + previews + 5
@@ -0,0 +1,29 @@
+import os
+
+import pytest
+
+from server.utils import SecretsHelper
+
+SECRET_COUNTS = [10, 200]
+
+
+@pytest.mark.benchmark(group="secrets")
+@pytest.mark.parametrize("secrets", SECRET_COUNTS)
+def bench_inject_env_variables(benchmark, fake_services, tmp_path, secrets):
+    # Given
+    fake_services["vault"].secrets["/v1/kv/data/bench/default-dev-secrets"] = {
+        f"SECRET_{index}": f"value-{index}" for index in range(secrets)
+    }
+    secrets_helper = SecretsHelper("bench", "feature-0", str(tmp_path))
+
+    def round_trip():
+        # A first deploy copies the default secrets, deleting the preview removes them
+        secrets_helper.inject_env_variables(str(tmp_path))
+        secrets_helper.cleanup_deployment_variables()
+
+    # When
+    benchmark(round_trip)
+
+    # Then
+    with open(os.path.join(tmp_path, ".env")) as file:
+        assert len(file.readlines()) == secrets
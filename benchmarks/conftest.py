@@ -0,0 +1,156 @@
+import os
+import typing
+
+import pytest
+
+from benchmarks.fakes import (
+    FakeDockerEngine,
+    FakeVault,
+    serve_in_background,
+    write_fake_executables,
+)
+from server import admission, docker_api, state, vault
+from server.ports import get_port_registry
+from server.routing import RoutingTable
+from server.utils import DeploymentConfig
+
+PREVIEW_COUNTS = [1, 100, 1000]
+PORT_RANGE_START = 40000
+
+SERVICE_TEMPLATE = """
+  service%(index)s:
+    image: registry.example.com/bench/service%(index)s:latest
+    command: ["python", "-m", "http.server", "8080"]
+    ports:
+      - "%(port)s:8080"
+    environment:
+      SERVICE_NAME: service%(index)s
+      LOG_LEVEL: info
+    volumes:
+      - ./service%(index)s:/app
+    labels:
+      sarthi.proxy.read_timeout: 60s
+    deploy:
+      resources:
+        limits:
+          memory: 256m
+"""
+
+
+def compose_file_content(services: int) -> str:
+    """
+    Compose file with services services, about 17 lines each.
+    """
+    return "services:" + "".join(
+        SERVICE_TEMPLATE % {"index": index, "port": 10000 + index}
+        for index in range(services)
+    )
+
+
+@pytest.fixture(scope="session")
+def fake_services(tmp_path_factory):
+    base_path = tmp_path_factory.mktemp("fakes")
+    write_fake_executables(str(base_path / "bin"))
+    docker_engine = FakeDockerEngine(str(base_path / "docker.sock"))
+    fake_vault = FakeVault()
+    for server in [docker_engine, fake_vault]:
+        serve_in_background(server)
+    yield {
+        "bin": str(base_path / "bin"),
+        "docker_socket": str(base_path / "docker.sock"),
+        "vault": fake_vault,
+    }
+    for server in [docker_engine, fake_vault]:
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.fixture(autouse=True)
+def sarthi_env(tmp_path, monkeypatch, fake_services):
+    """
+    Point Sarthi at the fakes and at fresh state under tmp_path, like a new host.
+    """
+    compose_path = tmp_path / "source-compose.yml"
+    compose_path.write_text(compose_file_content(5))
+    (tmp_path / "nginx-confs").mkdir()
+    (tmp_path / "deployments").mkdir()
+    env = {
+        "PATH": f"{fake_services['bin']}{os.pathsep}{os.environ['PATH']}",
+        "SARTHI_BENCH_COMPOSE_FILE": str(compose_path),
+        "DOCKER_SOCKET_PATH": fake_services["docker_socket"],
+        "VAULT_BASE_URL": fake_services["vault"].url,
+        "VAULT_TOKEN": "bench-token",
+        "DEPLOYMENTS_MOUNT_DIR": str(tmp_path / "deployments"),
+        "NGINX_PROXY_CONF_LOCATION": str(tmp_path / "nginx-confs"),
+        "LOCK_FILE_BASE_PATH": str(tmp_path),
+        "PORT_REGISTRY_PATH": str(tmp_path / "ports.json"),
+        "STATE_DB_PATH": str(tmp_path / "state.db"),
+        "DEPLOYMENT_HOST": "127.0.0.1",
+        "DEPLOYMENT_PORT_START": str(PORT_RANGE_START),
+        "DEPLOYMENT_PORT_END": str(PORT_RANGE_START + 1999),
+        "NGINX_RELOAD_DEBOUNCE_SECONDS": "0",
+    }
+    for key, value in env.items():
+        monkeypatch.setenv(key, value)
+    # Singletons are created from the environment on first use
+    for module, attribute in [
+        (state, "_deployment_store"),
+        (docker_api, "_docker_client"),
+        (admission, "_admission_controller"),
+        (vault, "_vault_session"),
+    ]:
+        monkeypatch.setattr(module, attribute, None)
+    fake_vault: FakeVault = fake_services["vault"]
+    fake_vault.secrets.clear()
+    yield tmp_path
+    vault.get_secrets_cache().clear()
+    if state._deployment_store:
+        state._deployment_store.close()
+
+
+def preview_config(index: int, project_name: str = "bench") -> DeploymentConfig:
+    return DeploymentConfig(
+        project_name=project_name,
+        branch_name=f"feature-{index}",
+        project_git_url="https://github.com/example/bench.git",
+        rest_action="POST",
+    )
+
+
+@pytest.fixture
+def live_previews(sarthi_env) -> typing.Callable[[int], typing.List[DeploymentConfig]]:
+    """
+    Create the state count deployed previews leave behind - checkouts, reserved ports,
+    routes and state store records - without deploying them.
+    """
+
+    def create(count: int) -> typing.List[DeploymentConfig]:
+        port_registry = get_port_registry()
+        routing_table = RoutingTable(os.environ["NGINX_PROXY_CONF_LOCATION"])
+        deployment_store = state.get_deployment_store()
+        configs = [preview_config(index, "live") for index in range(count)]
+        for config in configs:
+            namespace = config.get_deployment_namespace()
+            os.makedirs(
+                os.path.join(os.environ["DEPLOYMENTS_MOUNT_DIR"], namespace, ".git")
+            )
+            port = port_registry.allocate(namespace)
+            host = (
+                f"live-{config.branch_name}-8080-{config.get_project_hash()}.localhost"
+            )
+            routing_table.write_route(
+                f"live-{config.get_project_hash()}",
+                {
+                    "namespace": namespace,
+                    "hosts": [host],
+                    "host": "host.docker.internal",
+                    "port": str(port),
+                },
+            )
+            deployment_store.record_deploy_started(config)
+            deployment_store.record_deployed(
+                namespace, "0" * 40, str(port), [f"http://{host}"], {}
+            )
+        return configs
+
+    return create
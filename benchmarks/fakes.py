@@ -0,0 +1,166 @@
+"""
+Deterministic stand-ins for everything Sarthi talks to, so benchmarks measure Sarthi and not
+docker, git or Vault: fake git and docker executables, a Docker Engine API on a unix socket,
+a Vault KV v2 HTTP server and a listener holding host ports.
+"""
+import json
+import os
+import socket
+import socketserver
+import stat
+import struct
+import sys
+import threading
+import typing
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+COMMIT_SHA = "0123456789abcdef0123456789abcdef01234567"
+
+# git clone and git reset check out $SARTHI_BENCH_COMPOSE_FILE, everything else succeeds
+FAKE_GIT = """#!%(python)s
+import os, shutil, sys
+
+args = sys.argv[1:]
+if args[0] in ("clone", "reset"):
+    path = args[-1] if args[0] == "clone" else os.getcwd()
+    os.makedirs(os.path.join(path, ".git"), exist_ok=True)
+    shutil.copy(os.environ["SARTHI_BENCH_COMPOSE_FILE"], os.path.join(path, "docker-compose.yml"))
+elif args[0] == "rev-parse":
+    print("%(commit_sha)s")
+"""
+
+# docker compose up prints a line per service like a build would, everything else succeeds
+FAKE_DOCKER = """#!%(python)s
+import sys
+
+if "up" in sys.argv:
+    for line in range(20):
+        print(f"Step {line}/20 : RUN true")
+    print("Started")
+"""
+
+
+def write_fake_executables(bin_dir: str):
+    os.makedirs(bin_dir, exist_ok=True)
+    values = {"python": sys.executable, "commit_sha": COMMIT_SHA}
+    for name, template in [("git", FAKE_GIT), ("docker", FAKE_DOCKER)]:
+        path = os.path.join(bin_dir, name)
+        with open(path, "w") as file:
+            file.write(template % values)
+        os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+
+
+class _JSONHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Send headers and body in one write, Nagle's algorithm would delay the body otherwise
+    wbufsize = -1
+
+    def log_message(self, format, *args):
+        pass
+
+    def _read_body(self) -> bytes:
+        return self.rfile.read(int(self.headers.get("Content-Length") or 0))
+
+    def _send_json(self, status: int, body: typing.Any = None):
+        data = json.dumps(body).encode() if body is not None else b""
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class _FakeDockerHandler(_JSONHandler):
+    def address_string(self):
+        return "docker.sock"
+
+    def do_GET(self):
+        if self.path.startswith("/exec/"):
+            self._send_json(200, {"ExitCode": 0})
+        else:
+            # No containers, images or networks, so every deploy builds
+            self._send_json(200, [])
+
+    def do_POST(self):
+        self._read_body()
+        if self.path.endswith("/exec"):
+            self._send_json(201, {"Id": "exec-id"})
+        elif self.path.endswith("/start"):
+            self.send_response(200)
+            self.send_header("Content-Type", "application/vnd.docker.raw-stream")
+            self.end_headers()
+            text = b"nginx: configuration file test is successful\n"
+            self.wfile.write(struct.pack(">BxxxL", 2, len(text)) + text)
+            self.close_connection = True
+        else:
+            self._send_json(201, {})
+
+    def do_DELETE(self):
+        self._send_json(200, [])
+
+
+class FakeDockerEngine(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path: str):
+        super().__init__(socket_path, _FakeDockerHandler)
+
+
+class _FakeVaultHandler(_JSONHandler):
+    def do_GET(self):
+        secrets = self.server.secrets.get(self.path)
+        if secrets is None:
+            self._send_json(404, {"errors": []})
+        else:
+            self._send_json(200, {"data": {"data": secrets}})
+
+    def do_POST(self):
+        self.server.secrets[self.path] = json.loads(self._read_body())["data"]
+        self._send_json(200, {"data": {"version": 1}})
+
+    def do_DELETE(self):
+        data_path = self.path.replace("/v1/kv/metadata/", "/v1/kv/data/", 1)
+        self.server.secrets.pop(data_path, None)
+        self.send_response(204)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+
+class FakeVault(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), _FakeVaultHandler)
+        self.secrets: typing.Dict[str, typing.Dict[str, str]] = {}
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+
+def serve_in_background(server: socketserver.BaseServer) -> threading.Thread:
+    thread = threading.Thread(
+        target=server.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True
+    )
+    thread.start()
+    return thread
+
+
+class PortListener:
+    """
+    Holds host ports like processes Sarthi does not manage would, so port allocation has to
+    probe past them.
+    """
+
+    def __init__(self, ports: typing.Iterable[int]):
+        self._sockets = []
+        for port in ports:
+            listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            listener.bind(("127.0.0.1", port))
+            listener.listen()
+            self._sockets.append(listener)
+
+    def close(self):
+        for listener in self._sockets:
+            listener.close()
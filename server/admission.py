@@ -0,0 +1,186 @@
+import asyncio
+import collections
+import contextlib
+import logging
+import os
+import threading
+import typing
+
+from fastapi import HTTPException
+
+import server.constants as constants
+
+from .metrics import BUILDS_RUNNING, BUILDS_WAITING
+from .utils import (
+    DeploymentConfig,
+    list_deployment_namespaces,
+    parse_deployment_namespace,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class AdmissionController:
+    """
+    Keeps the host at a load it can handle - caps how many builds run at once, handing out
+    build slots in arrival order, and how many deployments may exist in total and per project.
+    Limits set to 0 are not enforced.
+    """
+
+    def __init__(
+        self,
+        deployments_mount_dir: str,
+        max_builds: int = constants.DEFAULT_MAX_CONCURRENT_BUILDS,
+        max_deployments: int = constants.DEFAULT_MAX_DEPLOYMENTS,
+        max_deployments_per_project: int = constants.DEFAULT_MAX_DEPLOYMENTS_PER_PROJECT,
+    ):
+        self._deployments_mount_dir = deployments_mount_dir
+        self._max_builds = max_builds
+        self._max_deployments = max_deployments
+        self._max_deployments_per_project = max_deployments_per_project
+        # Namespaces waiting for a build slot, in arrival order
+        self._waiting_builds: typing.Deque[str] = collections.deque()
+        self._running_builds = 0
+        self._condition = threading.Condition()
+
+    def check_new_deployment(
+        self, config: DeploymentConfig, pending_namespaces: typing.Iterable[str]
+    ):
+        """
+        Reject a deploy creating a new deployment if that would exceed the deployment limits.
+        pending_namespaces are deployments which are queued or being created but not on disk yet.
+        """
+        if not self._max_deployments and not self._max_deployments_per_project:
+            return
+        namespace = config.get_deployment_namespace()
+        live_namespaces = set(list_deployment_namespaces(self._deployments_mount_dir))
+        live_namespaces.update(pending_namespaces)
+        # Redeploys of existing deployments are always let through
+        if namespace in live_namespaces:
+            return
+
+        if self._max_deployments and len(live_namespaces) >= self._max_deployments:
+            logger.warning(f"Rejecting {namespace}, deployment limit reached")
+            raise HTTPException(
+                429,
+                f"Sarthi is running the maximum of {self._max_deployments} deployments. "
+                "Delete some preview environments and try again.",
+            )
+
+        if self._max_deployments_per_project:
+            project_deployments = 0
+            for live_namespace in live_namespaces:
+                names = parse_deployment_namespace(live_namespace)
+                if names and names[0] == config.project_name:
+                    project_deployments += 1
+            if project_deployments >= self._max_deployments_per_project:
+                logger.warning(f"Rejecting {namespace}, project limit reached")
+                raise HTTPException(
+                    429,
+                    f"{config.project_name} already has the maximum of "
+                    f"{self._max_deployments_per_project} deployments. "
+                    "Delete some preview environments and try again.",
+                )
+
+    def _try_acquire_build_slot(self, namespace: str) -> bool:
+        if (
+            self._waiting_builds[0] != namespace
+            or self._running_builds >= self._max_builds
+        ):
+            return False
+        self._waiting_builds.popleft()
+        self._running_builds += 1
+        BUILDS_WAITING.dec()
+        BUILDS_RUNNING.inc()
+        return True
+
+    def _enqueue_build(self, namespace: str):
+        self._waiting_builds.append(namespace)
+        BUILDS_WAITING.inc()
+        logger.info(
+            f"{namespace} is waiting for a build slot at position {len(self._waiting_builds)}"
+        )
+
+    def _abandon_build(self, namespace: str):
+        self._waiting_builds.remove(namespace)
+        BUILDS_WAITING.dec()
+        self._condition.notify_all()
+
+    def _release_build_slot(self):
+        with self._condition:
+            self._running_builds -= 1
+            BUILDS_RUNNING.dec()
+            self._condition.notify_all()
+
+    @contextlib.contextmanager
+    def build_slot(self, namespace: str):
+        if not self._max_builds:
+            yield
+            return
+        with self._condition:
+            self._enqueue_build(namespace)
+            try:
+                while not self._try_acquire_build_slot(namespace):
+                    self._condition.wait()
+            except BaseException:
+                self._abandon_build(namespace)
+                raise
+        try:
+            yield
+        finally:
+            self._release_build_slot()
+
+    @contextlib.asynccontextmanager
+    async def async_build_slot(self, namespace: str):
+        if not self._max_builds:
+            yield
+            return
+        with self._condition:
+            self._enqueue_build(namespace)
+        try:
+            while True:
+                with self._condition:
+                    if self._try_acquire_build_slot(namespace):
+                        break
+                await asyncio.sleep(constants.BUILD_SLOT_POLL_SECONDS)
+        except BaseException:
+            with self._condition:
+                self._abandon_build(namespace)
+            raise
+        try:
+            yield
+        finally:
+            self._release_build_slot()
+
+    def build_queue_position(self, namespace: str) -> typing.Optional[int]:
+        with self._condition:
+            try:
+                return self._waiting_builds.index(namespace) + 1
+            except ValueError:
+                return None
+
+
+_admission_controller: typing.Optional[AdmissionController] = None
+_admission_controller_lock = threading.Lock()
+
+
+def get_admission_controller() -> AdmissionController:
+    global _admission_controller
+    with _admission_controller_lock:
+        if _admission_controller is None:
+            _admission_controller = AdmissionController(
+                os.environ.get("DEPLOYMENTS_MOUNT_DIR") or "",
+                max_builds=int(
+                    os.environ.get("MAX_CONCURRENT_BUILDS")
+                    or constants.DEFAULT_MAX_CONCURRENT_BUILDS
+                ),
+                max_deployments=int(
+                    os.environ.get("MAX_DEPLOYMENTS")
+                    or constants.DEFAULT_MAX_DEPLOYMENTS
+                ),
+                max_deployments_per_project=int(
+                    os.environ.get("MAX_DEPLOYMENTS_PER_PROJECT")
+                    or constants.DEFAULT_MAX_DEPLOYMENTS_PER_PROJECT
+                ),
+            )
+        return _admission_controller
@@ -0,0 +1,232 @@
+import asyncio
+import contextlib
+import logging
+import os
+import shutil
+import threading
+import time
+import typing
+import weakref
+
+import filelock
+from fastapi.exceptions import HTTPException
+
+import server.constants as constants
+
+from .admission import get_admission_controller
+from .async_utils import (
+    AsyncComposeHelper,
+    AsyncNginxHelper,
+    AsyncSecretsHelper,
+    run_command,
+)
+from .deployer import Deployer
+from .metrics import DEPLOYMENT_LOCK_WAIT_SECONDS, track_phase
+from .state import get_deployment_store
+from .utils import DeploymentConfig, strip_credentials
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncDeployer(Deployer):
+    """
+    Deployer for the asyncio pipeline - git and docker run as asyncio subprocesses, Vault is
+    called with httpx and waiting for the deployment lock does not hold a thread, so a single
+    event loop can drive many deployments at once.
+
+    Unlike Deployer, nothing is done in the constructor, the project is synced when
+    deploy_preview_environment is awaited.
+    """
+
+    # namespace -> lock held by the deployers of this process working on it
+    _namespace_locks: "weakref.WeakValueDictionary[str, asyncio.Lock]" = (
+        weakref.WeakValueDictionary()
+    )
+
+    def __init__(self, config: DeploymentConfig, cancel_event: threading.Event = None):
+        self._init_state(config, cancel_event)
+        self._namespace_lock = self._namespace_locks.setdefault(
+            self._deployment_namespace, asyncio.Lock()
+        )
+
+    @contextlib.asynccontextmanager
+    async def _locked(self):
+        start = time.perf_counter()
+        # Deployers of this process queue up on the asyncio lock, the file lock is only
+        # contended by other processes so polling it is cheap
+        async with self._namespace_lock:
+            while True:
+                try:
+                    self._lock.acquire(timeout=0)
+                    break
+                except filelock.Timeout:
+                    await asyncio.sleep(constants.ASYNC_LOCK_POLL_SECONDS)
+            try:
+                DEPLOYMENT_LOCK_WAIT_SECONDS.observe(time.perf_counter() - start)
+                yield
+            finally:
+                self._lock.release()
+
+    async def _create_async_helpers(self):
+        # Parsing the compose file is the only blocking part of creating the helpers
+        await asyncio.to_thread(
+            self._create_helpers,
+            AsyncComposeHelper,
+            AsyncSecretsHelper,
+            AsyncNginxHelper,
+        )
+
+    async def _clone_project(self):
+        return_code, output = await run_command(self._clone_command())
+        if return_code != 0:
+            logger.error(f"Git clone failed. Return code: {return_code}")
+            logger.error(f"Output: {output}")
+            raise HTTPException(
+                500,
+                strip_credentials(
+                    f"Cloning the Git repo failed {self._config.project_git_url}:{self._config.branch_name} {output}"
+                ),
+            )
+        logger.info("Git clone successful.")
+
+    async def _fetch_project(self) -> bool:
+        if not os.path.isdir(os.path.join(self._project_path, ".git")):
+            return False
+        for args in self._fetch_commands():
+            return_code, output = await run_command(["git", *args], self._project_path)
+            if return_code != 0:
+                logger.warning(
+                    f"Git fetch failed for {self._project_path}, cloning again: {output}"
+                )
+                return False
+        logger.info(f"Git fetch successful for {self._project_path}")
+        return True
+
+    async def _setup_project(self):
+        if self._use_mirror:
+            await asyncio.to_thread(
+                self._mirror_helper.sync, self._config.branch_name_raw
+            )
+        if self._git_sync_mode != constants.GIT_SYNC_CLONE and (
+            await self._fetch_project()
+        ):
+            return
+        if os.path.exists(self._project_path):
+            logger.debug(f"Removing older project path {self._project_path}")
+            await asyncio.to_thread(shutil.rmtree, self._project_path)
+        await self._clone_project()
+
+    async def _allocate_port(self) -> typing.Optional[str]:
+        if self._direct_routing:
+            await self._nginx_helper.release_port()
+            return None
+        return await self._nginx_helper.find_free_port()
+
+    async def _configure_outer_proxy(self):
+        if not self._project_nginx_port and not self._direct_routing:
+            logger.error("Project Proxy not deployed, project_nginx_port is None")
+            raise HTTPException(
+                500, "Project Proxy not deployed, project_nginx_port is None"
+            )
+        await asyncio.to_thread(
+            self._nginx_helper.generate_outer_proxy_conf_file, self._project_nginx_port
+        )
+        await self._nginx_helper.reload_nginx(new_outer_proxy=True)
+
+    async def _read_commit_sha(self) -> str:
+        return_code, output = await run_command(
+            ["git", "rev-parse", "HEAD"], self._project_path
+        )
+        if return_code != 0:
+            raise HTTPException(500, f"Cannot read the deployed commit: {output}")
+        return output.strip()
+
+    async def _deploy_project(self) -> str:
+        # Files are written and hashed in threads, so the event loop never waits on the disk
+        services = self._compose_helper.get_service_ports_config()
+        conf_file_path, urls = await asyncio.to_thread(
+            self._nginx_helper.generate_project_proxy_conf_file,
+            services,
+            self._compose_helper.get_service_proxy_settings(),
+        )
+        with track_phase("port_alloc"):
+            self._project_nginx_port = await self._allocate_port()
+        await self._secrets_helper.inject_env_variables(self._project_path)
+        await asyncio.to_thread(
+            self._compose_helper.prepare_services,
+            self._project_nginx_port,
+            conf_file_path,
+            self._deployment_namespace,
+        )
+        self._commit_sha = await self._read_commit_sha()
+        self._deploy_fingerprint = await asyncio.to_thread(
+            self._fingerprint, self._commit_sha, conf_file_path, urls
+        )
+        mode = await asyncio.to_thread(
+            self._redeploy_mode,
+            self._deploy_fingerprint,
+            self._compose_helper.is_running,
+        )
+        if mode == constants.DEPLOY_UNCHANGED:
+            return mode
+        if mode == constants.DEPLOY_RECREATE:
+            with track_phase("compose_up"):
+                await self._compose_helper.start_services(
+                    self._project_nginx_port,
+                    conf_file_path,
+                    self._deployment_namespace,
+                    build=False,
+                )
+            return mode
+
+        async with get_admission_controller().async_build_slot(
+            self._deployment_namespace
+        ):
+            self._raise_if_cancelled()
+            with track_phase("compose_up"):
+                await self._compose_helper.start_services(
+                    self._project_nginx_port,
+                    conf_file_path,
+                    self._deployment_namespace,
+                )
+        return mode
+
+    async def deploy_preview_environment(self):
+        async with self._locked():
+            self._raise_if_cancelled()
+            with track_phase("clone"):
+                await self._setup_project()
+            await self._create_async_helpers()
+            if await self._deploy_project() != constants.DEPLOY_UNCHANGED:
+                with track_phase("outer_proxy"):
+                    await self._configure_outer_proxy()
+                await asyncio.to_thread(
+                    self._fingerprints.save,
+                    self._deployment_namespace,
+                    self._deploy_fingerprint,
+                )
+            await asyncio.to_thread(self._record_deployed)
+        return self._deploy_fingerprint.urls
+
+    async def delete_preview_environment(self):
+        async with self._locked():
+            await self._create_async_helpers()
+            with track_phase("delete"):
+                await self._compose_helper.remove_services()
+                await asyncio.to_thread(
+                    self._compose_helper.remove_images, self._deployment_namespace
+                )
+                await asyncio.to_thread(self._nginx_helper.remove_outer_proxy)
+                await self._nginx_helper.reload_nginx()
+                await self._nginx_helper.release_port()
+                await asyncio.to_thread(self._delete_deployment_files)
+                await asyncio.to_thread(
+                    self._mirror_helper.release, self._config.branch_name_raw
+                )
+                await asyncio.to_thread(
+                    self._fingerprints.remove, self._deployment_namespace
+                )
+                await asyncio.to_thread(
+                    get_deployment_store().remove, self._deployment_namespace
+                )
+                await self._secrets_helper.cleanup_deployment_variables()
@@ -0,0 +1,235 @@
+import asyncio
+import json
+import logging
+import os
+import pathlib
+import typing
+
+import httpx
+from fastapi import HTTPException
+
+import server.constants as constants
+
+from .logs import BuildLogBuffer, build_logs
+from .metrics import track_phase
+from .utils import ComposeHelper, NginxHelper, SecretsHelper
+from .vault import get_async_vault_client, get_secrets_cache
+
+logger = logging.getLogger(__name__)
+
+
+async def stream_command(
+    command: typing.List[str],
+    cwd: typing.Union[str, pathlib.Path] = None,
+    on_line: typing.Callable[[str], None] = None,
+) -> int:
+    """
+    Run a command as an asyncio subprocess with stdout and stderr merged, handing every
+    output line to on_line as it is read. The process is killed if the caller is cancelled.
+    """
+    process = await asyncio.create_subprocess_exec(
+        *command,
+        cwd=cwd,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.STDOUT,
+        limit=constants.ASYNC_SUBPROCESS_LINE_LIMIT,
+    )
+    try:
+        async for line in process.stdout:
+            if on_line:
+                on_line(line.decode(errors="replace"))
+        return await process.wait()
+    except asyncio.CancelledError:
+        process.kill()
+        await process.wait()
+        raise
+
+
+async def run_command(
+    command: typing.List[str], cwd: typing.Union[str, pathlib.Path] = None
+) -> typing.Tuple[int, str]:
+    output = []
+    return_code = await stream_command(command, cwd, output.append)
+    return return_code, "".join(output)
+
+
+class AsyncComposeHelper(ComposeHelper):
+    async def start_services(
+        self,
+        nginx_port: str,
+        conf_file_path: str,
+        deployment_namespace: str,
+        build: bool = True,
+    ):
+        self._prepare_compose_file(nginx_port, conf_file_path, deployment_namespace)
+
+        command = self._compose_up_command(build)
+        project_dir = pathlib.Path(self._compose_file_location).parent
+        build_log: BuildLogBuffer = build_logs.start(deployment_namespace)
+
+        try:
+            return_code = await stream_command(command, project_dir, build_log.append)
+        except Exception as e:
+            msg = f"An unexpected error occurred while starting services: {e}"
+            logger.error(msg)
+            raise HTTPException(500, msg)
+        finally:
+            build_log.close()
+
+        self._check_compose_up(return_code, build_log)
+        if self._direct_routing:
+            await asyncio.to_thread(self._connect_outer_proxies)
+        if build:
+            await asyncio.to_thread(self._share_build_cache, deployment_namespace)
+
+    async def remove_services(self):
+        project_dir = pathlib.Path(self._compose_file_location).parent
+        if not os.path.exists(project_dir):
+            logger.info(f"{self._compose_file_location} is already deleted!")
+            return "Deployment already deleted"
+        await asyncio.to_thread(self._disconnect_outer_proxies)
+        try:
+            return_code, output = await run_command(
+                ["docker", "compose", "down", "-v"], project_dir
+            )
+        except Exception as e:
+            msg = f"An unexpected error occurred while removing services: {e}"
+            logger.error(msg)
+            raise HTTPException(500, msg)
+        if return_code != 0:
+            msg = f"Docker Compose down failed with exit code {return_code}: {output}"
+            logger.error(msg)
+            raise HTTPException(500, msg)
+        logger.info("Docker Compose down -v executed successfully.")
+
+
+class AsyncNginxHelper(NginxHelper):
+    async def _probe_port(self, port: int) -> bool:
+        try:
+            _, writer = await asyncio.open_connection(self._host_name, port)
+        except ConnectionRefusedError:
+            return True
+        writer.close()
+        await writer.wait_closed()
+        return False
+
+    async def find_free_port(self) -> str:
+        port = await asyncio.to_thread(
+            self._port_registry.get, self._deployment_namespace
+        )
+        # Redeploys keep their port, which their own project nginx is listening on
+        busy_ports: typing.Set[int] = set()
+        while not port:
+            port = await asyncio.to_thread(
+                self._port_registry.allocate,
+                self._deployment_namespace,
+                lambda candidate: candidate not in busy_ports,
+            )
+            if not await self._probe_port(port):
+                logger.debug(f"Port {port} is in use outside of Sarthi, skipping it")
+                busy_ports.add(port)
+                await self.release_port()
+                port = None
+        self._port = port
+        return str(port)
+
+    async def reload_nginx(self, new_outer_proxy: bool = False):
+        # Reloads are batched with other deployments by the reload coordinator, which waits
+        # on a thread condition, so only that wait is moved off the event loop
+        await asyncio.to_thread(super().reload_nginx, new_outer_proxy)
+
+    async def release_port(self):
+        await asyncio.to_thread(super().release_port)
+
+
+class AsyncSecretsHelper(SecretsHelper):
+    async def _write_secrets_to_vault(self, secret_path_url, secrets: typing.Dict):
+        with track_phase("vault_write"):
+            try:
+                response = await get_async_vault_client().post(
+                    secret_path_url,
+                    headers=self._headers,
+                    content=json.dumps(
+                        {"data": {key: value for key, value in secrets.items()}}
+                    ),
+                )
+                response.raise_for_status()
+            except httpx.HTTPError as e:
+                logger.error(f"Error writing secrets to {secret_path_url}: {e}")
+                raise HTTPException(500, str(e))
+            finally:
+                get_secrets_cache().invalidate(secret_path_url)
+
+    async def _read_secrets_from_vault(self, secret_path_url):
+        with track_phase("vault_read"):
+            try:
+                response = await get_async_vault_client().get(
+                    secret_path_url, headers=self._headers
+                )
+            except httpx.HTTPError as e:
+                logger.error(
+                    f"Cannot read secrets from vault for {secret_path_url}: {e}"
+                )
+                raise HTTPException(
+                    500, f"Cannot read secrets from vault for {secret_path_url}"
+                )
+            return self._secrets_from_response(secret_path_url, response)
+
+    async def _read_default_secrets(self):
+        secrets_cache = get_secrets_cache()
+        cached_secrets = secrets_cache.get(self._default_secret_url)
+        if cached_secrets:
+            return cached_secrets
+        try:
+            secrets = await self._read_secrets_from_vault(self._default_secret_url)
+        except HTTPException:
+            stale_secrets = secrets_cache.get_stale(self._default_secret_url)
+            if not stale_secrets:
+                raise
+            logger.warning(
+                f"Vault unreachable, using cached {self._default_secret_url}"
+            )
+            return stale_secrets
+        self._cache_default_secrets(secrets)
+        return secrets
+
+    async def _create_env_placeholder(self):
+        default_response = await self._read_default_secrets()
+
+        if not default_response:
+            logger.debug(
+                "Default secrets not found, ingesting secrets from sample envs"
+            )
+            sample_envs = self._load_sample_envs()
+            await asyncio.gather(
+                self._write_secrets_to_vault(self._default_secret_url, sample_envs),
+                self._write_secrets_to_vault(self._secret_url, sample_envs),
+            )
+            return sample_envs
+
+        await self._write_secrets_to_vault(self._secret_url, default_response)
+        return default_response
+
+    async def inject_env_variables(self, project_path):
+        secret_data = await self._read_secrets_from_vault(self._secret_url)
+
+        if not secret_data:
+            logger.info(f"No secrets found in vault for {self._secrets_namespace}")
+            secret_data = await self._create_env_placeholder()
+
+        logger.info(f"Found secrets for {self._secrets_namespace}")
+        self._write_env_file(project_path, secret_data)
+
+    async def cleanup_deployment_variables(self):
+        with track_phase("vault_delete"):
+            try:
+                response = await get_async_vault_client().delete(
+                    self._secret_metadata_url, headers=self._headers
+                )
+                logger.debug(
+                    f"Tried Removing Deployment variables from Vault {response.status_code}"
+                )
+                response.raise_for_status()
+                return response
+            except httpx.HTTPError as e:
+                logger.error(f"Error removing deployment secrets {e}")
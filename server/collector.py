@@ -0,0 +1,282 @@
+import fnmatch
+import logging
+import os
+import shutil
+import threading
+import time
+import typing
+from dataclasses import dataclass, field
+
+import server.constants as constants
+
+from .metrics import GC_DEPLOYMENTS_DELETED
+from .state import get_deployment_store
+from .teardown import BulkTeardown
+from .utils import (
+    DeploymentConfig,
+    NginxHelper,
+    get_deployment_config,
+    list_deployment_namespaces,
+)
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class GarbageCollectionPolicy:
+    # 0 disables a policy
+    max_age_seconds: float = 0
+    max_idle_seconds: float = 0
+    max_previews_per_project: int = 0
+    disk_high_water_percent: float = 0
+    # Shell style patterns of branches which are never collected, like main
+    exclude_branches: typing.List[str] = field(default_factory=list)
+
+    @property
+    def enabled(self) -> bool:
+        return (
+            self.max_age_seconds > 0
+            or self.max_idle_seconds > 0
+            or self.max_previews_per_project > 0
+            or self.disk_high_water_percent > 0
+        )
+
+
+@dataclass
+class _Deployment:
+    config: DeploymentConfig
+    deployed_at: float
+    accessed_at: typing.Optional[float]
+    reasons: typing.List[str] = field(default_factory=list)
+
+    @property
+    def namespace(self) -> str:
+        return self.config.get_deployment_namespace()
+
+    @property
+    def last_activity(self) -> float:
+        return max(self.deployed_at, self.accessed_at or 0)
+
+    def to_dict(self) -> typing.Dict:
+        return {
+            "namespace": self.namespace,
+            "project_name": self.config.project_name,
+            "branch_name": self.config.branch_name_raw,
+            "deployed_at": self.deployed_at,
+            "accessed_at": self.accessed_at,
+            "reasons": self.reasons,
+        }
+
+
+def _directory_size(path: str) -> int:
+    size = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                size += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return size
+
+
+class GarbageCollector:
+    """
+    Deletes the preview environments nobody asked to delete, like the ones of force pushed
+    branches, deleted repositories or failed workflow runs. Deployments matching a policy are
+    torn down in batches of batch_size through BulkTeardown, so nginx is reloaded once per batch.
+
+    A pass runs every interval_seconds once any policy is set. Namespaces for which is_busy
+    returns True, like the ones with queued or running jobs, are left alone.
+    """
+
+    def __init__(
+        self,
+        deployments_mount_dir: str,
+        outer_conf_dir: str,
+        policy: GarbageCollectionPolicy,
+        interval_seconds: float = constants.DEFAULT_GC_INTERVAL_SECONDS,
+        batch_size: int = constants.DEFAULT_GC_BATCH_SIZE,
+        is_busy: typing.Callable[[str], bool] = None,
+    ):
+        self._deployments_mount_dir = deployments_mount_dir
+        self._outer_conf_dir = outer_conf_dir
+        self._policy = policy
+        self._interval_seconds = interval_seconds
+        self._batch_size = max(batch_size, 1)
+        self._is_busy = is_busy or (lambda namespace: False)
+        self._teardown = BulkTeardown(
+            deployments_mount_dir, max_workers=self._batch_size
+        )
+        # A pass started from the API waits for the scheduled one
+        self._collect_lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread: typing.Optional[threading.Thread] = None
+
+    @property
+    def enabled(self) -> bool:
+        return self._policy.enabled
+
+    def start(self):
+        if not self.enabled or self._thread:
+            return
+        self._thread = threading.Thread(target=self._run, name="sarthi-gc", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def _run(self):
+        while not self._stop_event.wait(self._interval_seconds):
+            try:
+                self.collect()
+            except Exception as e:
+                logger.exception(f"Error collecting stale deployments: {e}")
+
+    def _checkout_path(self, namespace: str) -> str:
+        return os.path.join(self._deployments_mount_dir, namespace)
+
+    def _deployed_at(self, namespace: str) -> float:
+        record = get_deployment_store().get(namespace)
+        if record:
+            return record["deployed_at"] or record["updated_at"]
+        # Deployments made before the state store existed, every git sync touches .git
+        git_path = os.path.join(self._checkout_path(namespace), ".git")
+        return os.path.getmtime(
+            git_path if os.path.exists(git_path) else self._checkout_path(namespace)
+        )
+
+    def _is_excluded(self, config: DeploymentConfig) -> bool:
+        return any(
+            fnmatch.fnmatchcase(config.branch_name_raw, pattern)
+            or fnmatch.fnmatchcase(config.branch_name, pattern)
+            for pattern in self._policy.exclude_branches
+        )
+
+    def _deployments(self) -> typing.List[_Deployment]:
+        deployments = []
+        for namespace in list_deployment_namespaces(self._deployments_mount_dir):
+            if self._is_busy(namespace):
+                continue
+            config = get_deployment_config(self._deployments_mount_dir, namespace)
+            if not config or self._is_excluded(config):
+                continue
+            nginx_helper = NginxHelper(
+                config, self._outer_conf_dir, self._checkout_path(namespace)
+            )
+            deployments.append(
+                _Deployment(
+                    config, self._deployed_at(namespace), nginx_helper.last_access()
+                )
+            )
+        return deployments
+
+    def _select_expired(self, deployments: typing.List[_Deployment], now: float):
+        for deployment in deployments:
+            max_age_seconds = self._policy.max_age_seconds
+            if max_age_seconds > 0 and now - deployment.deployed_at > max_age_seconds:
+                deployment.reasons.append(constants.GC_MAX_AGE)
+            # Deployments whose access is not tracked count as accessed when deployed
+            max_idle_seconds = self._policy.max_idle_seconds
+            if (
+                max_idle_seconds > 0
+                and now - deployment.last_activity > max_idle_seconds
+            ):
+                deployment.reasons.append(constants.GC_MAX_IDLE)
+
+    def _select_over_project_limit(self, deployments: typing.List[_Deployment]):
+        limit = self._policy.max_previews_per_project
+        if limit <= 0:
+            return
+        projects: typing.Dict[str, typing.List[_Deployment]] = {}
+        for deployment in deployments:
+            if not deployment.reasons:
+                projects.setdefault(deployment.config.project_name, []).append(
+                    deployment
+                )
+        # The most recently deployed previews of a project are kept
+        for project_deployments in projects.values():
+            project_deployments.sort(key=lambda d: d.deployed_at, reverse=True)
+            for deployment in project_deployments[limit:]:
+                deployment.reasons.append(constants.GC_MAX_PREVIEWS_PER_PROJECT)
+
+    def disk_usage_percent(self) -> typing.Optional[float]:
+        if not os.path.isdir(self._deployments_mount_dir):
+            return None
+        usage = shutil.disk_usage(self._deployments_mount_dir)
+        return usage.used / usage.total * 100
+
+    def _select_for_disk_usage(self, deployments: typing.List[_Deployment]):
+        high_water_percent = self._policy.disk_high_water_percent
+        if high_water_percent <= 0 or not os.path.isdir(self._deployments_mount_dir):
+            return
+        usage = shutil.disk_usage(self._deployments_mount_dir)
+        high_water_bytes = usage.total * high_water_percent / 100
+        if usage.used <= high_water_bytes:
+            return
+        # Only checkouts are cheap to size, so removing the images and volumes frees even more
+        freed = sum(
+            _directory_size(self._checkout_path(deployment.namespace))
+            for deployment in deployments
+            if deployment.reasons
+        )
+        least_recently_used = sorted(
+            (deployment for deployment in deployments if not deployment.reasons),
+            key=lambda d: d.last_activity,
+        )
+        for deployment in least_recently_used:
+            if usage.used - freed <= high_water_bytes:
+                break
+            deployment.reasons.append(constants.GC_DISK_USAGE)
+            freed += _directory_size(self._checkout_path(deployment.namespace))
+
+    def _delete(self, stale: typing.List[_Deployment]) -> typing.Dict:
+        deleted: typing.List[str] = []
+        failed: typing.Dict[str, str] = {}
+        for start in range(0, len(stale), self._batch_size):
+            if self._stop_event.is_set():
+                break
+            batch = stale[start : start + self._batch_size]  # noqa: E203
+            # A deploy may have been queued since the deployments were listed
+            configs = {
+                deployment.namespace: deployment.config
+                for deployment in batch
+                if not self._is_busy(deployment.namespace)
+            }
+            if not configs:
+                continue
+            result = self._teardown.delete(configs)
+            deleted.extend(result["deleted"])
+            failed.update(result["failed"])
+            for deployment in batch:
+                if deployment.namespace in result["deleted"]:
+                    GC_DEPLOYMENTS_DELETED.labels(deployment.reasons[0]).inc()
+        return {"deleted": deleted, "failed": failed}
+
+    def collect(self, dry_run: bool = False) -> typing.Dict:
+        """
+        Delete the deployments matching the policy, least recently used first, and report
+        them with the policies they matched. With dry_run nothing is deleted.
+        """
+        with self._collect_lock:
+            deployments = self._deployments()
+            self._select_expired(deployments, time.time())
+            self._select_over_project_limit(deployments)
+            self._select_for_disk_usage(deployments)
+            stale = sorted(
+                (deployment for deployment in deployments if deployment.reasons),
+                key=lambda d: d.last_activity,
+            )
+
+            report = {
+                "dry_run": dry_run,
+                "disk_usage_percent": self.disk_usage_percent(),
+                "stale": [deployment.to_dict() for deployment in stale],
+            }
+            if dry_run:
+                return report
+            report.update(self._delete(stale))
+        if stale:
+            logger.info(
+                f"Collected {len(report['deleted'])} stale deployments, {len(report['failed'])} failed"
+            )
+        return report
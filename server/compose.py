@@ -0,0 +1,113 @@
+import re
+import typing
+from dataclasses import dataclass
+
+import yaml
+from fastapi import HTTPException
+
+# The libyaml bindings parse and dump several times faster, PyYAML falls back to pure Python
+# when it was built without them
+SafeLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+SafeDumper = getattr(yaml, "CSafeDumper", yaml.SafeDumper)
+
+# [host ip:][published:]target[/protocol], ports may be ranges like 8000-8010
+SHORT_PORT_PATTERN = re.compile(
+    r"(?:(?P<host_ip>\[[0-9a-fA-F:.]+\]|\d+\.\d+\.\d+\.\d+):)?"
+    r"(?:(?P<published>\d*(?:-\d+)?):)?"
+    r"(?P<target>\d+(?:-\d+)?)"
+    r"(?:/(?P<protocol>tcp|udp|sctp))?"
+)
+
+
+@dataclass(frozen=True)
+class PortMapping:
+    target: str
+    # None if docker picks the host port
+    published: typing.Optional[str]
+    protocol: str = "tcp"
+    host_ip: typing.Optional[str] = None
+
+    @property
+    def url_port(self) -> str:
+        # Port in the preview URL of the service
+        return self.published or self.target
+
+
+def load_yaml(stream: typing.Union[str, typing.IO]) -> typing.Any:
+    return yaml.load(stream, Loader=SafeLoader)
+
+
+def dump_yaml(data: typing.Any, stream: typing.IO):
+    yaml.dump(data, stream, Dumper=SafeDumper, default_flow_style=False)
+
+
+def _port_range(ports: str) -> typing.List[str]:
+    start, _, end = ports.partition("-")
+    if not end:
+        return [start]
+    if int(end) < int(start):
+        raise ValueError(f"{ports} is not a range")
+    return [str(port) for port in range(int(start), int(end) + 1)]
+
+
+def _expand(
+    target: str,
+    published: typing.Optional[str],
+    protocol: str,
+    host_ip: typing.Optional[str],
+) -> typing.List[PortMapping]:
+    targets = _port_range(target)
+    published_ports = _port_range(published) if published else [None] * len(targets)
+    if len(published_ports) != len(targets):
+        if len(targets) != 1:
+            raise ValueError("published and target ranges differ in size")
+        # A single target is published on one port of the range
+        published_ports = published_ports[:1]
+    return [
+        PortMapping(target_port, published_port, protocol, host_ip)
+        for target_port, published_port in zip(targets, published_ports)
+    ]
+
+
+def _parse_port(port: typing.Union[str, int, typing.Dict]) -> typing.List[PortMapping]:
+    if isinstance(port, dict):
+        published = port.get("published")
+        return _expand(
+            str(port["target"]),
+            str(published) if published not in (None, "") else None,
+            port.get("protocol") or "tcp",
+            port.get("host_ip"),
+        )
+    match = SHORT_PORT_PATTERN.fullmatch(str(port).strip())
+    if not match:
+        raise ValueError("unknown port syntax")
+    return _expand(
+        match["target"],
+        match["published"] or None,
+        match["protocol"] or "tcp",
+        match["host_ip"],
+    )
+
+
+def parse_ports(
+    service: str, ports: typing.List[typing.Union[str, int, typing.Dict]]
+) -> typing.List[PortMapping]:
+    """
+    Port mappings of a service in any of the compose port syntaxes, with ranges expanded.
+    """
+    mappings = []
+    for port in ports or []:
+        try:
+            mappings.extend(_parse_port(port))
+        except (KeyError, ValueError) as e:
+            raise HTTPException(400, f"Invalid port {port} of service {service}: {e}")
+    return mappings
+
+
+def parse_service_ports(
+    compose: typing.Dict,
+) -> typing.Dict[str, typing.List[PortMapping]]:
+    return {
+        service: parse_ports(service, config.get("ports"))
+        for service, config in (compose.get("services") or {}).items()
+    }
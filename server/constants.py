@@ -15,6 +15,139 @@ DOCKER_HOST_NETWORK_DOMAIN = "host.docker.internal"
 DEFAULT_DEPLOYMENT_PORT_START = 15000
 DEFAULT_DEPLOYMENT_PORT_END = 25000
 
+DEFAULT_NGINX_RELOAD_DEBOUNCE_SECONDS = 0.2
+
+# container name of the outer nginx in docker-compose.yml
+SARTHI_NGINX_CONTAINER = "sarthi_nginx"
+DEFAULT_DOCKER_SOCKET_PATH = "/var/run/docker.sock"
+DEFAULT_DOCKER_API_TIMEOUT_SECONDS = 60
+DEFAULT_DOCKER_API_POOL_SIZE = 4
+
+# Built images are named sarthi/<project>/<service>:<branch>, the last build of any branch of
+# a project is also tagged with BUILD_CACHE_TAG so other branches can build on its layers
+IMAGE_REPOSITORY_PREFIX = "sarthi"
+BUILD_CACHE_TAG = "sarthi-cache"
+BUILD_NAMESPACE_LABEL = "sarthi.namespace"
+
 LOCALHOST = "localhost"
 
 SAMPLE_ENV_FILENAMES = [".env.sample", "env.sample", "sample.env"]
+
+DEFAULT_DEPLOYMENT_WORKERS = 2
+DEFAULT_JOB_HISTORY_SIZE = 500
+
+DEPLOYMENT_PIPELINE_THREADS = "threads"
+DEPLOYMENT_PIPELINE_ASYNC = "async"
+ASYNC_LOCK_POLL_SECONDS = 0.1
+# Longest line asyncio subprocess readers accept, docker build progress lines can be long
+ASYNC_SUBPROCESS_LINE_LIMIT = 1024 * 1024
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_SUCCEEDED = "succeeded"
+JOB_FAILED = "failed"
+JOB_SUPERSEDED = "superseded"
+JOB_CANCELLED = "cancelled"
+JOB_FINISHED_STATES = [JOB_SUCCEEDED, JOB_FAILED, JOB_SUPERSEDED, JOB_CANCELLED]
+
+GIT_SYNC_FETCH = "fetch"
+GIT_SYNC_CLONE = "clone"
+GIT_SYNC_MIRROR = "mirror"
+
+# What a deploy has to do, based on the fingerprint of the last successful one
+DEPLOY_BUILD = "build"
+DEPLOY_RECREATE = "recreate"
+DEPLOY_UNCHANGED = "unchanged"
+
+# Directory under DEPLOYMENTS_MOUNT_DIR holding the per project bare mirrors
+GIT_MIRRORS_DIR = ".mirrors"
+# Directory under DEPLOYMENTS_MOUNT_DIR holding Sarthi's own bookkeeping files
+SARTHI_STATE_DIR = ".sarthi"
+PORT_REGISTRY_FILE = "ports.json"
+# SQLite database under SARTHI_STATE_DIR recording the deployments, unless STATE_DB_PATH is set
+STATE_DB_FILE = "state.db"
+DEFAULT_DEPLOYMENTS_PAGE_SIZE = 50
+MAX_DEPLOYMENTS_PAGE_SIZE = 500
+DEPLOYMENT_DEPLOYING = "deploying"
+DEPLOYMENT_RUNNING = "running"
+DEPLOYMENT_FAILED = "failed"
+DEPLOYMENT_HIBERNATED = "hibernated"
+# Directory under SARTHI_STATE_DIR holding the fingerprint of the last deploy of every namespace
+FINGERPRINTS_DIR = "fingerprints"
+
+DEFAULT_BUILD_LOG_MAX_LINES = 2000
+DEFAULT_BUILD_LOG_MAX_BUFFERS = 100
+BUILD_LOG_MAX_LINE_LENGTH = 4096
+BUILD_LOG_POLL_SECONDS = 15
+BUILD_LOG_ERROR_TAIL_LINES = 20
+
+DEFAULT_VAULT_CONNECT_TIMEOUT_SECONDS = 3
+DEFAULT_VAULT_READ_TIMEOUT_SECONDS = 10
+DEFAULT_VAULT_MAX_RETRIES = 3
+DEFAULT_VAULT_RETRY_BACKOFF_SECONDS = 0.5
+DEFAULT_VAULT_POOL_SIZE = 10
+
+DEFAULT_SECRETS_CACHE_TTL_SECONDS = 60
+DEFAULT_SECRETS_CACHE_STALE_SECONDS = 600
+DEFAULT_SECRETS_CACHE_MAX_ENTRIES = 256
+
+DEFAULT_BULK_DELETE_WORKERS = 8
+# Length of the project/branch hash at the end of a deployment namespace
+PROJECT_HASH_LENGTH = 10
+
+# Reconciliation of checkouts, compose stacks, outer proxy confs and ports, 0 only runs it on startup
+DEFAULT_RECONCILE_INTERVAL_SECONDS = 600
+# Reconciliation results which changed outer proxy confs, nginx is reloaded after them
+RECONCILE_CONF_CHANGES = ["removed_confs", "removed_checkouts", "repaired_confs"]
+
+# Garbage collection of stale deployments, every policy is disabled unless set
+DEFAULT_GC_INTERVAL_SECONDS = 3600
+DEFAULT_GC_BATCH_SIZE = 8
+GC_MAX_AGE = "max_age"
+GC_MAX_IDLE = "max_idle"
+GC_MAX_PREVIEWS_PER_PROJECT = "max_previews_per_project"
+GC_DISK_USAGE = "disk_usage"
+
+# Hibernation of idle deployments, disabled unless HIBERNATE_IDLE_MINUTES is set
+DEFAULT_HIBERNATION_CHECK_SECONDS = 60
+DEFAULT_WAKE_TIMEOUT_SECONDS = 120
+WAKE_WORKERS = 2
+WAKE_RETRY_AFTER_SECONDS = 5
+# Routes of the deployments, one file each, and the nginx routing table generated from them
+ROUTES_DIR = "routes"
+ROUTING_TABLE_FILE = "sarthi-routes.conf"
+# proxy: outer nginx -> host port -> project nginx -> service
+# direct: outer nginx -> service, over the network of the compose stack
+ROUTING_MODE_PROXY = "proxy"
+ROUTING_MODE_DIRECT = "direct"
+# Docker's embedded DNS, resolves the services of the stacks the outer nginx is connected to
+DEFAULT_NGINX_RESOLVER = "127.0.0.11"
+# Idle keep-alive connections every nginx worker keeps open per upstream, 0 disables them
+DEFAULT_NGINX_UPSTREAM_KEEPALIVE = 16
+# Compose service labels, like sarthi.proxy.read_timeout: 300s, override the nginx settings
+# of the proxies in front of the service
+PROXY_SETTING_LABEL_PREFIX = "sarthi.proxy."
+PROXY_SETTINGS = {
+    "buffering": "proxy_buffering",
+    "request_buffering": "proxy_request_buffering",
+    "buffer_size": "proxy_buffer_size",
+    "buffers": "proxy_buffers",
+    "busy_buffers_size": "proxy_busy_buffers_size",
+    "connect_timeout": "proxy_connect_timeout",
+    "read_timeout": "proxy_read_timeout",
+    "send_timeout": "proxy_send_timeout",
+    "max_body_size": "client_max_body_size",
+}
+# Upstream of Sarthi's wake endpoint, for hibernated deployments
+WAKE_UPSTREAM = "sarthi-wake"
+# Per deployment access logs live next to the outer proxy confs, which both containers mount
+ACCESS_LOGS_DIR = "access-logs"
+OUTER_NGINX_CONF_DIR = "/etc/nginx/conf.d"
+ACCESS_LOG_MAX_BYTES = 1024 * 1024
+DEFAULT_SARTHI_INTERNAL_HOST = "sarthi:5000"
+
+# Admission control, 0 means unlimited
+DEFAULT_MAX_CONCURRENT_BUILDS = 0
+DEFAULT_MAX_DEPLOYMENTS = 0
+DEFAULT_MAX_DEPLOYMENTS_PER_PROJECT = 0
+BUILD_SLOT_POLL_SECONDS = 0.5
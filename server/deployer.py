@@ -1,7 +1,10 @@
+import contextlib
 import logging
 import os
 import shutil
 import subprocess
+import threading
+import time
 import typing
 
 import filelock
@@ -9,18 +12,45 @@ from fastapi.exceptions import HTTPException
 
 import server.constants as constants
 
-from .utils import ComposeHelper, DeploymentConfig, NginxHelper, SecretsHelper
+from .admission import get_admission_controller
+from .fingerprint import DeploymentFingerprint, FingerprintStore, compute_fingerprint
+from .metrics import DEPLOYMENT_LOCK_WAIT_SECONDS, current_phase_durations, track_phase
+from .state import get_deployment_store
+from .utils import (
+    ComposeHelper,
+    DeploymentConfig,
+    GitMirrorHelper,
+    NginxHelper,
+    SecretsHelper,
+    is_direct_routing,
+    strip_credentials,
+)
 
 logger = logging.getLogger(__name__)
 
 
+class DeploymentCancelled(Exception):
+    pass
+
+
 class Deployer:
-    def __init__(self, config: DeploymentConfig):
+    def __init__(self, config: DeploymentConfig, cancel_event: threading.Event = None):
+        self._init_state(config, cancel_event)
+
+        with self._locked():
+            if config.rest_action != constants.DELETE:
+                self._raise_if_cancelled()
+                with track_phase("clone"):
+                    self._setup_project()
+            self._create_helpers(ComposeHelper, SecretsHelper, NginxHelper)
+
+    def _init_state(self, config: DeploymentConfig, cancel_event: threading.Event):
         self._config = config
+        self._cancel_event = cancel_event
         self._DEPLOYMENTS_MOUNT_DIR: typing.Final[str] = os.environ.get(
             "DEPLOYMENTS_MOUNT_DIR"
         )
-        self._deployment_namespace = f"{self._config.project_name}_{self._config.branch_name}_{config.get_project_hash()}"
+        self._deployment_namespace = config.get_deployment_namespace()
         self._lock_file_path = os.path.join(
             os.environ.get("LOCK_FILE_BASE_PATH") or "/tmp",
             f"{self._deployment_namespace}.lock",
@@ -29,35 +59,84 @@ class Deployer:
         self._project_path: typing.Final[str] = os.path.join(
             self._DEPLOYMENTS_MOUNT_DIR, self._deployment_namespace
         )
+        self._git_sync_mode = (
+            os.environ.get("GIT_SYNC_MODE") or constants.GIT_SYNC_FETCH
+        ).lower()
+        self._mirror_helper = GitMirrorHelper(config, self._DEPLOYMENTS_MOUNT_DIR)
+        self._fingerprints = FingerprintStore(
+            os.path.join(
+                self._DEPLOYMENTS_MOUNT_DIR or "/tmp",
+                constants.SARTHI_STATE_DIR,
+                constants.FINGERPRINTS_DIR,
+            )
+        )
+        self._outer_proxy_conf_location = (
+            os.environ.get("NGINX_PROXY_CONF_LOCATION") or "/etc/nginx/conf.d"
+        )
+        self._direct_routing = is_direct_routing()
+
+    def _create_helpers(
+        self,
+        compose_helper_class: typing.Type[ComposeHelper],
+        secrets_helper_class: typing.Type[SecretsHelper],
+        nginx_helper_class: typing.Type[NginxHelper],
+    ):
+        with track_phase("compose_parse"):
+            self._compose_helper = compose_helper_class(
+                os.path.join(self._project_path, self._config.compose_file_location),
+                self._config.rest_action != constants.DELETE,
+            )
+        self._secrets_helper = secrets_helper_class(
+            self._config.project_name, self._config.branch_name, self._project_path
+        )
+        self._nginx_helper = nginx_helper_class(
+            self._config, self._outer_proxy_conf_location, self._project_path
+        )
 
+    @contextlib.contextmanager
+    def _locked(self):
+        start = time.perf_counter()
         with self._lock:
-            if config.rest_action != constants.DELETE:
-                self._setup_project()
+            DEPLOYMENT_LOCK_WAIT_SECONDS.observe(time.perf_counter() - start)
+            yield
 
-            self._compose_helper = ComposeHelper(
-                os.path.join(self._project_path, config.compose_file_location),
-                config.rest_action != constants.DELETE,
-            )
-            self._secrets_helper = SecretsHelper(
-                self._config.project_name, self._config.branch_name, self._project_path
-            )
-            self._outer_proxy_conf_location = (
-                os.environ.get("NGINX_PROXY_CONF_LOCATION") or "/etc/nginx/conf.d"
-            )
-            self._nginx_helper = NginxHelper(
-                config, self._outer_proxy_conf_location, self._project_path
+    def _raise_if_cancelled(self):
+        # Only called at steps where stopping leaves the deployment in a consistent state
+        if self._cancel_event and self._cancel_event.is_set():
+            logger.info(f"Deployment of {self._deployment_namespace} was cancelled")
+            raise DeploymentCancelled(
+                f"Deployment of {self._deployment_namespace} was cancelled by a newer request"
             )
 
+    @property
+    def _use_mirror(self) -> bool:
+        return self._git_sync_mode == constants.GIT_SYNC_MIRROR
+
+    @property
+    def _remote_url(self) -> str:
+        if self._use_mirror:
+            return self._mirror_helper.mirror_path
+        return self._config.project_git_url
+
+    def _clone_command(self) -> typing.List[str]:
+        command = ["git", "clone", "-b", self._config.branch_name_raw]
+        if self._use_mirror:
+            # Borrow objects from the project mirror instead of copying them
+            command.append("--shared")
+        return [*command, self._remote_url, self._project_path]
+
+    def _fetch_commands(self) -> typing.List[typing.List[str]]:
+        return [
+            # The remote URL embeds the GitHub token, which can change between requests
+            ["remote", "set-url", "origin", self._remote_url],
+            ["fetch", "--depth", "1", "origin", self._config.branch_name_raw],
+            ["reset", "--hard", "FETCH_HEAD"],
+            ["clean", "-ffdx"],
+        ]
+
     def _clone_project(self):
         process = subprocess.Popen(
-            [
-                "git",
-                "clone",
-                "-b",
-                self._config.branch_name_raw,
-                self._config.project_git_url,
-                self._project_path,
-            ],
+            self._clone_command(),
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
         )
@@ -74,37 +153,147 @@ class Deployer:
             logger.error(f"Standard Error: {stderr.decode()}")
             raise HTTPException(
                 500,
-                f"Cloning the Git repo failed {self._config.project_git_url}:{self._config.branch_name} {stderr.decode()}",
+                strip_credentials(
+                    f"Cloning the Git repo failed {self._config.project_git_url}:{self._config.branch_name} {stderr.decode()}"
+                ),
+            )
+
+    def _run_git_command(self, *args: str) -> str:
+        return subprocess.run(
+            ["git", *args],
+            check=True,
+            capture_output=True,
+            cwd=self._project_path,
+        ).stdout.decode()
+
+    def _fetch_project(self) -> bool:
+        """
+        Bring an existing checkout to the tip of the branch with a shallow fetch and a hard reset.
+        Files which did not change keep their mtimes, so docker build caches stay warm.
+        Returns False if the checkout could not be synced and has to be cloned again.
+        """
+        if not os.path.isdir(os.path.join(self._project_path, ".git")):
+            return False
+        try:
+            for args in self._fetch_commands():
+                self._run_git_command(*args)
+        except subprocess.CalledProcessError as e:
+            stderr = e.stderr.decode() if e.stderr else ""
+            logger.warning(
+                f"Git fetch failed for {self._project_path}, cloning again: {stderr}"
             )
+            return False
+        logger.info(f"Git fetch successful for {self._project_path}")
+        return True
 
     def _setup_project(self):
+        if self._use_mirror:
+            self._mirror_helper.sync(self._config.branch_name_raw)
+        if self._git_sync_mode != constants.GIT_SYNC_CLONE and self._fetch_project():
+            return
         if os.path.exists(self._project_path):
             # TODO: Run docker compose down -v
             logger.debug(f"Removing older project path {self._project_path}")
             shutil.rmtree(self._project_path)
         self._clone_project()
 
+    def _allocate_port(self) -> typing.Optional[str]:
+        if self._direct_routing:
+            # The outer nginx reaches the services over their network, nothing is published
+            self._nginx_helper.release_port()
+            return None
+        return self._nginx_helper.find_free_port()
+
     def _configure_outer_proxy(self):
-        if not self._project_nginx_port:
+        if not self._project_nginx_port and not self._direct_routing:
             logger.error("Project Proxy not deployed, project_nginx_port is None")
             raise HTTPException(
                 "Project Proxy not deployed, project_nginx_port is None"
             )
         self._nginx_helper.generate_outer_proxy_conf_file(self._project_nginx_port)
-        self._nginx_helper.reload_nginx()
+        self._nginx_helper.reload_nginx(new_outer_proxy=True)
+
+    def _fingerprint(
+        self, commit_sha: str, conf_file_path: str, urls: typing.List[str]
+    ) -> DeploymentFingerprint:
+        return compute_fingerprint(
+            commit_sha,
+            os.path.join(self._project_path, self._config.compose_file_location),
+            conf_file_path,
+            os.path.join(self._project_path, ".env"),
+            urls,
+        )
 
-    def _deploy_project(self):
+    def _redeploy_mode(
+        self, fingerprint: DeploymentFingerprint, is_running: typing.Callable[[], bool]
+    ) -> str:
+        """
+        Compare with the last successful deploy: nothing to do if nothing changed and the
+        stack is up, only recreate the containers if nothing but the secrets changed.
+        """
+        previous = self._fingerprints.get(self._deployment_namespace)
+        if (
+            self._config.force_rebuild
+            or not previous
+            or previous.build != fingerprint.build
+            or not is_running()
+        ):
+            return constants.DEPLOY_BUILD
+        if previous.env != fingerprint.env:
+            logger.info(f"Only secrets of {self._deployment_namespace} changed")
+            return constants.DEPLOY_RECREATE
+        logger.info(f"{self._deployment_namespace} is unchanged, skipping the deploy")
+        return constants.DEPLOY_UNCHANGED
+
+    def _deploy_project(self) -> str:
         services = self._compose_helper.get_service_ports_config()
         conf_file_path, urls = self._nginx_helper.generate_project_proxy_conf_file(
-            services
+            services, self._compose_helper.get_service_proxy_settings()
         )
-        # TODO: Keep retrying finding a new port for race conditions
-        self._project_nginx_port = self._nginx_helper.find_free_port()
+        with track_phase("port_alloc"):
+            self._project_nginx_port = self._allocate_port()
         self._secrets_helper.inject_env_variables(self._project_path)
-        self._compose_helper.start_services(
+        self._compose_helper.prepare_services(
             self._project_nginx_port, conf_file_path, self._deployment_namespace
         )
-        return urls
+        self._commit_sha = self._run_git_command("rev-parse", "HEAD").strip()
+        self._deploy_fingerprint = self._fingerprint(
+            self._commit_sha, conf_file_path, urls
+        )
+        mode = self._redeploy_mode(
+            self._deploy_fingerprint, self._compose_helper.is_running
+        )
+        if mode == constants.DEPLOY_UNCHANGED:
+            return mode
+        if mode == constants.DEPLOY_RECREATE:
+            with track_phase("compose_up"):
+                self._compose_helper.start_services(
+                    self._project_nginx_port,
+                    conf_file_path,
+                    self._deployment_namespace,
+                    build=False,
+                )
+            return mode
+
+        with get_admission_controller().build_slot(self._deployment_namespace):
+            # The deploy may have been superseded while it waited for a build slot
+            self._raise_if_cancelled()
+            with track_phase("compose_up"):
+                self._compose_helper.start_services(
+                    self._project_nginx_port,
+                    conf_file_path,
+                    self._deployment_namespace,
+                )
+        return mode
+
+    def _record_deployed(self):
+        get_deployment_store().record_deployed(
+            self._deployment_namespace,
+            self._commit_sha,
+            self._project_nginx_port,
+            self._deploy_fingerprint.urls,
+            current_phase_durations(),
+        )
 
     def _delete_deployment_files(self):
         if not os.path.exists(self._project_path):
@@ -116,15 +305,123 @@ class Deployer:
             logger.debug(f"Error removing deployment files {e}")
 
     def deploy_preview_environment(self):
-        with self._lock:
-            urls = self._deploy_project()
-            self._configure_outer_proxy()
-        return urls
+        with self._locked():
+            self._raise_if_cancelled()
+            # An unchanged stack which is running is already routed to
+            if self._deploy_project() != constants.DEPLOY_UNCHANGED:
+                with track_phase("outer_proxy"):
+                    self._configure_outer_proxy()
+                self._fingerprints.save(
+                    self._deployment_namespace, self._deploy_fingerprint
+                )
+            self._record_deployed()
+        return self._deploy_fingerprint.urls
 
-    def delete_preview_environment(self):
-        with self._lock:
+    def reload_nginx(self):
+        self._nginx_helper.reload_nginx()
+
+    def delete_preview_environment(self, reload_nginx: bool = True):
+        """
+        With reload_nginx=False the outer proxy conf is removed but nginx is not reloaded,
+        for callers tearing down many deployments that reload once at the end.
+        """
+        with self._locked(), track_phase("delete"):
             self._compose_helper.remove_services()
-            self._nginx_helper.remove_outer_proxy()
-            self._nginx_helper.reload_nginx()
-            self._delete_deployment_files()
+            self._compose_helper.remove_images(self._deployment_namespace)
+            self._remove_deployment(reload_nginx)
             self._secrets_helper.cleanup_deployment_variables()
+
+    def _remove_deployment(self, reload_nginx: bool):
+        # Everything a deployment leaves behind apart from its compose stack and its secrets
+        self._nginx_helper.remove_outer_proxy()
+        if reload_nginx:
+            self._nginx_helper.reload_nginx()
+        self._nginx_helper.release_port()
+        self._delete_deployment_files()
+        self._mirror_helper.release(self._config.branch_name_raw)
+        self._fingerprints.remove(self._deployment_namespace)
+        get_deployment_store().remove(self._deployment_namespace)
+
+    def delete_if_stackless(self, has_stack: typing.Callable[[], bool]) -> bool:
+        """
+        Delete a checkout which has no compose stack, like one left by a crash in the middle of
+        its first deploy. has_stack is checked again under the lock, a deploy may have just finished.
+        nginx is not reloaded and the secrets of the branch are kept. Failed deploys are kept so
+        the failure can be looked at, a redeploy or DELETE cleans them up.
+        """
+        with self._locked():
+            if has_stack():
+                return False
+            deployment = get_deployment_store().get(self._deployment_namespace)
+            if deployment and deployment["status"] == constants.DEPLOYMENT_FAILED:
+                return False
+            logger.info(f"Removing {self._deployment_namespace}, it has no stack")
+            with track_phase("delete"):
+                self._remove_deployment(reload_nginx=False)
+        return True
+
+    def repair_outer_proxy(self) -> bool:
+        """
+        Point the outer proxy conf at the port reserved for the deployment again, if it is
+        missing or routes to another port. In direct routing mode a missing route is written
+        again. nginx is not reloaded.
+        """
+        with self._locked():
+            if self._nginx_helper.is_hibernated():
+                return False
+            if self._direct_routing:
+                return self._repair_direct_route()
+            port = self._nginx_helper.reserved_port()
+            if not port or self._nginx_helper.outer_proxy_port() == port:
+                return False
+            logger.info(
+                f"Pointing the outer proxy of {self._deployment_namespace} at port {port}"
+            )
+            self._nginx_helper.generate_outer_proxy_conf_file(port)
+        return True
+
+    def _repair_direct_route(self) -> bool:
+        if self._nginx_helper.has_route():
+            return False
+        logger.info(f"Routing {self._deployment_namespace} to its services again")
+        self._nginx_helper.generate_outer_proxy_conf_file()
+        return True
+
+    def hibernate_preview_environment(self, idle_seconds: float) -> bool:
+        """
+        Stop the stack and route its domains to the wake endpoint if nobody accessed it
+        for idle_seconds. Idleness is checked again under the lock, a deploy may have just finished.
+        """
+        with self._locked():
+            if self._nginx_helper.is_hibernated():
+                return False
+            last_access = self._nginx_helper.last_access()
+            if last_access is None or time.time() - last_access < idle_seconds:
+                return False
+            with track_phase("hibernate"):
+                logger.info(f"Hibernating idle deployment {self._deployment_namespace}")
+                self._compose_helper.stop_services()
+                self._nginx_helper.generate_wake_proxy_conf_file()
+                self._nginx_helper.reload_nginx(new_outer_proxy=True)
+            get_deployment_store().set_status(
+                self._deployment_namespace, constants.DEPLOYMENT_HIBERNATED
+            )
+        return True
+
+    def wake_preview_environment(self, timeout_seconds: float):
+        with self._locked():
+            if not self._nginx_helper.is_hibernated():
+                return
+            with track_phase("wake"):
+                logger.info(f"Waking up deployment {self._deployment_namespace}")
+                self._compose_helper.resume_services()
+                port = None
+                if not self._direct_routing:
+                    # The namespace keeps its reserved port, this only looks it up
+                    port = self._nginx_helper.find_free_port()
+                    self._nginx_helper.wait_for_port(port, timeout_seconds)
+                self._nginx_helper.generate_outer_proxy_conf_file(port)
+                self._nginx_helper.reload_nginx(new_outer_proxy=True)
+            get_deployment_store().set_status(
+                self._deployment_namespace, constants.DEPLOYMENT_RUNNING
+            )
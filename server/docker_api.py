@@ -0,0 +1,217 @@
+import http.client
+import json
+import logging
+import os
+import queue
+import socket
+import struct
+import threading
+import typing
+import urllib.parse
+
+import server.constants as constants
+
+logger = logging.getLogger(__name__)
+
+
+class DockerEngineError(Exception):
+    pass
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path: str, timeout: float):
+        super().__init__("localhost", timeout=timeout)
+        self._socket_path = socket_path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self._socket_path)
+        self.sock = sock
+
+
+class DockerEngineClient:
+    """
+    Minimal Docker Engine API client talking HTTP over the docker unix socket.
+    Connections are kept alive and pooled, so a call costs one round trip instead of
+    spawning and initialising the docker CLI.
+    """
+
+    def __init__(
+        self,
+        socket_path: str = constants.DEFAULT_DOCKER_SOCKET_PATH,
+        timeout: float = constants.DEFAULT_DOCKER_API_TIMEOUT_SECONDS,
+        pool_size: int = constants.DEFAULT_DOCKER_API_POOL_SIZE,
+    ):
+        self._socket_path = socket_path
+        self._timeout = timeout
+        self._pool: "queue.LifoQueue[UnixHTTPConnection]" = queue.LifoQueue(
+            maxsize=pool_size
+        )
+
+    def _get_connection(self) -> UnixHTTPConnection:
+        try:
+            return self._pool.get_nowait()
+        except queue.Empty:
+            return UnixHTTPConnection(self._socket_path, self._timeout)
+
+    def _put_connection(self, connection: UnixHTTPConnection):
+        try:
+            self._pool.put_nowait(connection)
+        except queue.Full:
+            connection.close()
+
+    def _request(
+        self, method: str, path: str, body: typing.Dict = None
+    ) -> typing.Tuple[int, bytes]:
+        payload = json.dumps(body).encode() if body is not None else None
+        headers = {"Content-Type": "application/json"} if payload else {}
+
+        # A pooled connection may have been closed by the daemon, retry once on a new one
+        for attempt in range(2):
+            connection = self._get_connection()
+            try:
+                connection.request(method, path, body=payload, headers=headers)
+                response = connection.getresponse()
+                data = response.read()
+            except (http.client.HTTPException, ConnectionError) as e:
+                connection.close()
+                if attempt:
+                    raise DockerEngineError(f"{method} {path} failed: {e}")
+                continue
+            except OSError as e:
+                connection.close()
+                raise DockerEngineError(f"{method} {path} failed: {e}")
+
+            if response.will_close:
+                connection.close()
+            else:
+                self._put_connection(connection)
+            return response.status, data
+
+    def _request_json(self, method: str, path: str, body: typing.Dict = None):
+        status, data = self._request(method, path, body)
+        if status >= 400:
+            raise DockerEngineError(
+                f"{method} {path} failed with {status}: {data.decode(errors='replace')}"
+            )
+        return json.loads(data) if data else None
+
+    @staticmethod
+    def _demultiplex(data: bytes) -> str:
+        """
+        Exec output without a TTY is framed as [stream, 0, 0, 0, size (4 bytes)] + payload.
+        """
+        output = []
+        offset = 0
+        while offset + 8 <= len(data):
+            _, size = struct.unpack_from(">BxxxL", data, offset)
+            end = offset + 8 + size
+            output.append(data[offset + 8 : end])  # noqa: E203
+            offset = end
+        return b"".join(output).decode(errors="replace")
+
+    def exec_run(
+        self, container: str, command: typing.List[str]
+    ) -> typing.Tuple[int, str]:
+        """
+        Run a command in a running container and return its exit code and combined output.
+        """
+        exec_instance = self._request_json(
+            "POST",
+            f"/containers/{container}/exec",
+            {"Cmd": command, "AttachStdout": True, "AttachStderr": True},
+        )
+        status, data = self._request(
+            "POST",
+            f"/exec/{exec_instance['Id']}/start",
+            {"Detach": False, "Tty": False},
+        )
+        if status >= 400:
+            raise DockerEngineError(
+                f"Starting {command} in {container} failed with {status}: {data.decode(errors='replace')}"
+            )
+        exec_state = self._request_json("GET", f"/exec/{exec_instance['Id']}/json")
+        return exec_state["ExitCode"], self._demultiplex(data)
+
+    def list_containers(
+        self, labels: typing.List[str] = None, all_containers: bool = True
+    ) -> typing.List[typing.Dict]:
+        query = {"all": "true" if all_containers else "false"}
+        if labels:
+            query["filters"] = json.dumps({"label": labels})
+        return self._request_json(
+            "GET", f"/containers/json?{urllib.parse.urlencode(query)}"
+        )
+
+    def list_images(
+        self, labels: typing.List[str] = None, dangling: bool = None
+    ) -> typing.List[typing.Dict]:
+        filters = {}
+        if labels:
+            filters["label"] = labels
+        if dangling is not None:
+            filters["dangling"] = ["true" if dangling else "false"]
+        query = {"filters": json.dumps(filters)} if filters else {}
+        return self._request_json(
+            "GET", f"/images/json?{urllib.parse.urlencode(query)}"
+        )
+
+    def tag_image(self, image: str, repository: str, tag: str):
+        query = urllib.parse.urlencode({"repo": repository, "tag": tag})
+        self._request_json("POST", f"/images/{image}/tag?{query}")
+
+    def remove_image(self, image: str):
+        """
+        Remove an image by id, or drop one of its tags if it has others.
+        """
+        self._request_json("DELETE", f"/images/{image}")
+
+    def list_networks(
+        self, labels: typing.List[str] = None
+    ) -> typing.List[typing.Dict]:
+        query = {"filters": json.dumps({"label": labels})} if labels else {}
+        return self._request_json("GET", f"/networks?{urllib.parse.urlencode(query)}")
+
+    def connect_network(self, network: str, container: str):
+        status, data = self._request(
+            "POST", f"/networks/{network}/connect", {"Container": container}
+        )
+        # Connecting a container twice is refused, it is connected either way
+        if status >= 400 and b"already exists" not in data:
+            raise DockerEngineError(
+                f"Connecting {container} to {network} failed with {status}: {data.decode(errors='replace')}"
+            )
+
+    def disconnect_network(self, network: str, container: str):
+        self._request_json(
+            "POST",
+            f"/networks/{network}/disconnect",
+            {"Container": container, "Force": True},
+        )
+
+    def close(self):
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+_docker_client: typing.Optional[DockerEngineClient] = None
+_docker_client_lock = threading.Lock()
+
+
+def get_docker_client() -> DockerEngineClient:
+    global _docker_client
+    with _docker_client_lock:
+        if _docker_client is None:
+            _docker_client = DockerEngineClient(
+                socket_path=os.environ.get("DOCKER_SOCKET_PATH")
+                or constants.DEFAULT_DOCKER_SOCKET_PATH,
+                timeout=float(
+                    os.environ.get("DOCKER_API_TIMEOUT_SECONDS")
+                    or constants.DEFAULT_DOCKER_API_TIMEOUT_SECONDS
+                ),
+            )
+        return _docker_client
@@ -0,0 +1,93 @@
+import hashlib
+import json
+import logging
+import os
+import typing
+from dataclasses import asdict, dataclass
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class DeploymentFingerprint:
+    # Hash of everything that goes into the images and containers except the secrets
+    build: str
+    # Hash of the injected .env, secrets only need the containers to be recreated
+    env: str
+    urls: typing.List[str]
+
+
+def _hash_file(digest, path: str):
+    try:
+        with open(path, "rb") as file:
+            digest.update(file.read())
+    except FileNotFoundError:
+        digest.update(b"\0missing")
+
+
+def compute_fingerprint(
+    commit_sha: str,
+    compose_file_path: str,
+    proxy_conf_path: str,
+    env_file_path: str,
+    urls: typing.List[str],
+) -> DeploymentFingerprint:
+    """
+    Fingerprint a deployment from its commit, its processed compose file, its project proxy
+    conf and its .env file.
+    """
+    build_digest = hashlib.sha256(commit_sha.encode())
+    for path in [compose_file_path, proxy_conf_path]:
+        build_digest.update(b"\0")
+        _hash_file(build_digest, path)
+    env_digest = hashlib.sha256()
+    _hash_file(env_digest, env_file_path)
+    return DeploymentFingerprint(
+        build=build_digest.hexdigest(), env=env_digest.hexdigest(), urls=urls
+    )
+
+
+class FingerprintStore:
+    """
+    Fingerprint of the last successful deploy of every namespace, one file per namespace.
+    Callers hold the namespace's deployment lock, so no locking is done here.
+    """
+
+    def __init__(self, fingerprints_dir: str):
+        self._fingerprints_dir = fingerprints_dir
+
+    def _path(self, namespace: str) -> str:
+        return os.path.join(self._fingerprints_dir, f"{namespace}.json")
+
+    def get(self, namespace: str) -> typing.Optional[DeploymentFingerprint]:
+        try:
+            with open(self._path(namespace)) as file:
+                return DeploymentFingerprint(**json.load(file))
+        except FileNotFoundError:
+            return None
+        except (json.JSONDecodeError, TypeError) as e:
+            logger.warning(f"Ignoring corrupt fingerprint of {namespace}: {e}")
+            return None
+
+    def save(self, namespace: str, fingerprint: DeploymentFingerprint):
+        os.makedirs(self._fingerprints_dir, exist_ok=True)
+        path = self._path(namespace)
+        temp_path = f"{path}.tmp"
+        with open(temp_path, "w") as file:
+            json.dump(asdict(fingerprint), file)
+        os.replace(temp_path, path)
+
+    def namespaces(self) -> typing.List[str]:
+        if not os.path.isdir(self._fingerprints_dir):
+            return []
+        return [
+            name[: -len(".json")]  # noqa: E203
+            for name in os.listdir(self._fingerprints_dir)
+            if name.endswith(".json")
+        ]
+
+    def remove(self, namespace: str):
+        try:
+            os.remove(self._path(namespace))
+        except FileNotFoundError:
+            pass
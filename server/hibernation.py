@@ -0,0 +1,112 @@
+import logging
+import threading
+import typing
+from concurrent.futures import ThreadPoolExecutor
+
+from fastapi import HTTPException
+
+import server.constants as constants
+
+from .deployer import Deployer
+from .utils import get_deployment_config, list_deployment_namespaces
+
+logger = logging.getLogger(__name__)
+
+
+class HibernationManager:
+    """
+    Stops the compose stacks of deployments nobody accessed for idle_seconds and starts them
+    again when a request hits the wake endpoint their outer proxy conf is switched to.
+
+    Namespaces for which is_busy returns True, like the ones with queued or running jobs,
+    are not hibernated.
+    """
+
+    def __init__(
+        self,
+        deployments_mount_dir: str,
+        idle_seconds: float,
+        check_interval_seconds: float = constants.DEFAULT_HIBERNATION_CHECK_SECONDS,
+        wake_timeout_seconds: float = constants.DEFAULT_WAKE_TIMEOUT_SECONDS,
+        is_busy: typing.Callable[[str], bool] = None,
+    ):
+        self._deployments_mount_dir = deployments_mount_dir
+        self._idle_seconds = idle_seconds
+        self._check_interval_seconds = check_interval_seconds
+        self._wake_timeout_seconds = wake_timeout_seconds
+        self._is_busy = is_busy or (lambda namespace: False)
+        self._wake_executor = ThreadPoolExecutor(
+            max_workers=constants.WAKE_WORKERS, thread_name_prefix="sarthi-wake"
+        )
+        self._waking: typing.Set[str] = set()
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread: typing.Optional[threading.Thread] = None
+
+    @property
+    def enabled(self) -> bool:
+        return self._idle_seconds > 0
+
+    def start(self):
+        if not self.enabled or self._thread:
+            return
+        self._thread = threading.Thread(
+            target=self._run, name="sarthi-hibernation", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        self._wake_executor.shutdown(wait=False, cancel_futures=True)
+
+    def _run(self):
+        while not self._stop_event.wait(self._check_interval_seconds):
+            try:
+                self.hibernate_idle_deployments()
+            except Exception as e:
+                logger.exception(f"Error hibernating idle deployments: {e}")
+
+    def hibernate_idle_deployments(self) -> typing.List[str]:
+        hibernated = []
+        for namespace in list_deployment_namespaces(self._deployments_mount_dir):
+            if self._stop_event.is_set():
+                break
+            # A deploy holds the deployment lock for its whole build
+            if self._is_busy(namespace):
+                continue
+            config = get_deployment_config(self._deployments_mount_dir, namespace)
+            if not config:
+                continue
+            try:
+                if Deployer(config).hibernate_preview_environment(self._idle_seconds):
+                    hibernated.append(namespace)
+            except HTTPException as e:
+                logger.error(f"Error hibernating {namespace}: {e.detail}")
+        return hibernated
+
+    def _wake(self, namespace: str, config):
+        try:
+            Deployer(config).wake_preview_environment(self._wake_timeout_seconds)
+        except HTTPException as e:
+            logger.error(f"Error waking up {namespace}: {e.detail}")
+        except Exception as e:
+            logger.exception(f"Error waking up {namespace}: {e}")
+        finally:
+            with self._lock:
+                self._waking.discard(namespace)
+
+    def wake(self, namespace: str) -> bool:
+        """
+        Start waking the deployment up in the background, returns False for unknown namespaces.
+        Requests arriving while it is already being woken up don't start another wake up.
+        """
+        config = get_deployment_config(self._deployments_mount_dir, namespace)
+        if not config:
+            return False
+        with self._lock:
+            if namespace in self._waking:
+                return True
+            self._waking.add(namespace)
+        logger.info(f"Wake up of {namespace} requested")
+        self._wake_executor.submit(self._wake, namespace, config)
+        return True
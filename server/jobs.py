@@ -0,0 +1,306 @@
+import asyncio
+import collections
+import contextlib
+import logging
+import sqlite3
+import threading
+import time
+import typing
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+
+from fastapi import HTTPException
+
+import server.constants as constants
+
+from .admission import get_admission_controller
+from .async_deployer import AsyncDeployer
+from .deployer import Deployer, DeploymentCancelled
+from .metrics import (
+    DEPLOYMENT_JOBS,
+    DEPLOYMENT_JOBS_QUEUED,
+    DEPLOYMENTS_IN_PROGRESS,
+    collect_phase_durations,
+)
+from .state import get_deployment_store
+from .utils import DeploymentConfig, strip_credentials
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class DeploymentJob:
+    config: DeploymentConfig
+    id: str = field(default_factory=lambda: uuid.uuid4().hex)
+    status: str = constants.JOB_QUEUED
+    created_at: float = field(default_factory=time.time)
+    started_at: typing.Optional[float] = None
+    finished_at: typing.Optional[float] = None
+    result: typing.Optional[typing.Dict] = None
+    error: typing.Optional[str] = None
+    superseded_by: typing.Optional[str] = None
+    cancel_event: threading.Event = field(default_factory=threading.Event)
+
+    @property
+    def namespace(self) -> str:
+        return self.config.get_deployment_namespace()
+
+    def to_dict(self) -> typing.Dict:
+        queued_until = self.started_at or self.finished_at or time.time()
+        return {
+            "id": self.id,
+            "action": self.config.rest_action,
+            "project": self.config.project_name,
+            "branch": self.config.branch_name,
+            "namespace": self.namespace,
+            "status": self.status,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "queued_seconds": queued_until - self.created_at,
+            "run_seconds": (self.finished_at or time.time()) - self.started_at
+            if self.started_at
+            else None,
+            "result": self.result,
+            "error": self.error,
+            "superseded_by": self.superseded_by,
+            # Needs the same bearer token as the other /deployments endpoints
+            "logs_url": f"/deployments/{self.namespace}/logs",
+        }
+
+
+class DeploymentQueue:
+    """
+    Runs deployment jobs on a bounded pool of worker threads so that the event loop
+    only has to enqueue a job and can answer other requests while it is being built.
+
+    Jobs for the same deployment namespace run one at a time, in the order they were
+    submitted. They are also coalesced: a newer request supersedes deploys of that namespace
+    which are still waiting in the queue, and can optionally cancel a deploy which is already
+    running.
+    """
+
+    def __init__(
+        self,
+        max_workers: int = constants.DEFAULT_DEPLOYMENT_WORKERS,
+        history_size: int = constants.DEFAULT_JOB_HISTORY_SIZE,
+        cancel_running: bool = False,
+    ):
+        self._history_size = history_size
+        self._cancel_running = cancel_running
+        self._jobs: typing.OrderedDict[str, DeploymentJob] = collections.OrderedDict()
+        # namespace -> jobs which are queued or running for it, only the first one is scheduled
+        self._active_jobs: typing.Dict[
+            str, typing.List[DeploymentJob]
+        ] = collections.defaultdict(list)
+        self._lock = threading.Lock()
+        self._closed = False
+        self._start_workers(max_workers)
+
+    def _start_workers(self, max_workers: int):
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="sarthi-deployer"
+        )
+
+    def _schedule(self, job: DeploymentJob):
+        self._executor.submit(self._run, job)
+
+    def submit(self, config: DeploymentConfig) -> DeploymentJob:
+        job = DeploymentJob(config=config)
+        with self._lock:
+            if config.rest_action == constants.POST:
+                get_admission_controller().check_new_deployment(
+                    config,
+                    [
+                        namespace
+                        for namespace, jobs in self._active_jobs.items()
+                        if any(
+                            active_job.config.rest_action == constants.POST
+                            for active_job in jobs
+                        )
+                    ],
+                )
+            self._supersede_deploys(job)
+            self._jobs[job.id] = job
+            active_jobs = self._active_jobs[job.namespace]
+            active_jobs.append(job)
+            # Later jobs of the namespace are scheduled by _finish when this one is done
+            runnable = len(active_jobs) == 1
+            self._evict_finished_jobs()
+        DEPLOYMENT_JOBS_QUEUED.inc()
+        if runnable:
+            self._schedule(job)
+        logger.info(f"Queued {config.rest_action} job {job.id} for {job.namespace}")
+        return job
+
+    def get(self, job_id: str) -> typing.Optional[DeploymentJob]:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def is_active(self, namespace: str) -> bool:
+        with self._lock:
+            return namespace in self._active_jobs
+
+    def queue_position(self, job: DeploymentJob) -> typing.Optional[int]:
+        """
+        1-based position of a queued job among the jobs waiting for a worker.
+        """
+        with self._lock:
+            if job.status != constants.JOB_QUEUED:
+                return None
+            position = 1
+            for queued_job in self._jobs.values():
+                if queued_job is job:
+                    return position
+                if queued_job.status == constants.JOB_QUEUED:
+                    position += 1
+            return None
+
+    def shutdown(self, wait: bool = True):
+        self._closed = True
+        self._executor.shutdown(wait=wait, cancel_futures=not wait)
+
+    def _supersede_deploys(self, newer_job: DeploymentJob):
+        # Pending deletes are never dropped, tearing down has to happen in order
+        for job in self._active_jobs.get(newer_job.namespace, []):
+            if job.config.rest_action != constants.POST:
+                continue
+            if job.status == constants.JOB_QUEUED:
+                logger.info(f"Job {job.id} superseded by {newer_job.id}")
+                job.status = constants.JOB_SUPERSEDED
+                job.superseded_by = newer_job.id
+                job.finished_at = time.time()
+            elif job.status == constants.JOB_RUNNING and self._cancel_running:
+                logger.info(
+                    f"Cancelling running job {job.id} in favour of {newer_job.id}"
+                )
+                job.superseded_by = newer_job.id
+                job.cancel_event.set()
+
+    def _finish(self, job: DeploymentJob):
+        job.finished_at = job.finished_at or time.time()
+        DEPLOYMENT_JOBS.labels(job.config.rest_action, job.status).inc()
+        with self._lock:
+            active_jobs = self._active_jobs[job.namespace]
+            active_jobs.remove(job)
+            next_job = active_jobs[0] if active_jobs else None
+            if not active_jobs:
+                del self._active_jobs[job.namespace]
+        # Jobs left behind by a shutdown stay queued
+        if next_job and not self._closed:
+            self._schedule(next_job)
+
+    def _evict_finished_jobs(self):
+        # Only forget jobs that are done, clients may still be polling running ones
+        for job_id in list(self._jobs.keys()):
+            if len(self._jobs) <= self._history_size:
+                break
+            if self._jobs[job_id].status in constants.JOB_FINISHED_STATES:
+                del self._jobs[job_id]
+
+    def _execute(self, job: DeploymentJob) -> typing.Dict:
+        deployer = Deployer(job.config, job.cancel_event)
+        if job.config.rest_action == constants.DELETE:
+            deployer.delete_preview_environment()
+            return {"message": "Removed preview environment"}
+        return {"urls": deployer.deploy_preview_environment()}
+
+    def _start(self, job: DeploymentJob) -> bool:
+        """
+        Mark a job which got a worker as running, returns False if it was superseded while queued.
+        """
+        DEPLOYMENT_JOBS_QUEUED.dec()
+        with self._lock:
+            superseded = job.status == constants.JOB_SUPERSEDED
+            if not superseded:
+                job.status = constants.JOB_RUNNING
+                job.started_at = time.time()
+        if superseded:
+            self._finish(job)
+            return False
+        return True
+
+    @contextlib.contextmanager
+    def _track_result(self, job: DeploymentJob):
+        logger.info(
+            f"Running {job.config.rest_action} job {job.id} for {job.namespace}"
+        )
+        in_progress = DEPLOYMENTS_IN_PROGRESS.labels(job.config.rest_action)
+        in_progress.inc()
+        try:
+            with collect_phase_durations():
+                if job.config.rest_action == constants.POST:
+                    get_deployment_store().record_deploy_started(job.config)
+                yield
+            job.status = constants.JOB_SUCCEEDED
+        except DeploymentCancelled as e:
+            job.error = str(e)
+            job.status = constants.JOB_CANCELLED
+        except HTTPException as e:
+            logger.error(f"Job {job.id} for {job.namespace} failed: {e.detail}")
+            self._fail(job, str(e.detail))
+        except Exception as e:
+            logger.exception(f"Job {job.id} for {job.namespace} failed: {e}")
+            self._fail(job, str(e))
+        finally:
+            in_progress.dec()
+            self._finish(job)
+
+    @staticmethod
+    def _fail(job: DeploymentJob, error: str):
+        # Recorded before the status changes, so clients polling the job see the stored failure
+        if job.config.rest_action == constants.POST:
+            try:
+                get_deployment_store().record_deploy_failed(job.namespace, error)
+            except sqlite3.Error as e:
+                logger.error(f"Cannot record the failure of {job.namespace}: {e}")
+        # Git errors can hold the clone URL with the GitHub token
+        job.error = strip_credentials(error)
+        job.status = constants.JOB_FAILED
+
+    def _run(self, job: DeploymentJob):
+        if not self._start(job):
+            return
+        with self._track_result(job):
+            job.result = self._execute(job)
+
+
+class AsyncDeploymentQueue(DeploymentQueue):
+    """
+    DeploymentQueue which runs jobs as tasks on the event loop with AsyncDeployer, at most
+    max_workers of them at a time. Jobs have to be submitted from the event loop.
+    """
+
+    def _start_workers(self, max_workers: int):
+        self._semaphore = asyncio.Semaphore(max_workers)
+        self._tasks: typing.Set[asyncio.Task] = set()
+
+    def _schedule(self, job: DeploymentJob):
+        task = asyncio.get_running_loop().create_task(self._run_async(job))
+        # The loop only keeps weak references to tasks
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def shutdown(self, wait: bool = True):
+        # Tasks cannot outlive the event loop, so they are cancelled either way
+        self._closed = True
+        for task in list(self._tasks):
+            task.cancel()
+
+    async def _execute_async(self, job: DeploymentJob) -> typing.Dict:
+        deployer = AsyncDeployer(job.config, job.cancel_event)
+        if job.config.rest_action == constants.DELETE:
+            await deployer.delete_preview_environment()
+            return {"message": "Removed preview environment"}
+        return {"urls": await deployer.deploy_preview_environment()}
+
+    async def _run_async(self, job: DeploymentJob):
+        async with self._semaphore:
+            if not self._start(job):
+                return
+            with self._track_result(job):
+                try:
+                    job.result = await self._execute_async(job)
+                except asyncio.CancelledError:
+                    raise DeploymentCancelled("Sarthi is shutting down")
@@ -0,0 +1,162 @@
+import asyncio
+import collections
+import itertools
+import threading
+import typing
+
+import server.constants as constants
+
+
+class BuildLogBuffer:
+    """
+    Ring buffer holding the last lines of a deployment's build output.
+    Every line gets a sequence number so readers can tail the buffer while it is written.
+    """
+
+    def __init__(self, max_lines: int = constants.DEFAULT_BUILD_LOG_MAX_LINES):
+        self._lines: typing.Deque[typing.Tuple[int, str]] = collections.deque(
+            maxlen=max_lines
+        )
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        # Event loops with followers and the event which wakes each of them up
+        self._async_waiters: typing.Set[
+            typing.Tuple[asyncio.AbstractEventLoop, asyncio.Event]
+        ] = set()
+        self._closed = False
+
+    @property
+    def closed(self) -> bool:
+        return self._closed
+
+    def reset(self):
+        with self._condition:
+            self._lines.clear()
+            self._closed = False
+
+    def _notify(self):
+        # Called with the condition held, lines may be written from any thread
+        self._condition.notify_all()
+        for loop, event in self._async_waiters:
+            try:
+                loop.call_soon_threadsafe(event.set)
+            except RuntimeError:
+                # The loop of the follower is closed
+                pass
+
+    def append(self, line: str):
+        line = line.rstrip("\n")[: constants.BUILD_LOG_MAX_LINE_LENGTH]
+        with self._condition:
+            self._lines.append((next(self._sequence), line))
+            self._notify()
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._notify()
+
+    def lines(self) -> typing.List[str]:
+        with self._condition:
+            return [line for _, line in self._lines]
+
+    def _lines_after(self, last_sequence: int) -> typing.List[typing.Tuple[int, str]]:
+        if not self._lines:
+            return []
+        # Sequence numbers in the buffer are contiguous, skip straight to the unread ones
+        start = max(0, last_sequence + 1 - self._lines[0][0])
+        return list(itertools.islice(self._lines, start, None))
+
+    def follow(
+        self, poll_seconds: float = constants.BUILD_LOG_POLL_SECONDS
+    ) -> typing.Iterator[typing.Optional[str]]:
+        """
+        Yield buffered lines and then new ones as they are written, until the buffer is closed.
+        Yields None every poll_seconds without new output so callers can send keep-alives.
+        Lines which were rotated out of the buffer before they were read are skipped.
+        """
+        last_sequence = -1
+        while True:
+            with self._condition:
+                new_lines = self._lines_after(last_sequence)
+                if not new_lines and not self._closed:
+                    self._condition.wait(poll_seconds)
+                    new_lines = self._lines_after(last_sequence)
+                closed = self._closed
+
+            if not new_lines:
+                if closed:
+                    return
+                yield None
+            for sequence, line in new_lines:
+                last_sequence = sequence
+                yield line
+
+    async def follow_async(
+        self, poll_seconds: float = constants.BUILD_LOG_POLL_SECONDS
+    ) -> typing.AsyncIterator[typing.Optional[str]]:
+        """
+        follow() for the event loop, waiting for new lines does not hold a thread.
+        """
+        waiter = (asyncio.get_running_loop(), asyncio.Event())
+        _, event = waiter
+        with self._condition:
+            self._async_waiters.add(waiter)
+        try:
+            last_sequence = -1
+            while True:
+                with self._condition:
+                    new_lines = self._lines_after(last_sequence)
+                    closed = self._closed
+                    # Lines written from now on set the event again
+                    event.clear()
+
+                if not new_lines:
+                    if closed:
+                        return
+                    try:
+                        await asyncio.wait_for(event.wait(), poll_seconds)
+                    except asyncio.TimeoutError:
+                        yield None
+                for sequence, line in new_lines:
+                    last_sequence = sequence
+                    yield line
+        finally:
+            with self._condition:
+                self._async_waiters.discard(waiter)
+
+
+class BuildLogRegistry:
+    """
+    Build log buffers keyed by deployment namespace, the least recently written ones are dropped
+    once more than max_buffers deployments have logs.
+    """
+
+    def __init__(
+        self,
+        max_buffers: int = constants.DEFAULT_BUILD_LOG_MAX_BUFFERS,
+        max_lines: int = constants.DEFAULT_BUILD_LOG_MAX_LINES,
+    ):
+        self._max_buffers = max_buffers
+        self._max_lines = max_lines
+        self._buffers: typing.OrderedDict[
+            str, BuildLogBuffer
+        ] = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def start(self, namespace: str) -> BuildLogBuffer:
+        with self._lock:
+            buffer = self._buffers.pop(namespace, None) or BuildLogBuffer(
+                self._max_lines
+            )
+            buffer.reset()
+            self._buffers[namespace] = buffer
+            while len(self._buffers) > self._max_buffers:
+                self._buffers.popitem(last=False)
+            return buffer
+
+    def get(self, namespace: str) -> typing.Optional[BuildLogBuffer]:
+        with self._lock:
+            return self._buffers.get(namespace)
+
+
+build_logs = BuildLogRegistry()
@@ -0,0 +1,106 @@
+import contextlib
+import contextvars
+import time
+import typing
+
+from prometheus_client import Counter, Gauge, Histogram
+
+# Builds and clones take minutes, nginx and vault calls milliseconds
+PHASE_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+DEPLOYMENT_PHASE_SECONDS = Histogram(
+    "sarthi_deployment_phase_seconds",
+    "Time spent in each phase of a deployment",
+    ["phase"],
+    buckets=PHASE_BUCKETS,
+)
+DEPLOYMENT_PHASE_ERRORS = Counter(
+    "sarthi_deployment_phase_errors_total",
+    "Deployment phases which raised an error",
+    ["phase"],
+)
+DEPLOYMENT_LOCK_WAIT_SECONDS = Histogram(
+    "sarthi_deployment_lock_wait_seconds",
+    "Time spent waiting for the per deployment file lock",
+    buckets=PHASE_BUCKETS,
+)
+DEPLOYMENT_JOBS = Counter(
+    "sarthi_deployment_jobs_total",
+    "Finished deployment jobs",
+    ["action", "status"],
+)
+DEPLOYMENT_JOBS_QUEUED = Gauge(
+    "sarthi_deployment_jobs_queued",
+    "Deployment jobs waiting for a worker",
+)
+DEPLOYMENTS_IN_PROGRESS = Gauge(
+    "sarthi_deployments_in_progress",
+    "Deployment jobs being worked on",
+    ["action"],
+)
+BUILDS_RUNNING = Gauge(
+    "sarthi_builds_running",
+    "docker compose up --build runs holding a build slot",
+)
+BUILDS_WAITING = Gauge(
+    "sarthi_builds_waiting",
+    "Deployments waiting for a build slot",
+)
+GC_DEPLOYMENTS_DELETED = Counter(
+    "sarthi_gc_deployments_deleted_total",
+    "Stale deployments deleted by the garbage collector",
+    ["reason"],
+)
+VAULT_REQUESTS = Counter(
+    "sarthi_vault_requests_total",
+    "Requests made to Vault",
+    ["method", "status"],
+)
+VAULT_REQUEST_SECONDS = Histogram(
+    "sarthi_vault_request_seconds",
+    "Time taken by Vault requests, including retries",
+    ["method"],
+    buckets=PHASE_BUCKETS,
+)
+
+# phase -> seconds spent in it by the deployment running in this context
+_phase_durations: contextvars.ContextVar[
+    typing.Optional[typing.Dict[str, float]]
+] = contextvars.ContextVar("phase_durations", default=None)
+
+
+@contextlib.contextmanager
+def collect_phase_durations():
+    """
+    Collect the durations of the phases tracked while the block runs, for recording them
+    with the deployment. Threads started with asyncio.to_thread add to the same durations.
+    """
+    token = _phase_durations.set({})
+    try:
+        yield
+    finally:
+        _phase_durations.reset(token)
+
+
+def current_phase_durations() -> typing.Dict[str, float]:
+    return dict(_phase_durations.get() or {})
+
+
+@contextlib.contextmanager
+def track_phase(phase: str):
+    """
+    Time a deployment phase and count it as an error if it raises.
+    Can be used as a context manager or as a decorator.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        DEPLOYMENT_PHASE_ERRORS.labels(phase).inc()
+        raise
+    finally:
+        duration = time.perf_counter() - start
+        DEPLOYMENT_PHASE_SECONDS.labels(phase).observe(duration)
+        durations = _phase_durations.get()
+        if durations is not None:
+            durations[phase] = durations.get(phase, 0) + duration
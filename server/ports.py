@@ -0,0 +1,165 @@
+import json
+import logging
+import os
+import typing
+
+import filelock
+from fastapi import HTTPException
+
+import server.constants as constants
+
+logger = logging.getLogger(__name__)
+
+
+class PortRegistry:
+    """
+    On-disk registry of the host ports handed out to deployments.
+
+    A namespace keeps its port across redeploys, released ports go to a free-list and are
+    handed out again before new ports are taken from the range. Ports found in use outside
+    Sarthi are parked on a busy list, which is only retried once the range runs out. The file
+    lock makes a reservation atomic across workers and processes.
+    """
+
+    def __init__(self, registry_path: str, start_port: int, end_port: int):
+        self._registry_path = registry_path
+        self._start_port = int(start_port)
+        self._end_port = int(end_port)
+        self._lock = filelock.FileLock(f"{registry_path}.lock")
+
+    def _load(self) -> typing.Dict:
+        try:
+            with open(self._registry_path) as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return {"ports": {}, "free": [], "busy": [], "next": self._start_port}
+        except json.JSONDecodeError as e:
+            logger.error(f"Port registry {self._registry_path} is corrupt: {e}")
+            raise HTTPException(500, "Port registry is corrupt. Check with admin")
+
+    def _save(self, registry: typing.Dict):
+        # Write to a temp file and rename so a crash never leaves a half written registry
+        temp_path = f"{self._registry_path}.tmp"
+        with open(temp_path, "w") as file:
+            json.dump(registry, file)
+        os.replace(temp_path, self._registry_path)
+
+    def _in_range(self, port: int) -> bool:
+        return self._start_port <= port <= self._end_port
+
+    def _next_candidate(self, registry: typing.Dict) -> typing.Optional[int]:
+        while registry["free"]:
+            port = registry["free"].pop()
+            if self._in_range(port):
+                return port
+        port = max(registry["next"], self._start_port)
+        if port <= self._end_port:
+            registry["next"] = port + 1
+            return port
+        busy_ports = registry.setdefault("busy", [])
+        while busy_ports:
+            port = busy_ports.pop(0)
+            if self._in_range(port):
+                return port
+        return None
+
+    def allocate(
+        self, namespace: str, is_port_free: typing.Callable[[int], bool] = None
+    ) -> int:
+        """
+        Return the port reserved for the namespace, reserving a new one if it has none.
+        Candidates rejected by is_port_free are in use outside Sarthi and are skipped. They
+        go to the end of the busy list, so ports which stay busy are not probed on every call.
+        """
+        os.makedirs(os.path.dirname(self._registry_path), exist_ok=True)
+        with self._lock:
+            registry = self._load()
+            port = registry["ports"].get(namespace)
+            if port:
+                return port
+
+            reserved_ports = set(registry["ports"].values())
+            skipped_ports = []
+            port = self._next_candidate(registry)
+            while port and (
+                port in reserved_ports or (is_port_free and not is_port_free(port))
+            ):
+                if port not in reserved_ports:
+                    logger.debug(
+                        f"Port {port} is in use outside of Sarthi, skipping it"
+                    )
+                    skipped_ports.append(port)
+                port = self._next_candidate(registry)
+
+            if not port:
+                logger.error("Could not find a free port in the specified range")
+                raise HTTPException(
+                    500, "Could not find a free port in the specified range"
+                )
+
+            registry["ports"][namespace] = port
+            registry.setdefault("busy", []).extend(skipped_ports)
+            self._save(registry)
+        logger.info(f"Reserved port {port} for {namespace}")
+        return port
+
+    def register(self, namespace: str, port: int) -> bool:
+        """
+        Reserve the port a deployment is already published on, like the ones deployed before
+        the registry existed. Returns False if the namespace has a port or the port is taken.
+        """
+        os.makedirs(os.path.dirname(self._registry_path), exist_ok=True)
+        with self._lock:
+            registry = self._load()
+            if registry["ports"].get(namespace):
+                return False
+            if port in registry["ports"].values():
+                logger.warning(
+                    f"Port {port} of {namespace} is reserved by another deployment"
+                )
+                return False
+            registry["ports"][namespace] = port
+            for ports in [registry["free"], registry.setdefault("busy", [])]:
+                if port in ports:
+                    ports.remove(port)
+            self._save(registry)
+        logger.info(f"Registered port {port} of {namespace}")
+        return True
+
+    def release(self, namespace: str):
+        if not os.path.exists(self._registry_path):
+            return
+        with self._lock:
+            registry = self._load()
+            port = registry["ports"].pop(namespace, None)
+            if not port:
+                return
+            registry["free"].append(port)
+            self._save(registry)
+        logger.info(f"Released port {port} of {namespace}")
+
+    def get(self, namespace: str) -> typing.Optional[int]:
+        if not os.path.exists(self._registry_path):
+            return None
+        with self._lock:
+            return self._load()["ports"].get(namespace)
+
+    def namespaces(self) -> typing.List[str]:
+        if not os.path.exists(self._registry_path):
+            return []
+        with self._lock:
+            return list(self._load()["ports"])
+
+
+def get_port_registry() -> PortRegistry:
+    return PortRegistry(
+        os.environ.get("PORT_REGISTRY_PATH")
+        or os.path.join(
+            os.environ.get("DEPLOYMENTS_MOUNT_DIR") or "/tmp",
+            constants.SARTHI_STATE_DIR,
+            constants.PORT_REGISTRY_FILE,
+        ),
+        os.environ.get("DEPLOYMENT_PORT_START")
+        or constants.DEFAULT_DEPLOYMENT_PORT_START,
+        os.environ.get("DEPLOYMENT_PORT_END") or constants.DEFAULT_DEPLOYMENT_PORT_END,
+    )
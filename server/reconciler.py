@@ -0,0 +1,321 @@
+import logging
+import os
+import re
+import threading
+import typing
+
+from fastapi import HTTPException
+
+import server.constants as constants
+
+from .deployer import Deployer
+from .docker_api import DockerEngineError
+from .fingerprint import FingerprintStore
+from .ports import get_port_registry
+from .routing import RoutingTable
+from .state import get_deployment_store
+from .utils import (
+    ComposeHelper,
+    DeploymentConfig,
+    NginxHelper,
+    get_deployment_config,
+    is_direct_routing,
+    list_compose_stacks,
+    list_deployment_namespaces,
+    parse_deployment_namespace,
+)
+
+logger = logging.getLogger(__name__)
+
+# <project name, at most 10 characters>-<project hash>.json, see NginxHelper
+ROUTE_FILE_PATTERN = re.compile(
+    rf"([a-z0-9_.-]{{1,10}}-[0-9a-f]{{{constants.PROJECT_HASH_LENGTH}}})\.json"
+)
+# Server block per deployment written before the routing table, which they would shadow
+LEGACY_OUTER_PROXY_CONF_PATTERN = re.compile(
+    rf"[a-z0-9_.-]{{1,10}}-[0-9a-f]{{{constants.PROJECT_HASH_LENGTH}}}\.conf"
+)
+
+
+class Reconciler:
+    """
+    Repairs drift between deployment checkouts, compose stacks, outer proxy confs and the
+    port registry, like the leftovers of a crash in the middle of a deploy. Checkouts are the
+    source of truth: whatever has no checkout is removed, checkouts without a stack are
+    deleted and outer proxy confs are pointed at the reserved port again. In direct routing
+    mode the outer nginx is connected to the network of every stack again. nginx is reloaded
+    once per pass.
+
+    A pass runs when Sarthi starts and then every interval_seconds. Namespaces for which
+    is_busy returns True, like the ones with queued or running jobs, are left alone.
+    """
+
+    def __init__(
+        self,
+        deployments_mount_dir: str,
+        outer_conf_dir: str,
+        interval_seconds: float = constants.DEFAULT_RECONCILE_INTERVAL_SECONDS,
+        is_busy: typing.Callable[[str], bool] = None,
+    ):
+        self._deployments_mount_dir = deployments_mount_dir
+        self._outer_conf_dir = outer_conf_dir
+        self._interval_seconds = interval_seconds
+        self._is_busy = is_busy or (lambda namespace: False)
+        self._direct_routing = is_direct_routing()
+        self._fingerprints = FingerprintStore(
+            os.path.join(
+                deployments_mount_dir,
+                constants.SARTHI_STATE_DIR,
+                constants.FINGERPRINTS_DIR,
+            )
+        )
+        self._stop_event = threading.Event()
+        self._thread: typing.Optional[threading.Thread] = None
+
+    def start(self):
+        if self._thread:
+            return
+        self._thread = threading.Thread(
+            target=self._run, name="sarthi-reconciler", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def _run(self):
+        startup = True
+        while not self._stop_event.is_set():
+            try:
+                self.reconcile(startup=startup)
+            except Exception as e:
+                logger.exception(f"Error reconciling deployments: {e}")
+            startup = False
+            if self._interval_seconds <= 0 or self._stop_event.wait(
+                self._interval_seconds
+            ):
+                return
+
+    def _deployment_configs(self) -> typing.Dict[str, DeploymentConfig]:
+        # Directories Sarthi can't map to a deployment are not touched
+        configs = {}
+        for namespace in list_deployment_namespaces(self._deployments_mount_dir):
+            config = get_deployment_config(self._deployments_mount_dir, namespace)
+            if config:
+                configs[namespace] = config
+        return configs
+
+    def _nginx_helper(self, config: DeploymentConfig) -> NginxHelper:
+        return NginxHelper(
+            config,
+            self._outer_conf_dir,
+            os.path.join(
+                self._deployments_mount_dir, config.get_deployment_namespace()
+            ),
+        )
+
+    def _remove_legacy_confs(self) -> typing.List[str]:
+        # Their deployments get a route when their outer proxy is repaired
+        removed = []
+        for name in os.listdir(self._outer_conf_dir):
+            if LEGACY_OUTER_PROXY_CONF_PATTERN.fullmatch(name):
+                logger.info(f"Removing outer proxy conf {name}, replaced by its route")
+                os.remove(os.path.join(self._outer_conf_dir, name))
+                removed.append(name)
+        return removed
+
+    def _remove_orphan_confs(self, expected_confs: typing.Set[str]) -> typing.List[str]:
+        if not os.path.isdir(self._outer_conf_dir):
+            return []
+        removed = self._remove_legacy_confs()
+        routing_table = RoutingTable(self._outer_conf_dir)
+        routes_dir = routing_table.routes_dir
+        if not os.path.isdir(routes_dir):
+            return removed
+        for name in os.listdir(routes_dir):
+            match = ROUTE_FILE_PATTERN.fullmatch(name)
+            if name in expected_confs or not match:
+                continue
+            # A redeploy recloning its checkout has no project dir for a moment
+            route = routing_table.read_route(match.group(1)) or {}
+            if route.get("namespace") and self._is_busy(route["namespace"]):
+                continue
+            logger.info(f"Removing route {name}, it has no deployment")
+            os.remove(os.path.join(routes_dir, name))
+            access_log_path = os.path.join(
+                self._outer_conf_dir, constants.ACCESS_LOGS_DIR, f"{match.group(1)}.log"
+            )
+            if os.path.exists(access_log_path):
+                os.remove(access_log_path)
+            removed.append(name)
+        return removed
+
+    @staticmethod
+    def _known_namespaces() -> typing.Set[str]:
+        return set(get_port_registry().namespaces()) | set(
+            get_deployment_store().namespaces()
+        )
+
+    def _remove_orphan_stacks(
+        self, stacks: typing.Dict[str, typing.Set[str]], namespaces: typing.Set[str]
+    ) -> typing.List[str]:
+        removed = []
+        known_namespaces = self._known_namespaces()
+        for namespace, project_names in stacks.items():
+            if namespace in namespaces or self._is_busy(namespace):
+                continue
+            # Like checkouts, stacks Sarthi can't map to a deployment are not touched
+            if namespace not in known_namespaces and not parse_deployment_namespace(
+                namespace
+            ):
+                continue
+            for project_name in project_names:
+                logger.info(
+                    f"Removing compose project {project_name}, it has no checkout"
+                )
+                try:
+                    ComposeHelper.remove_project(project_name)
+                    removed.append(project_name)
+                except HTTPException as e:
+                    logger.error(f"Error removing {project_name}: {e.detail}")
+        return removed
+
+    def _release_orphan_state(self, namespaces: typing.Set[str]) -> typing.List[str]:
+        port_registry = get_port_registry()
+        released = []
+        for namespace in set(port_registry.namespaces()) - namespaces:
+            if not self._is_busy(namespace):
+                port_registry.release(namespace)
+                released.append(namespace)
+
+        for namespace in set(self._fingerprints.namespaces()) - namespaces:
+            if not self._is_busy(namespace):
+                self._fingerprints.remove(namespace)
+        deployment_store = get_deployment_store()
+        for namespace in set(deployment_store.namespaces()) - namespaces:
+            if not self._is_busy(namespace):
+                deployment_store.remove(namespace)
+        return released
+
+    def _register_legacy_ports(
+        self, stacks: typing.Dict[str, typing.Set[str]], namespaces: typing.Set[str]
+    ) -> typing.List[str]:
+        # Deployments made before the port registry existed keep the port they are published on
+        if self._direct_routing:
+            return []
+        port_registry = get_port_registry()
+        reserved = set(port_registry.namespaces())
+        registered = []
+        for namespace in sorted(namespaces & set(stacks) - reserved):
+            if self._is_busy(namespace):
+                continue
+            try:
+                port = ComposeHelper.published_proxy_port(namespace)
+            except DockerEngineError as e:
+                logger.error(f"Cannot find the port of {namespace}: {e}")
+                continue
+            if port and port_registry.register(namespace, port):
+                registered.append(namespace)
+        return registered
+
+    def _needs_route_repair(self, nginx_helper: NginxHelper) -> bool:
+        if self._direct_routing:
+            return not nginx_helper.has_route()
+        return nginx_helper.outer_proxy_port() != nginx_helper.reserved_port()
+
+    def _connect_outer_proxy(
+        self, stacks: typing.Dict[str, typing.Set[str]], namespaces: typing.Set[str]
+    ):
+        # A recreated outer nginx container is connected to no stack
+        if not self._direct_routing:
+            return
+        for namespace, project_names in stacks.items():
+            if namespace not in namespaces or self._is_busy(namespace):
+                continue
+            for project_name in project_names:
+                try:
+                    ComposeHelper.connect_outer_proxy(project_name)
+                except HTTPException as e:
+                    logger.error(e.detail)
+
+    def _repair_checkout(
+        self,
+        config: DeploymentConfig,
+        nginx_helper: NginxHelper,
+        stacks: typing.Dict[str, typing.Set[str]],
+    ) -> typing.Optional[str]:
+        namespace = config.get_deployment_namespace()
+
+        def has_stack() -> bool:
+            return namespace in list_compose_stacks(self._deployments_mount_dir)
+
+        try:
+            if namespace not in stacks:
+                if Deployer(config).delete_if_stackless(has_stack):
+                    return "removed_checkouts"
+            elif self._needs_route_repair(nginx_helper):
+                if Deployer(config).repair_outer_proxy():
+                    return "repaired_confs"
+        except (HTTPException, DockerEngineError) as e:
+            logger.error(f"Error reconciling {namespace}: {e}")
+        return None
+
+    def _mark_interrupted_deploys(self) -> typing.List[str]:
+        # Nothing is deploying yet when Sarthi starts, these were cut off by a restart
+        deployment_store = get_deployment_store()
+        interrupted = []
+        for namespace in deployment_store.namespaces(constants.DEPLOYMENT_DEPLOYING):
+            if not self._is_busy(namespace):
+                deployment_store.record_deploy_failed(
+                    namespace, "Interrupted by a restart of Sarthi"
+                )
+                interrupted.append(namespace)
+        return interrupted
+
+    def reconcile(self, startup: bool = False) -> typing.Dict[str, typing.List[str]]:
+        """
+        Run one reconciliation pass and return what was repaired. With startup, deploys the
+        state store still has as in progress were interrupted and are marked as failed.
+        """
+        # Without the stacks, orphans can't be told apart from deployments
+        try:
+            stacks = list_compose_stacks(self._deployments_mount_dir)
+        except DockerEngineError as e:
+            logger.error(f"Cannot list compose stacks, skipping reconciliation: {e}")
+            return {}
+
+        configs = self._deployment_configs()
+        nginx_helpers = {
+            namespace: self._nginx_helper(config)
+            for namespace, config in configs.items()
+        }
+
+        report = {
+            "removed_confs": self._remove_orphan_confs(
+                {helper.outer_proxy_conf_name for helper in nginx_helpers.values()}
+            ),
+            "removed_stacks": self._remove_orphan_stacks(stacks, set(configs)),
+            "released_ports": self._release_orphan_state(set(configs)),
+            "registered_ports": self._register_legacy_ports(stacks, set(configs)),
+            "removed_checkouts": [],
+            "repaired_confs": [],
+            "interrupted_deploys": self._mark_interrupted_deploys() if startup else [],
+        }
+        self._connect_outer_proxy(stacks, set(configs))
+        for namespace, config in configs.items():
+            if self._is_busy(namespace):
+                continue
+            repair = self._repair_checkout(config, nginx_helpers[namespace], stacks)
+            if repair:
+                report[repair].append(namespace)
+
+        if any(report[key] for key in constants.RECONCILE_CONF_CHANGES):
+            try:
+                NginxHelper.reload_outer_nginx(self._outer_conf_dir)
+            except HTTPException as e:
+                logger.error(f"Error reloading nginx after reconciliation: {e.detail}")
+
+        repaired = {key: value for key, value in report.items() if value}
+        if repaired:
+            logger.info(f"Reconciled deployments: {repaired}")
+        return report
@@ -0,0 +1,264 @@
+import json
+import logging
+import os
+import typing
+
+import server.constants as constants
+
+logger = logging.getLogger(__name__)
+
+ROUTING_TABLE_TEMPLATE: typing.Final[
+    str
+] = """# Generated by Sarthi from %(routes_dir)s/*.json, changes are overwritten
+map_hash_max_size %(map_hash_max_size)s;
+map_hash_bucket_size %(map_hash_bucket_size)s;
+open_log_file_cache max=1000 inactive=1m;%(server_names_hash)s%(resolver)s
+%(upstreams)s
+map $host $sarthi_upstream {
+    default "";%(upstream_entries)s
+}
+
+# Upgrade websockets, otherwise leave the connection to the upstream open
+map $http_upgrade $sarthi_connection_upgrade {
+    default upgrade;
+    "" "";
+}
+%(servers)s"""
+
+# Hostnames with their own access log or proxy settings get their own server block, exact
+# server names are looked up in a hash too. Access log paths are static, so the nginx master
+# opens them as root on reload and the unprivileged workers only write to the open files.
+SERVER_TEMPLATE: typing.Final[
+    str
+] = """
+server {
+    listen 80%(default_server)s;
+    server_name %(server_name)s;
+    access_log /var/log/nginx/access.log combined;%(access_log)s
+
+    location / {
+        if ($sarthi_upstream = "") {
+            return 404;
+        }
+        proxy_pass http://$sarthi_upstream;
+        proxy_http_version 1.1;
+        proxy_set_header Upgrade $http_upgrade;
+        proxy_set_header Connection $sarthi_connection_upgrade;
+        proxy_set_header Host $host;
+        proxy_set_header X-Real-IP $remote_addr;
+        proxy_set_header X-Forwarded-For $proxy_add_x_forwarded_for;
+        proxy_set_header X-Forwarded-Proto $scheme;
+        proxy_set_header X-Original-URI $request_uri;%(proxy_settings)s
+    }
+}
+"""
+
+UPSTREAM_TEMPLATE: typing.Final[
+    str
+] = """
+upstream %s {
+    server %s;%s
+}
+"""
+
+
+def upstream_keepalive() -> int:
+    return int(
+        os.environ.get("NGINX_UPSTREAM_KEEPALIVE")
+        or constants.DEFAULT_NGINX_UPSTREAM_KEEPALIVE
+    )
+
+
+def keepalive_directive(indent: str) -> str:
+    keepalive = upstream_keepalive()
+    return f"\n{indent}keepalive {keepalive};" if keepalive > 0 else ""
+
+
+def proxy_directives(settings: typing.Dict[str, str], indent: str) -> str:
+    return "".join(
+        f"\n{indent}{directive} {value};" for directive, value in settings.items()
+    )
+
+
+def hash_bucket_size(keys: typing.Iterable[str]) -> int:
+    """
+    Bucket size for an nginx hash of keys, like the map and server names hashes. nginx fails
+    to start if the longest key does not fit in a single bucket.
+    """
+    longest = max((len(key) for key in keys), default=0)
+    size = 64
+    # Every entry in a bucket also holds a pointer and the length of its key
+    while size < longest + 16:
+        size *= 2
+    return size
+
+
+def _hash_max_size(entries: int) -> int:
+    size = 2048
+    while size < entries * 2:
+        size *= 2
+    return size
+
+
+def _write_atomically(path: str, content: str):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "w") as file:
+        file.write(content)
+    os.replace(temp_path, path)
+
+
+def _server_names_hash(server_names: typing.Collection[str]) -> str:
+    return (
+        f"\nserver_names_hash_max_size {_hash_max_size(len(server_names))};"
+        f"\nserver_names_hash_bucket_size {hash_bucket_size(server_names)};"
+    )
+
+
+def _resolver() -> str:
+    # Service aliases are resolved when requests come in, so stacks can be recreated
+    resolver = os.environ.get("NGINX_RESOLVER") or constants.DEFAULT_NGINX_RESOLVER
+    return f"\nresolver {resolver} valid=10s ipv6=off;"
+
+
+class RoutingTable:
+    """
+    Routes of every deployment in a single nginx conf - a map from the exact hostnames of the
+    deployments to their upstreams and one catch-all server block proxying to it, so nginx finds
+    a deployment with a hash lookup instead of trying a regex server_name per deployment.
+    Hostnames with their own access log or proxy settings get exact server blocks, which nginx
+    finds with a hash lookup as well.
+
+    Every deployment keeps its route in its own file, which it writes under its deployment lock.
+    The conf is generated from all of them right before nginx is tested and reloaded.
+    """
+
+    def __init__(self, outer_conf_dir: str):
+        self._outer_conf_dir = outer_conf_dir
+        self._routes_dir = os.path.join(outer_conf_dir, constants.ROUTES_DIR)
+        self._path = os.path.join(outer_conf_dir, constants.ROUTING_TABLE_FILE)
+
+    @property
+    def routes_dir(self) -> str:
+        return self._routes_dir
+
+    def route_path(self, name: str) -> str:
+        return os.path.join(self._routes_dir, f"{name}.json")
+
+    def write_route(self, name: str, route: typing.Dict):
+        _write_atomically(self.route_path(name), json.dumps(route))
+
+    def read_route(self, name: str) -> typing.Optional[typing.Dict]:
+        return self._read_route_file(self.route_path(name))
+
+    @staticmethod
+    def _read_route_file(path: str) -> typing.Optional[typing.Dict]:
+        try:
+            with open(path) as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return None
+        except json.JSONDecodeError as e:
+            logger.warning(f"Ignoring corrupt route {path}: {e}")
+            return None
+
+    def routes(self) -> typing.Dict[str, typing.Dict]:
+        if not os.path.isdir(self._routes_dir):
+            return {}
+        routes = {}
+        for file_name in sorted(os.listdir(self._routes_dir)):
+            if not file_name.endswith(".json"):
+                continue
+            route = self._read_route_file(os.path.join(self._routes_dir, file_name))
+            if route:
+                routes[file_name[: -len(".json")]] = route  # noqa: E203
+        return routes
+
+    @staticmethod
+    def _upstreams(
+        name: str, route: typing.Dict
+    ) -> typing.Tuple[typing.Dict[str, str], typing.Dict[str, str]]:
+        """
+        Upstream blocks a route needs and the upstream of each of its hostnames. Hibernated
+        deployments go to the wake endpoint, nginx replaces the request URI with the one in
+        the upstream value. Routes straight to services use their network aliases, which are
+        resolved when requests come in and so can't keep connections alive.
+        """
+        if route.get("hibernated"):
+            wake = f"{constants.WAKE_UPSTREAM}/deployments/{route['namespace']}/wake"
+            return (
+                {
+                    constants.WAKE_UPSTREAM: os.environ.get("SARTHI_INTERNAL_HOST")
+                    or constants.DEFAULT_SARTHI_INTERNAL_HOST
+                },
+                {host: wake for host in route["hosts"]},
+            )
+        if "servers" in route:
+            return {}, route["servers"]
+        upstream = f"sarthi-{name}"
+        return (
+            {upstream: f"{route['host']}:{route['port']}"},
+            {host: upstream for host in route["hosts"]},
+        )
+
+    @staticmethod
+    def _server(
+        server_name: str,
+        access_log: typing.Optional[str] = None,
+        proxy_settings: typing.Dict[str, str] = None,
+    ) -> str:
+        return SERVER_TEMPLATE % {
+            "default_server": " default_server" if server_name == "_" else "",
+            "server_name": server_name,
+            "access_log": f"\n    access_log {constants.OUTER_NGINX_CONF_DIR}/{access_log} combined;"
+            if access_log
+            else "",
+            "proxy_settings": proxy_directives(proxy_settings or {}, " " * 8),
+        }
+
+    def render(self) -> str:
+        upstreams: typing.Dict[str, str] = {}
+        upstream_entries: typing.Dict[str, str] = {}
+        servers: typing.Dict[str, typing.Dict] = {}
+        resolve = False
+        for name, route in self.routes().items():
+            route_upstreams, host_upstreams = self._upstreams(name, route)
+            upstreams.update(route_upstreams)
+            resolve = resolve or ("servers" in route and not route.get("hibernated"))
+            for host, upstream in host_upstreams.items():
+                # Hostnames are unique to a deployment, the first route wins if they are not
+                if host in upstream_entries:
+                    continue
+                upstream_entries[host] = upstream
+                server = {
+                    "access_log": route.get("access_log"),
+                    "proxy_settings": (route.get("proxy") or {}).get(host),
+                }
+                if any(server.values()):
+                    servers[host] = server
+
+        return ROUTING_TABLE_TEMPLATE % {
+            "routes_dir": constants.ROUTES_DIR,
+            "map_hash_max_size": _hash_max_size(len(upstream_entries)),
+            "map_hash_bucket_size": hash_bucket_size(upstream_entries),
+            "upstreams": "".join(
+                UPSTREAM_TEMPLATE % (upstream, server, keepalive_directive(" " * 4))
+                for upstream, server in upstreams.items()
+            ),
+            "upstream_entries": "".join(
+                f"\n    {host} {value};" for host, value in upstream_entries.items()
+            ),
+            "server_names_hash": _server_names_hash(servers) if servers else "",
+            "resolver": _resolver() if resolve else "",
+            "servers": self._server("_")
+            + "".join(self._server(host, **server) for host, server in servers.items()),
+        }
+
+    def write(self) -> str:
+        """
+        Generate the routing table from the routes of all deployments, replacing the old one
+        in a single rename so nginx never reads a half written table.
+        """
+        conf = self.render()
+        _write_atomically(self._path, conf)
+        return conf
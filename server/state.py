@@ -0,0 +1,216 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import typing
+
+import server.constants as constants
+
+from .utils import DeploymentConfig, strip_credentials
+
+logger = logging.getLogger(__name__)
+
+SCHEMA: typing.Final[
+    str
+] = """
+CREATE TABLE IF NOT EXISTS deployments (
+    namespace TEXT PRIMARY KEY,
+    project_name TEXT NOT NULL,
+    branch_name TEXT NOT NULL,
+    branch_name_raw TEXT NOT NULL,
+    project_git_url TEXT,
+    commit_sha TEXT,
+    port INTEGER,
+    urls TEXT NOT NULL DEFAULT '[]',
+    status TEXT NOT NULL,
+    error TEXT,
+    phase_durations TEXT NOT NULL DEFAULT '{}',
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    deployed_at REAL
+);
+CREATE INDEX IF NOT EXISTS deployments_project_branch
+    ON deployments (project_name, branch_name);
+CREATE INDEX IF NOT EXISTS deployments_status ON deployments (status, updated_at);
+CREATE INDEX IF NOT EXISTS deployments_updated_at ON deployments (updated_at);
+"""
+
+
+class DeploymentStore:
+    """
+    Record of the deployments Sarthi made, in SQLite so listing them does not need to scan
+    the deployments directory or ask docker. WAL mode lets readers run next to the writer.
+    """
+
+    def __init__(self, db_path: str):
+        if db_path != ":memory:":
+            os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        self._connection = sqlite3.connect(
+            db_path, check_same_thread=False, isolation_level=None
+        )
+        self._connection.row_factory = sqlite3.Row
+        self._lock = threading.Lock()
+        with self._lock:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+            self._connection.executescript(SCHEMA)
+
+    def _execute(
+        self, query: str, parameters: typing.Sequence = ()
+    ) -> typing.List[sqlite3.Row]:
+        # The connection is shared by all threads, so rows are fetched under the lock too
+        with self._lock:
+            return self._connection.execute(query, parameters).fetchall()
+
+    def record_deploy_started(self, config: DeploymentConfig):
+        now = time.time()
+        self._execute(
+            """
+            INSERT INTO deployments (
+                namespace, project_name, branch_name, branch_name_raw, project_git_url,
+                status, created_at, updated_at
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (namespace) DO UPDATE SET
+                project_git_url = excluded.project_git_url,
+                status = excluded.status,
+                error = NULL,
+                updated_at = excluded.updated_at
+            """,
+            (
+                config.get_deployment_namespace(),
+                config.project_name,
+                config.branch_name,
+                config.branch_name_raw,
+                strip_credentials(config.project_git_url),
+                constants.DEPLOYMENT_DEPLOYING,
+                now,
+                now,
+            ),
+        )
+
+    def record_deployed(
+        self,
+        namespace: str,
+        commit_sha: str,
+        port: typing.Optional[str],
+        urls: typing.List[str],
+        phase_durations: typing.Dict[str, float],
+    ):
+        now = time.time()
+        self._execute(
+            """
+            UPDATE deployments SET
+                commit_sha = ?, port = ?, urls = ?, phase_durations = ?, status = ?,
+                error = NULL, updated_at = ?, deployed_at = ?
+            WHERE namespace = ?
+            """,
+            (
+                commit_sha,
+                int(port) if port else None,
+                json.dumps(urls),
+                json.dumps(phase_durations),
+                constants.DEPLOYMENT_RUNNING,
+                now,
+                now,
+                namespace,
+            ),
+        )
+
+    def record_deploy_failed(self, namespace: str, error: str):
+        self._execute(
+            "UPDATE deployments SET status = ?, error = ?, updated_at = ? WHERE namespace = ?",
+            (
+                constants.DEPLOYMENT_FAILED,
+                strip_credentials(error),
+                time.time(),
+                namespace,
+            ),
+        )
+
+    def set_status(self, namespace: str, status: str):
+        self._execute(
+            "UPDATE deployments SET status = ?, updated_at = ? WHERE namespace = ?",
+            (status, time.time(), namespace),
+        )
+
+    def remove(self, namespace: str):
+        self._execute("DELETE FROM deployments WHERE namespace = ?", (namespace,))
+
+    @staticmethod
+    def _to_dict(row: sqlite3.Row) -> typing.Dict:
+        deployment = dict(row)
+        deployment["urls"] = json.loads(deployment["urls"])
+        deployment["phase_durations"] = json.loads(deployment["phase_durations"])
+        return deployment
+
+    def get(self, namespace: str) -> typing.Optional[typing.Dict]:
+        rows = self._execute(
+            "SELECT * FROM deployments WHERE namespace = ?", (namespace,)
+        )
+        return self._to_dict(rows[0]) if rows else None
+
+    def list(
+        self,
+        project_name: str = None,
+        branch_name: str = None,
+        status: str = None,
+        limit: int = constants.DEFAULT_DEPLOYMENTS_PAGE_SIZE,
+        offset: int = 0,
+    ) -> typing.Tuple[typing.List[typing.Dict], int]:
+        """
+        Deployments matching the filters, most recently updated first, and their total count.
+        """
+        conditions, parameters = [], []
+        if project_name:
+            conditions.append("project_name = ?")
+            parameters.append(project_name)
+        if branch_name:
+            conditions.append("(branch_name = ? OR branch_name_raw = ?)")
+            parameters.extend([branch_name, branch_name])
+        if status:
+            conditions.append("status = ?")
+            parameters.append(status)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+
+        total = self._execute(f"SELECT COUNT(*) FROM deployments {where}", parameters)[
+            0
+        ][0]
+        rows = self._execute(
+            f"SELECT * FROM deployments {where} ORDER BY updated_at DESC LIMIT ? OFFSET ?",
+            [*parameters, limit, offset],
+        )
+        return [self._to_dict(row) for row in rows], total
+
+    def namespaces(self, status: str = None) -> typing.List[str]:
+        if status:
+            rows = self._execute(
+                "SELECT namespace FROM deployments WHERE status = ?", (status,)
+            )
+        else:
+            rows = self._execute("SELECT namespace FROM deployments")
+        return [row["namespace"] for row in rows]
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+_deployment_store: typing.Optional[DeploymentStore] = None
+_deployment_store_lock = threading.Lock()
+
+
+def get_deployment_store() -> DeploymentStore:
+    global _deployment_store
+    with _deployment_store_lock:
+        if _deployment_store is None:
+            _deployment_store = DeploymentStore(
+                os.environ.get("STATE_DB_PATH")
+                or os.path.join(
+                    os.environ.get("DEPLOYMENTS_MOUNT_DIR") or "/tmp",
+                    constants.SARTHI_STATE_DIR,
+                    constants.STATE_DB_FILE,
+                )
+            )
+        return _deployment_store
@@ -0,0 +1,107 @@
+import fnmatch
+import logging
+import typing
+from concurrent.futures import ThreadPoolExecutor
+
+from fastapi import HTTPException
+
+import server.constants as constants
+
+from .deployer import Deployer
+from .utils import DeploymentConfig, get_deployment_config, list_deployment_namespaces
+
+logger = logging.getLogger(__name__)
+
+
+class BulkTeardown:
+    """
+    Deletes many preview environments at once - deployments are torn down concurrently on a
+    bounded pool of threads and nginx is reloaded a single time once all of them are gone.
+    """
+
+    def __init__(
+        self,
+        deployments_mount_dir: str,
+        max_workers: int = constants.DEFAULT_BULK_DELETE_WORKERS,
+    ):
+        self._deployments_mount_dir = deployments_mount_dir
+        self._max_workers = max_workers
+
+    def select(
+        self,
+        namespaces: typing.List[str] = None,
+        project_name: str = None,
+        branch_pattern: str = None,
+    ) -> typing.Dict[str, typing.Optional[DeploymentConfig]]:
+        """
+        Map the namespaces to delete to their configs, None for namespaces which are not Sarthi's.
+        Explicit namespaces are taken as is, otherwise deployments on disk are filtered by
+        project name and a shell style pattern on the branch name.
+        """
+        if namespaces:
+            return {
+                namespace: get_deployment_config(self._deployments_mount_dir, namespace)
+                for namespace in namespaces
+            }
+
+        selected = {}
+        for namespace in list_deployment_namespaces(self._deployments_mount_dir):
+            config = get_deployment_config(self._deployments_mount_dir, namespace)
+            if not config:
+                continue
+            if project_name and config.project_name != project_name:
+                continue
+            if branch_pattern and not (
+                fnmatch.fnmatchcase(config.branch_name_raw, branch_pattern)
+                or fnmatch.fnmatchcase(config.branch_name, branch_pattern)
+            ):
+                continue
+            selected[namespace] = config
+        return selected
+
+    @staticmethod
+    def _delete(config: DeploymentConfig) -> Deployer:
+        deployer = Deployer(config)
+        deployer.delete_preview_environment(reload_nginx=False)
+        return deployer
+
+    def delete(
+        self, configs: typing.Dict[str, typing.Optional[DeploymentConfig]]
+    ) -> typing.Dict:
+        deleted: typing.List[str] = []
+        failed: typing.Dict[str, str] = {}
+        deployers: typing.List[Deployer] = []
+
+        with ThreadPoolExecutor(
+            max_workers=self._max_workers, thread_name_prefix="sarthi-teardown"
+        ) as executor:
+            futures = {
+                namespace: executor.submit(self._delete, config)
+                for namespace, config in configs.items()
+                if config
+            }
+            for namespace, config in configs.items():
+                if not config:
+                    failed[namespace] = "Unknown deployment namespace"
+                    continue
+                try:
+                    deployers.append(futures[namespace].result())
+                    deleted.append(namespace)
+                except HTTPException as e:
+                    logger.error(f"Error deleting {namespace}: {e.detail}")
+                    failed[namespace] = str(e.detail)
+                except Exception as e:
+                    logger.exception(f"Error deleting {namespace}: {e}")
+                    failed[namespace] = str(e)
+
+        result = {"deleted": deleted, "failed": failed}
+        if deployers:
+            # Removed outer proxy confs are all picked up by one reload
+            try:
+                deployers[0].reload_nginx()
+            except HTTPException as e:
+                logger.error(f"Error reloading nginx after bulk delete: {e.detail}")
+                result["error"] = str(e.detail)
+
+        logger.info(f"Bulk deleted {len(deleted)} deployments, {len(failed)} failed")
+        return result
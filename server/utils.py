@@ -4,11 +4,15 @@ import logging
 import os
 import pathlib
 import re
+import shutil
 import socket
 import subprocess
+import threading
+import time
 import typing
 from dataclasses import dataclass
 
+import filelock
 import requests
 import yaml
 from dotenv import dotenv_values
@@ -16,8 +20,33 @@ from fastapi import HTTPException
 
 import server.constants as constants
 
+from .compose import PortMapping, dump_yaml, load_yaml, parse_service_ports
+from .docker_api import DockerEngineError, get_docker_client
+from .logs import BuildLogBuffer, build_logs
+from .metrics import track_phase
+from .ports import get_port_registry
+from .routing import (
+    RoutingTable,
+    hash_bucket_size,
+    keepalive_directive,
+    proxy_directives,
+)
+from .vault import get_secrets_cache, get_vault_session
+
 logger = logging.getLogger(__name__)
 
+# Proxy setting values end up in nginx confs, like 300s, 8 16k or off
+PROXY_SETTING_VALUE_PATTERN = re.compile(r"[0-9A-Za-z. ]+")
+# GitHub tokens are embedded in clone URLs as https://<token>:@github.com/...
+URL_CREDENTIALS_PATTERN = re.compile(r"//[^/@\s]*@")
+
+
+def strip_credentials(text: str) -> str:
+    """
+    Remove the credentials of every URL in text, like the clone URL in git errors.
+    """
+    return URL_CREDENTIALS_PATTERN.sub("//", text or "")
+
 
 @dataclass
 class DeploymentConfig:
@@ -27,6 +56,8 @@ class DeploymentConfig:
     gh_token: str = None
     compose_file_location: str = constants.COMPOSE_FILE
     rest_action: str = constants.POST
+    # Rebuild even if nothing changed since the last deploy, e.g. to pick up new base images
+    force_rebuild: bool = False
 
     def __post_init__(self):
         self.branch_name_raw = self.branch_name
@@ -50,11 +81,16 @@ class DeploymentConfig:
             )
 
     def get_project_hash(self):
-        return get_random_stub(f"{self.project_name}:{self.branch_name}", 10)
+        return get_random_stub(
+            f"{self.project_name}:{self.branch_name}", constants.PROJECT_HASH_LENGTH
+        )
+
+    def get_deployment_namespace(self):
+        return f"{self.project_name}_{self.branch_name}_{self.get_project_hash()}"
 
     def __repr__(self):
         return (
-            f"DeploymentConfig({self.project_name!r}, {self.branch_name!r}, {self.project_git_url!r}, "
+            f"DeploymentConfig({self.project_name!r}, {self.branch_name!r}, {strip_credentials(self.project_git_url)!r}, "
             f"{self.compose_file_location!r}, {self.rest_action!r})"
         )
 
@@ -66,7 +102,7 @@ class ComposeHelper:
 services:
     nginx:
         image: nginx
-        restart: always
+        restart: unless-stopped
         ports:
             - '%s:80'
         volumes:
@@ -80,10 +116,21 @@ services:
         self._compose = (
             load_yaml_file(self._compose_file_location) if load_compose_file else None
         )
+        # Parsed once, the processed compose file has no ports anymore
+        self._service_ports: typing.Dict[str, typing.List[PortMapping]] = (
+            parse_service_ports(self._compose) if self._compose else {}
+        )
+        # (image, project cache image) of the services built by this deployment
+        self._built_images: typing.List[typing.Tuple[str, str]] = []
+        self._prepared = False
+        self._direct_routing = is_direct_routing()
 
-    def start_services(
+    def _prepare_compose_file(
         self, nginx_port: str, conf_file_path: str, deployment_namespace: str
     ):
+        # Processing is not idempotent, the nginx service would be counted as a service of the stack
+        if self._prepared:
+            return
         try:
             self._generate_processed_compose_file(
                 nginx_port, conf_file_path, deployment_namespace
@@ -91,22 +138,83 @@ services:
         except Exception as e:
             logger.error(f"Error generating processed compose file: {e}")
             raise HTTPException(500, e)
+        self._prepared = True
 
-        command = ["docker", "compose", "up", "-d", "--build"]
+    def prepare_services(
+        self, nginx_port: str, conf_file_path: str, deployment_namespace: str
+    ):
+        """
+        Write the processed compose file without starting anything, start_services reuses it.
+        """
+        self._prepare_compose_file(nginx_port, conf_file_path, deployment_namespace)
+
+    def _compose_up_command(self, build: bool) -> typing.List[str]:
+        return ["docker", "compose", "up", "-d", *(["--build"] if build else [])]
+
+    def start_services(
+        self,
+        nginx_port: str,
+        conf_file_path: str,
+        deployment_namespace: str,
+        build: bool = True,
+    ):
+        """
+        With build=False images are not rebuilt, containers whose config or env changed are recreated.
+        """
+        self._prepare_compose_file(nginx_port, conf_file_path, deployment_namespace)
+
+        command = self._compose_up_command(build)
         project_dir = pathlib.Path(self._compose_file_location).parent
+        build_log = build_logs.start(deployment_namespace)
 
         try:
-            subprocess.run(command, check=True, cwd=project_dir)
-            logger.info("Docker Compose up -d --build executed successfully.")
+            return_code = self._stream_command(command, project_dir, build_log)
         except Exception as e:
             msg = f"An unexpected error occurred while starting services: {e}"
             logger.error(msg)
             raise HTTPException(500, msg)
+        finally:
+            build_log.close()
+
+        self._check_compose_up(return_code, build_log)
+        if self._direct_routing:
+            self._connect_outer_proxies()
+        if build:
+            self._share_build_cache(deployment_namespace)
+
+    @staticmethod
+    def _check_compose_up(return_code: int, build_log: BuildLogBuffer):
+        if return_code != 0:
+            output = "\n".join(
+                build_log.lines()[-constants.BUILD_LOG_ERROR_TAIL_LINES :]  # noqa: E203
+            )
+            msg = f"Docker Compose up failed with exit code {return_code}: {output}"
+            logger.error(msg)
+            raise HTTPException(500, msg)
+        logger.info("Docker Compose up executed successfully.")
+
+    @staticmethod
+    def _stream_command(
+        command: typing.List[str], cwd: pathlib.Path, build_log: BuildLogBuffer
+    ) -> int:
+        # stdout and stderr are merged and read line by line so the build can be tailed live
+        process = subprocess.Popen(
+            command,
+            cwd=cwd,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True,
+            errors="replace",
+        )
+        for line in process.stdout:
+            build_log.append(line)
+        return process.wait()
 
     def remove_services(self):
         if not os.path.exists(pathlib.Path(self._compose_file_location).parent):
             logger.info(f"{self._compose_file_location} is already deleted!")
             return "Deployment already deleted"
+        self._disconnect_outer_proxies()
         command = ["docker", "compose", "down", "-v"]
         project_dir = pathlib.Path(self._compose_file_location).parent
         try:
@@ -117,14 +225,162 @@ services:
             logger.error(msg)
             raise HTTPException(500, msg)
 
+    def _run_compose_command(self, *args: str):
+        project_dir = pathlib.Path(self._compose_file_location).parent
+        try:
+            subprocess.run(
+                ["docker", "compose", *args],
+                check=True,
+                capture_output=True,
+                cwd=project_dir,
+            )
+        except subprocess.CalledProcessError as e:
+            msg = (
+                f"Docker Compose {args[0]} failed: {e.stderr.decode(errors='replace')}"
+            )
+            logger.error(msg)
+            raise HTTPException(500, msg)
+        logger.info(f"Docker Compose {' '.join(args)} executed successfully.")
+
+    def _list_containers(self) -> typing.List[typing.Dict]:
+        project_dir = pathlib.Path(self._compose_file_location).parent
+        return get_docker_client().list_containers(
+            labels=[
+                f"com.docker.compose.project.working_dir={project_dir}",
+                "com.docker.compose.oneoff=False",
+            ]
+        )
+
+    def _compose_project_names(self) -> typing.Set[str]:
+        try:
+            containers = self._list_containers()
+        except DockerEngineError as e:
+            logger.warning(
+                f"Cannot list containers of {self._compose_file_location}: {e}"
+            )
+            return set()
+        return {
+            container["Labels"]["com.docker.compose.project"]
+            for container in containers
+            if "com.docker.compose.project" in container.get("Labels", {})
+        }
+
+    @staticmethod
+    def _default_networks(project_name: str) -> typing.List[str]:
+        networks = get_docker_client().list_networks(
+            labels=[
+                f"com.docker.compose.project={project_name}",
+                "com.docker.compose.network=default",
+            ]
+        )
+        return [network["Id"] for network in networks]
+
+    @staticmethod
+    def connect_outer_proxy(project_name: str):
+        """
+        Connect the outer nginx to the default network of a compose project, so it can reach
+        the services of the stack by their network aliases. Connecting twice is a no-op.
+        """
+        try:
+            for network in ComposeHelper._default_networks(project_name):
+                get_docker_client().connect_network(
+                    network, constants.SARTHI_NGINX_CONTAINER
+                )
+        except DockerEngineError as e:
+            logger.error(f"Error connecting nginx to {project_name}: {e}")
+            raise HTTPException(500, f"Cannot route to {project_name}: {e}")
+
+    @staticmethod
+    def disconnect_outer_proxy(project_name: str):
+        # docker compose down can't remove a network the outer nginx is still connected to
+        try:
+            for network in ComposeHelper._default_networks(project_name):
+                get_docker_client().disconnect_network(
+                    network, constants.SARTHI_NGINX_CONTAINER
+                )
+        except DockerEngineError as e:
+            logger.debug(f"Outer nginx not disconnected from {project_name}: {e}")
+
+    @staticmethod
+    def published_proxy_port(deployment_namespace: str) -> typing.Optional[int]:
+        """
+        Host port the project nginx of a deployment is published on, None if it is not running.
+        """
+        containers = get_docker_client().list_containers(
+            labels=[f"com.docker.compose.service=nginx_{deployment_namespace}"]
+        )
+        for container in containers:
+            for port in container.get("Ports") or []:
+                if port.get("PrivatePort") == 80 and port.get("PublicPort"):
+                    return int(port["PublicPort"])
+        return None
+
+    def _connect_outer_proxies(self):
+        for project_name in self._compose_project_names():
+            self.connect_outer_proxy(project_name)
+
+    def _disconnect_outer_proxies(self):
+        for project_name in self._compose_project_names():
+            self.disconnect_outer_proxy(project_name)
+
+    def is_running(self) -> bool:
+        """
+        Whether every service of the processed stack has a running container which is not unhealthy.
+        """
+        try:
+            containers = self._list_containers()
+        except DockerEngineError as e:
+            logger.warning(
+                f"Cannot list containers of {self._compose_file_location}: {e}"
+            )
+            return False
+        running_services = {
+            container["Labels"].get("com.docker.compose.service")
+            for container in containers
+            if container.get("State") == "running"
+            and "(unhealthy)" not in container.get("Status", "")
+        }
+        # Services behind a profile are not started by docker compose up
+        expected_services = {
+            name
+            for name, service in self._compose["services"].items()
+            if not service.get("profiles")
+        }
+        return expected_services <= running_services
+
+    @staticmethod
+    def remove_project(project_name: str):
+        """
+        Tear down a compose project by name, for stacks whose checkout is already gone.
+        """
+        ComposeHelper.disconnect_outer_proxy(project_name)
+        try:
+            subprocess.run(
+                ["docker", "compose", "-p", project_name, "down", "-v"],
+                check=True,
+                capture_output=True,
+            )
+        except subprocess.CalledProcessError as e:
+            msg = f"Docker Compose down of {project_name} failed: {e.stderr.decode(errors='replace')}"
+            logger.error(msg)
+            raise HTTPException(500, msg)
+        logger.info(f"Removed compose project {project_name}")
+
+    def stop_services(self):
+        self._run_compose_command("stop")
+
+    def resume_services(self):
+        self._run_compose_command("start")
+
     def _generate_processed_compose_file(
         self, nginx_port: str, conf_file_path: str, deployment_namespace: str
     ):
         """
         This should ideally be called after get_service_ports_config as it will overwrite the compose file
         1. Remove ports mapping
-        2. Add in a nginx config
+        2. Add in a nginx config, or in direct routing mode expose the services to the outer nginx
         """
+        exposed_services = list(self._exposed_ports())
         for service in self._compose["services"]:
             if "ports" in self._compose["services"][service]:
                 del self._compose["services"][service]["ports"]
@@ -132,13 +388,46 @@ services:
             if "container_name" in self._compose["services"][service]:
                 del self._compose["services"][service]["container_name"]
 
-            self._compose["services"][service]["restart"] = "always"
+            # unless-stopped, so hibernated stacks stay stopped when the docker daemon restarts
+            self._compose["services"][service]["restart"] = "unless-stopped"
+
+        self._apply_resource_limits()
+        self._apply_build_cache(deployment_namespace)
+        if self._direct_routing:
+            self._add_service_aliases(exposed_services, deployment_namespace)
+        else:
+            self._add_project_proxy(nginx_port, conf_file_path, deployment_namespace)
 
+        self._write_compose_file()
+
+    def _add_service_aliases(
+        self, services: typing.List[str], deployment_namespace: str
+    ):
+        # The outer nginx is connected to the default network of every stack, service names
+        # would clash between deployments
+        for service in services:
+            config = self._compose["services"][service]
+            if "network_mode" in config:
+                continue
+            networks = config.get("networks") or {}
+            if isinstance(networks, list):
+                networks = {name: None for name in networks}
+            default_network = networks.get("default") or {}
+            aliases = default_network.setdefault("aliases", [])
+            alias = get_service_host(deployment_namespace, service)
+            if alias not in aliases:
+                aliases.append(alias)
+            networks["default"] = default_network
+            config["networks"] = networks
+
+    def _add_project_proxy(
+        self, nginx_port: str, conf_file_path: str, deployment_namespace: str
+    ):
         service_proxy_template = ComposeHelper.NGINX_SERVICE_TEMPLATE % (
             nginx_port,
             conf_file_path,
         )
-        proxy_yaml = yaml.safe_load(service_proxy_template)
+        proxy_yaml = load_yaml(service_proxy_template)
 
         # Add the proxy nginx to all networks, along with default
         if "networks" in self._compose:
@@ -150,32 +439,213 @@ services:
             "services"
         ]["nginx"]
 
-        self._write_compose_file()
+    @staticmethod
+    def _resource_limit(service: typing.Dict, key: str, limits_key: str):
+        limits = (service.get("deploy") or {}).get("resources", {}).get("limits", {})
+        return service.get(key) or limits.get(limits_key)
+
+    def _apply_resource_limits(self):
+        """
+        Split STACK_MEMORY_LIMIT and STACK_CPU_LIMIT evenly over the services of the stack.
+        Services which set a limit of their own keep it.
+        """
+        services = self._compose["services"]
+        stack_memory_limit = os.environ.get("STACK_MEMORY_LIMIT")
+        if stack_memory_limit:
+            unlimited = [
+                name
+                for name, service in services.items()
+                if not self._resource_limit(service, "mem_limit", "memory")
+            ]
+            for name in unlimited:
+                services[name]["mem_limit"] = parse_memory_size(
+                    stack_memory_limit
+                ) // len(unlimited)
+
+        stack_cpu_limit = os.environ.get("STACK_CPU_LIMIT")
+        if stack_cpu_limit:
+            unlimited = [
+                name
+                for name, service in services.items()
+                if not self._resource_limit(service, "cpus", "cpus")
+            ]
+            for name in unlimited:
+                services[name]["cpus"] = round(
+                    float(stack_cpu_limit) / len(unlimited), 2
+                )
+
+    @staticmethod
+    def _set_build_option(build: typing.Dict, option: str, name: str, value: str):
+        # args and labels can be given as a mapping or as a list of NAME=value
+        values = build.setdefault(option, {})
+        if isinstance(values, list):
+            values.append(f"{name}={value}")
+        else:
+            values[name] = value
+
+    def _apply_build_cache(self, deployment_namespace: str):
+        """
+        Name the images of built services per project and service and tag them with the branch,
+        so every branch of a project builds from the layers of the project's last build instead
+        of from scratch. With BUILD_CACHE_DIR set, the BuildKit cache is shared through it too.
+        """
+        project_name, branch_name = parse_deployment_namespace(
+            deployment_namespace
+        ) or (deployment_namespace, constants.BUILD_CACHE_TAG)
+        build_cache_dir = os.environ.get("BUILD_CACHE_DIR")
+        self._built_images = []
+
+        for name, service in self._compose["services"].items():
+            if "build" not in service:
+                continue
+            if isinstance(service["build"], str):
+                service["build"] = {"context": service["build"]}
+            build = service["build"]
+
+            repository = get_image_repository(project_name, name)
+            cache_image = f"{repository}:{constants.BUILD_CACHE_TAG}"
+            service.setdefault("image", f"{repository}:{get_image_tag(branch_name)}")
+
+            cache_from = [*build.get("cache_from", []), service["image"], cache_image]
+            if build_cache_dir:
+                cache_path = os.path.join(build_cache_dir, project_name, name)
+                cache_from.append(f"type=local,src={cache_path}")
+                build["cache_to"] = [
+                    *build.get("cache_to", []),
+                    f"type=local,dest={cache_path},mode=max",
+                ]
+            build["cache_from"] = cache_from
+            # Images carry their cache metadata, so cache_from works on local images
+            self._set_build_option(build, "args", "BUILDKIT_INLINE_CACHE", "1")
+            self._set_build_option(
+                build, "labels", constants.BUILD_NAMESPACE_LABEL, deployment_namespace
+            )
+            self._built_images.append((service["image"], cache_image))
+
+    def _share_build_cache(self, deployment_namespace: str):
+        """
+        Tag the images just built as the project's build cache and remove the images they replaced.
+        """
+        if not self._built_images:
+            return
+        docker_client = get_docker_client()
+        for image, cache_image in self._built_images:
+            repository, _, tag = cache_image.rpartition(":")
+            try:
+                docker_client.tag_image(image, repository, tag)
+            except DockerEngineError as e:
+                logger.warning(f"Cannot tag {image} as {cache_image}: {e}")
+        self.remove_images(deployment_namespace, dangling=True)
+
+    def remove_images(self, deployment_namespace: str, dangling: bool = None):
+        """
+        Remove the images built for a deployment, dangling=True only removes the ones
+        which newer builds replaced.
+        """
+        docker_client = get_docker_client()
+        try:
+            images = docker_client.list_images(
+                labels=[f"{constants.BUILD_NAMESPACE_LABEL}={deployment_namespace}"],
+                dangling=dangling,
+            )
+        except DockerEngineError as e:
+            logger.warning(f"Cannot list images of {deployment_namespace}: {e}")
+            return
+        for image in images:
+            tags = [
+                tag for tag in image.get("RepoTags") or [] if tag != "<none>:<none>"
+            ]
+            # Images shared as the project's build cache only lose the branch tag
+            references = [
+                tag for tag in tags if not tag.endswith(f":{constants.BUILD_CACHE_TAG}")
+            ]
+            if not tags:
+                references = [image["Id"]]
+            for reference in references:
+                try:
+                    docker_client.remove_image(reference)
+                except DockerEngineError as e:
+                    logger.warning(f"Cannot remove image {reference}: {e}")
 
     def _write_compose_file(self):
         with open(self._compose_file_location, "w") as yaml_file:
-            # Dump the data to the YAML file
-            yaml.dump(self._compose, yaml_file, default_flow_style=False)
+            dump_yaml(self._compose, yaml_file)
 
         logger.info(f"YAML data written to {self._compose_file_location} successfully.")
 
+    def _exposed_ports(self) -> typing.Dict[str, typing.List[PortMapping]]:
+        # nginx proxies HTTP, UDP ports can't be exposed through it
+        exposed = {}
+        for service, mappings in self._service_ports.items():
+            tcp_mappings = [
+                mapping for mapping in mappings if mapping.protocol == "tcp"
+            ]
+            if tcp_mappings:
+                exposed[service] = tcp_mappings
+        return exposed
+
     def get_service_ports_config(
         self,
-    ) -> typing.Dict[str, typing.List[typing.Tuple[int, int]]]:
-        services = {}
-        for service in self._compose["services"]:
-            if service not in services:
-                services[service] = []
+    ) -> typing.Dict[str, typing.List[typing.Tuple[str, str]]]:
+        """
+        (URL port, container port) of the TCP ports every service publishes.
+        """
+        exposed = self._exposed_ports()
+        return {
+            service: [
+                (mapping.url_port, mapping.target)
+                for mapping in exposed.get(service, [])
+            ]
+            for service in self._service_ports
+        }
 
-            port_mappings = []
+    @staticmethod
+    def _labels(service: typing.Dict) -> typing.Dict[str, typing.Any]:
+        labels = service.get("labels") or {}
+        if isinstance(labels, list):
+            return dict(
+                label.split("=", 1) if "=" in label else (label, "") for label in labels
+            )
+        return labels
+
+    @staticmethod
+    def _proxy_setting_value(value: typing.Any) -> str:
+        # YAML reads off and on as booleans
+        if isinstance(value, bool):
+            return "on" if value else "off"
+        return str(value).strip()
+
+    def get_service_proxy_settings(self) -> typing.Dict[str, typing.Dict[str, str]]:
+        """
+        nginx directives of the proxies in front of every service, from its sarthi.proxy.*
+        labels. Unknown settings and values which are not plain words are refused.
+        """
+        settings = {}
+        for service, config in self._compose["services"].items():
+            service_settings = {}
+            for label, value in self._labels(config).items():
+                if not label.startswith(constants.PROXY_SETTING_LABEL_PREFIX):
+                    continue
+                name = label[len(constants.PROXY_SETTING_LABEL_PREFIX) :]  # noqa: E203
+                value = self._proxy_setting_value(value)
+                if (
+                    name not in constants.PROXY_SETTINGS
+                    or not PROXY_SETTING_VALUE_PATTERN.fullmatch(value)
+                ):
+                    raise HTTPException(
+                        400, f"Invalid proxy setting {label}: {value} of {service}"
+                    )
+                service_settings[constants.PROXY_SETTINGS[name]] = value
+            if service_settings:
+                settings[service] = service_settings
+        return settings
 
-            if "ports" in self._compose["services"][service]:
-                port_mappings = self._compose["services"][service]["ports"]
 
-            for port_mapping in port_mappings:
-                ports = port_mapping.split(":")
-                services[service].append((ports[-2], ports[-1]))
-        return services
+@dataclass
+class _ServiceRoute:
+    service: str
+    port: str
+    proxy_settings: typing.Dict[str, str]
 
 
 class NginxHelper:
@@ -193,31 +663,35 @@ class NginxHelper:
         str
     ] = """
             location / {
-                proxy_pass http://%s:%s;
+                proxy_pass http://%s;
+                proxy_http_version 1.1;
+                proxy_set_header Upgrade $http_upgrade;
+                proxy_set_header Connection $sarthi_connection_upgrade;
                 proxy_set_header Host $host;
                 proxy_set_header X-Real-IP $remote_addr;
                 proxy_set_header X-Forwarded-For $proxy_add_x_forwarded_for;
-                proxy_set_header X-Forwarded-Proto $scheme;
+                proxy_set_header X-Forwarded-Proto $scheme;%s
             }
     """
 
-    PROJECT_BLOCK_TEMPLATE: typing.Final[
+    UPSTREAM_BLOCK_TEMPLATE: typing.Final[
         str
     ] = """
-    server {
-        listen 80;
-        server_name %s;
-
-        location / {
-            proxy_pass http://%s:%s;
-            proxy_set_header Host $host;
-            proxy_set_header X-Real-IP $remote_addr;
-            proxy_set_header X-Forwarded-For $proxy_add_x_forwarded_for;
-            proxy_set_header X-Forwarded-Proto $scheme;
-        }
+    upstream %s {
+        server %s:%s;%s
     }
     """
 
+    # Upgrade websockets, otherwise leave the connection to the service open
+    CONNECTION_UPGRADE_MAP: typing.Final[
+        str
+    ] = """
+map $http_upgrade $sarthi_connection_upgrade {
+    default upgrade;
+    "" "";
+}
+"""
+
     def __init__(
         self,
         config: DeploymentConfig,
@@ -238,128 +712,301 @@ class NginxHelper:
         )
 
         self._project_hash = config.get_project_hash()
+        self._deployment_namespace = config.get_deployment_namespace()
         self._port = None
         self._host_name = (
             os.environ.get("DEPLOYMENT_HOST") or constants.DOCKER_HOST_NETWORK_DOMAIN
         )
-        self._start_port = (
-            os.environ.get("DEPLOYMENT_PORT_START")
-            or constants.DEFAULT_DEPLOYMENT_PORT_START
-        )
-        self._end_port = (
-            os.environ.get("DEPLOYMENT_PORT_END")
-            or constants.DEFAULT_DEPLOYMENT_PORT_END
-        )
+        self._port_registry = get_port_registry()
         self._DOMAIN_NAME = os.environ.get("DOMAIN_NAME") or constants.LOCALHOST
         self._DOCKER_INTERNAL_HOSTNAME: typing.Final[
             str
         ] = constants.DOCKER_HOST_NETWORK_DOMAIN
         self._outer_conf_base_path = outer_conf_base_path
         self._deployment_project_path = deployment_project_path
-        self._conf_file_name = f"{self._project_name}-{self._project_hash}.conf"
-        self._outer_proxy_path = os.path.join(
-            self._outer_conf_base_path, self._conf_file_name
-        )
+        self._route_name = f"{self._project_name}-{self._project_hash}"
+        self._conf_file_name = f"{self._route_name}.conf"
+        self._routing_table = RoutingTable(self._outer_conf_base_path)
+        self._outer_proxy_path = self._routing_table.route_path(self._route_name)
         self._deployment_proxy_path = os.path.join(
             self._deployment_project_path, self._conf_file_name
         )
+        # hostname -> service route of the exposed services, read from the project proxy conf
+        # if it was not generated by this helper
+        self._service_routes: typing.Optional[typing.Dict[str, _ServiceRoute]] = None
+        self._direct_routing = is_direct_routing()
+        self._access_log_name = os.path.join(
+            constants.ACCESS_LOGS_DIR, f"{self._route_name}.log"
+        )
+        self._access_log_path = os.path.join(
+            self._outer_conf_base_path, self._access_log_name
+        )
+        # Access logs are only needed to find idle deployments
+        self._track_access = (
+            float(os.environ.get("HIBERNATE_IDLE_MINUTES") or 0) > 0
+            or float(os.environ.get("GC_MAX_IDLE_HOURS") or 0) > 0
+        )
 
-    def find_free_port(self) -> str:
-        current_port = self._start_port
+    def _is_port_free(self, port: int) -> bool:
+        # Guards against ports taken by processes which are not managed by Sarthi
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+            try:
+                s.connect((self._host_name, port))
+                return False
+            except ConnectionRefusedError:
+                return True
 
-        while current_port <= self._end_port:
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                try:
-                    s.connect((self._host_name, current_port))
-                    s.close()
-                    current_port += 1
-                except ConnectionRefusedError:
-                    self._port = current_port
-                    return str(current_port)
-
-        logger.error("Could not find a free port in the specified range")
-        raise HTTPException(500, "Could not find a free port in the specified range")
-
-    def generate_outer_proxy_conf_file(self, port: str) -> str:
-        port = port or self._port
-        server_name_regex = f"~{self._project_hash}.{self._DOMAIN_NAME}"
-        conf = NginxHelper.PROJECT_BLOCK_TEMPLATE % (
-            server_name_regex,
-            self._DOCKER_INTERNAL_HOSTNAME,
-            port,
+    def find_free_port(self) -> str:
+        self._port = self._port_registry.allocate(
+            self._deployment_namespace, self._is_port_free
         )
+        return str(self._port)
 
-        with open(self._outer_proxy_path, "w") as file:
-            file.write(conf)
+    def release_port(self):
+        self._port_registry.release(self._deployment_namespace)
 
-        if not self._test_nginx_config():
-            os.remove(self._outer_proxy_path)
-            logger.error("Failed creating outer_proxy_conf_file. Check with admin")
-            raise HTTPException(
-                500, "Failed creating outer_proxy_conf_file. Check with admin"
+    @staticmethod
+    def _parse_service_routes(conf: str) -> typing.Dict[str, _ServiceRoute]:
+        upstreams = {
+            name: (service, port)
+            for name, service, port in re.findall(
+                r"upstream\s+(\S+)\s*\{\s*server\s+([^:;\s]+):(\d+);", conf
             )
-        return conf
+        }
+        proxy_directives = set(constants.PROXY_SETTINGS.values())
+        service_routes = {}
+        # Older project proxy confs have regex server names and proxy to service:port
+        for host, location in re.findall(
+            r"server_name\s+~?([^\s;]+);\s*location / \{([^}]*)\}", conf
+        ):
+            upstream = re.search(r"proxy_pass http://([^;\s]+);", location).group(1)
+            service, _, port = upstream.partition(":")
+            if upstream in upstreams:
+                service, port = upstreams[upstream]
+            service_routes[host] = _ServiceRoute(
+                service,
+                port,
+                {
+                    directive: value
+                    for directive, value in re.findall(r"(\w+)\s+([^;]+);", location)
+                    if directive in proxy_directives
+                },
+            )
+        return service_routes
+
+    def _read_service_routes(self) -> typing.Dict[str, _ServiceRoute]:
+        if self._service_routes is None:
+            try:
+                with open(self._deployment_proxy_path) as file:
+                    self._service_routes = self._parse_service_routes(file.read())
+            except FileNotFoundError:
+                self._service_routes = {}
+        return self._service_routes
+
+    def _route(self, **route) -> typing.Dict:
+        service_routes = self._read_service_routes()
+        route = {
+            "namespace": self._deployment_namespace,
+            "hosts": list(service_routes),
+            **route,
+        }
+        proxy_settings = {
+            host: service_route.proxy_settings
+            for host, service_route in service_routes.items()
+            if service_route.proxy_settings
+        }
+        if proxy_settings:
+            route["proxy"] = proxy_settings
+        if self._track_access:
+            # Touch the log so a deployment nobody visited counts as accessed when it was deployed
+            os.makedirs(os.path.dirname(self._access_log_path), exist_ok=True)
+            pathlib.Path(self._access_log_path).touch()
+            route["access_log"] = self._access_log_name
+        self._routing_table.write_route(self._route_name, route)
+        return route
+
+    def generate_outer_proxy_conf_file(self, port: str = None) -> typing.Dict:
+        """
+        Route the hostnames of the deployment to its project proxy, or straight to the services
+        in direct routing mode. The route is added to the routing table and validated by the
+        next reload_nginx(new_outer_proxy=True) call.
+        """
+        if self._direct_routing:
+            servers = {}
+            for host, service_route in self._read_service_routes().items():
+                service_host = get_service_host(
+                    self._deployment_namespace, service_route.service
+                )
+                servers[host] = f"{service_host}:{service_route.port}"
+            return self._route(servers=servers)
+        return self._route(
+            host=self._DOCKER_INTERNAL_HOSTNAME, port=str(port or self._port)
+        )
+
+    def generate_wake_proxy_conf_file(self) -> typing.Dict:
+        """
+        Route the deployment's hostnames to Sarthi's wake endpoint while its stack is stopped.
+        """
+        return self._route(hibernated=True)
+
+    def _read_route(self) -> typing.Optional[typing.Dict]:
+        return self._routing_table.read_route(self._route_name)
+
+    def has_route(self) -> bool:
+        return self._read_route() is not None
+
+    def is_hibernated(self) -> bool:
+        route = self._read_route()
+        return bool(route and route.get("hibernated"))
+
+    def last_access(self) -> typing.Optional[float]:
+        """
+        Time of the last request to the deployment, None if its access is not tracked.
+        The access log is only used for its mtime and is truncated once it grows too big,
+        nginx opens it in append mode so it keeps writing from the start.
+        """
+        if not os.path.exists(self._outer_proxy_path):
+            return None
+        try:
+            stat = os.stat(self._access_log_path)
+        except FileNotFoundError:
+            return None
+        if stat.st_size > constants.ACCESS_LOG_MAX_BYTES:
+            os.truncate(self._access_log_path, 0)
+        return stat.st_mtime
+
+    def wait_for_port(self, port: str, timeout_seconds: float):
+        deadline = time.monotonic() + timeout_seconds
+        while self._is_port_free(int(port)):
+            if time.monotonic() > deadline:
+                logger.error(f"Project proxy on port {port} did not come up")
+                raise HTTPException(
+                    500, f"Deployment did not come up within {timeout_seconds}s"
+                )
+            time.sleep(1)
 
     def generate_project_proxy_conf_file(
         self,
         services: typing.Dict[str, typing.List[typing.Tuple[int, int]]],
+        proxy_settings: typing.Dict[str, typing.Dict[str, str]] = None,
     ) -> typing.Tuple[str, typing.List[str]]:
+        """
+        proxy_settings are the nginx directives of every service, see
+        ComposeHelper.get_service_proxy_settings.
+        """
+        proxy_settings = proxy_settings or {}
         urls: typing.List[str] = []
+        service_routes: typing.Dict[str, _ServiceRoute] = {}
+        upstreams: typing.Dict[str, str] = {}
         routes = ""
         for service, ports_mappings in services.items():
+            service_settings = proxy_settings.get(service, {})
             for ports in ports_mappings:
-                routes_block = NginxHelper.ROUTES_BLOCK_TEMPLATE % (
+                # Named upstreams keep connections to the service alive between requests
+                upstream = f"sarthi_{service}_{ports[1]}"
+                upstreams[upstream] = NginxHelper.UPSTREAM_BLOCK_TEMPLATE % (
+                    upstream,
                     service,
                     ports[1],
+                    keepalive_directive(" " * 8),
+                )
+                routes_block = NginxHelper.ROUTES_BLOCK_TEMPLATE % (
+                    upstream,
+                    proxy_directives(service_settings, " " * 16),
                 )
 
                 service_url = f"{self._project_name}-{self._branch_name}-{ports[0]}-{self._project_hash}.{self._DOMAIN_NAME}"
-                server_name_regex = f"~{service_url}"
                 urls.append(f"http://{service_url}")
+                service_routes[service_url] = _ServiceRoute(
+                    service, str(ports[1]), service_settings
+                )
 
+                # Exact server names are looked up in a hash, regex ones are tried one by one
                 server_block = NginxHelper.SERVER_BLOCK_TEMPLATE % (
-                    server_name_regex,
+                    service_url,
                     routes_block,
                 )
                 routes += server_block
 
+        self._service_routes = service_routes
         with open(self._deployment_proxy_path, "w") as file:
-            file.write(routes)
+            file.write(
+                f"server_names_hash_bucket_size {hash_bucket_size(service_routes)};\n"
+                f"{NginxHelper.CONNECTION_UPGRADE_MAP}{''.join(upstreams.values())}{routes}"
+            )
 
         return str(self._deployment_proxy_path), urls
 
-    def _test_nginx_config(self):
+    @staticmethod
+    @track_phase("nginx_test")
+    def _test_nginx_config():
         try:
-            subprocess.run(
-                ["docker", "exec", "sarthi_nginx", "nginx", "-t"],
-                check=True,
-                capture_output=True,
-                text=True,
+            exit_code, output = get_docker_client().exec_run(
+                constants.SARTHI_NGINX_CONTAINER, ["nginx", "-t"]
             )
-            return True
-        except subprocess.CalledProcessError as e:
+        except DockerEngineError as e:
             logger.error(f"Error testing Nginx configuration: {e}")
+            raise HTTPException(500, "Internal Server Error")
+        if exit_code != 0:
+            logger.error(f"Error testing Nginx configuration: {output}")
             raise HTTPException(
                 500,
                 "Error in generated Nginx configs. Check with Sarthi Admin or see logs.",
             )
-        except Exception as e:
-            logger.error(f"Error testing Nginx configuration: {e}")
-            raise HTTPException(500, "Internal Server Error")
+        return True
 
-    def reload_nginx(self):
-        self._test_nginx_config()
+    def reload_nginx(self, new_outer_proxy: bool = False):
+        """
+        Reload nginx along with any other deployment asking for a reload at the same time.
+        With new_outer_proxy the outer proxy conf of this deployment is validated and removed
+        if it breaks the nginx config.
+        """
+        nginx_reload_coordinator.reload(
+            self,
+            self._outer_proxy_path if new_outer_proxy else None,
+            self._outer_conf_base_path,
+        )
+
+    @staticmethod
+    @track_phase("nginx_reload")
+    def _reload_nginx():
         try:
-            subprocess.run(
-                ["docker", "exec", "sarthi_nginx", "nginx", "-s", "reload"],
-                check=True,
+            exit_code, output = get_docker_client().exec_run(
+                constants.SARTHI_NGINX_CONTAINER, ["nginx", "-s", "reload"]
             )
-        except Exception as e:
+        except DockerEngineError as e:
             logger.error(e)
             raise HTTPException(500, "Failed to reload Nginx for the deployment")
+        if exit_code != 0:
+            logger.error(f"Error reloading Nginx: {output}")
+            raise HTTPException(500, "Failed to reload Nginx for the deployment")
         logger.info("Nginx reloaded successfully.")
 
+    @classmethod
+    def reload_outer_nginx(cls, outer_conf_base_path: str):
+        """
+        Reload nginx for routes changed outside of a deployment, like removed orphans.
+        """
+        nginx_reload_coordinator.reload(cls, outer_conf_dir=outer_conf_base_path)
+
+    @property
+    def outer_proxy_conf_name(self) -> str:
+        return os.path.basename(self._outer_proxy_path)
+
+    def reserved_port(self) -> typing.Optional[str]:
+        port = self._port_registry.get(self._deployment_namespace)
+        return str(port) if port else None
+
+    def outer_proxy_port(self) -> typing.Optional[str]:
+        route = self._read_route()
+        if not route or route.get("hibernated"):
+            return None
+        # Routes straight to the services have no port
+        return route.get("port")
+
     def remove_outer_proxy(self):
+        if os.path.exists(self._access_log_path):
+            os.remove(self._access_log_path)
         if not os.path.exists(self._outer_proxy_path):
             logger.info(f"{self._outer_proxy_path} already deleted!")
             return
@@ -369,6 +1016,139 @@ class NginxHelper:
             logger.debug(f"Exception removing outer proxy {e}")
 
 
+@dataclass
+class _ReloadRequest:
+    conf_path: typing.Optional[str] = None
+    outer_conf_dir: typing.Optional[str] = None
+    done: bool = False
+    error: typing.Optional[HTTPException] = None
+
+
+class NginxReloadCoordinator:
+    """
+    Batches nginx reloads of concurrent deployments - while one reload runs, every deployment
+    asking for a reload waits and the next reload is done once for all of them.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._pending: typing.List[_ReloadRequest] = []
+        self._reloading = False
+
+    def reload(
+        self,
+        nginx_helper: "NginxHelper",
+        conf_path: str = None,
+        outer_conf_dir: str = None,
+    ):
+        """
+        conf_path is the route of a deployment to validate, the routing table of outer_conf_dir
+        is generated again before nginx is tested.
+        """
+        request = _ReloadRequest(conf_path, outer_conf_dir)
+        with self._condition:
+            self._pending.append(request)
+            while self._reloading and not request.done:
+                self._condition.wait()
+            is_leader = not request.done
+            if is_leader:
+                self._reloading = True
+
+        if is_leader:
+            self._reload_pending(nginx_helper)
+
+        if request.error:
+            raise request.error
+
+    def _reload_pending(self, nginx_helper: "NginxHelper"):
+        # Give deployments finishing at the same time a chance to join this batch
+        time.sleep(
+            float(
+                os.environ.get("NGINX_RELOAD_DEBOUNCE_SECONDS")
+                or constants.DEFAULT_NGINX_RELOAD_DEBOUNCE_SECONDS
+            )
+        )
+        with self._condition:
+            batch, self._pending = self._pending, []
+        try:
+            self._reload_batch(nginx_helper, batch)
+        finally:
+            with self._condition:
+                for request in batch:
+                    request.done = True
+                self._reloading = False
+                self._condition.notify_all()
+
+    @staticmethod
+    def _write_routing_tables(batch: typing.List[_ReloadRequest]):
+        for outer_conf_dir in {request.outer_conf_dir for request in batch}:
+            if outer_conf_dir:
+                RoutingTable(outer_conf_dir).write()
+
+    def _test_routes(
+        self, nginx_helper: "NginxHelper", batch: typing.List[_ReloadRequest]
+    ):
+        self._write_routing_tables(batch)
+        nginx_helper._test_nginx_config()
+
+    def _reload_batch(
+        self, nginx_helper: "NginxHelper", batch: typing.List[_ReloadRequest]
+    ):
+        logger.debug(f"Reloading nginx for {len(batch)} deployments")
+        try:
+            self._test_routes(nginx_helper, batch)
+        except HTTPException:
+            self._reject_invalid_confs(nginx_helper, batch)
+
+        if all(request.error for request in batch):
+            return
+        try:
+            nginx_helper._reload_nginx()
+        except HTTPException as e:
+            for request in batch:
+                request.error = request.error or e
+
+    def _reject_invalid_confs(
+        self, nginx_helper: "NginxHelper", batch: typing.List[_ReloadRequest]
+    ):
+        """
+        Slow path when the batch breaks the nginx config - park all new routes, then bring them
+        back one at a time and remove the ones nginx rejects.
+        """
+        new_confs = [
+            request
+            for request in batch
+            if request.conf_path and os.path.exists(request.conf_path)
+        ]
+        for request in new_confs:
+            os.replace(request.conf_path, f"{request.conf_path}.pending")
+
+        try:
+            self._test_routes(nginx_helper, batch)
+        except HTTPException as e:
+            logger.error("Nginx config is broken even without the new confs")
+            for request in new_confs:
+                os.remove(f"{request.conf_path}.pending")
+            for request in batch:
+                request.error = e
+            return
+
+        for request in new_confs:
+            os.replace(f"{request.conf_path}.pending", request.conf_path)
+            try:
+                self._test_routes(nginx_helper, batch)
+            except HTTPException:
+                os.remove(request.conf_path)
+                self._write_routing_tables(batch)
+                logger.error(f"Failed creating {request.conf_path}. Check with admin")
+                request.error = HTTPException(
+                    500, "Failed creating outer_proxy_conf_file. Check with admin"
+                )
+
+
+nginx_reload_coordinator = NginxReloadCoordinator()
+
+
 class SecretsHelper:
     def __init__(self, project_name, branch_name, project_path):
         vault_url = os.environ.get("VAULT_BASE_URL")
@@ -387,9 +1167,10 @@ class SecretsHelper:
         )
         self._headers = {"X-Vault-Token": vault_token}
 
+    @track_phase("vault_write")
     def _write_secrets_to_vault(self, secret_path_url, secrets: typing.Dict):
         try:
-            response = requests.post(
+            response = get_vault_session().post(
                 url=secret_path_url,
                 headers=self._headers,
                 data=json.dumps(
@@ -397,15 +1178,31 @@ class SecretsHelper:
                 ),
             )
             response.raise_for_status()
-        except requests.HTTPError as e:
-            logger.error(f"Error writing secrets to {secret_path_url}", e)
-            raise HTTPException(500, e)
+        except requests.RequestException as e:
+            logger.error(f"Error writing secrets to {secret_path_url}: {e}")
+            raise HTTPException(500, str(e))
+        finally:
+            get_secrets_cache().invalidate(secret_path_url)
 
+    @track_phase("vault_read")
     def _read_secrets_from_vault(self, secret_path_url):
         try:
-            response = requests.get(url=secret_path_url, headers=self._headers)
-        except requests.HTTPError:
-            logger.error(f"Cannot read secrets from vault for {secret_path_url}")
+            response = get_vault_session().get(
+                url=secret_path_url, headers=self._headers
+            )
+        except requests.RequestException as e:
+            logger.error(f"Cannot read secrets from vault for {secret_path_url}: {e}")
+            raise HTTPException(
+                500, f"Cannot read secrets from vault for {secret_path_url}"
+            )
+        return self._secrets_from_response(secret_path_url, response)
+
+    @staticmethod
+    def _secrets_from_response(
+        secret_path_url, response
+    ) -> typing.Optional[typing.Dict]:
+        if response.status_code >= 500:
+            logger.error(f"Vault returned {response.status_code} for {secret_path_url}")
             raise HTTPException(
                 500, f"Cannot read secrets from vault for {secret_path_url}"
             )
@@ -414,21 +1211,56 @@ class SecretsHelper:
         res_json = response.json()
         return res_json["data"]["data"]
 
+    def _read_default_secrets(self):
+        """
+        default-dev-secrets rarely change and are read for every deploy of every branch,
+        so they are served from the secrets cache and stale copies are used if Vault is down.
+        """
+        secrets_cache = get_secrets_cache()
+        cached_secrets = secrets_cache.get(self._default_secret_url)
+        if cached_secrets:
+            return cached_secrets
+        try:
+            secrets = self._read_secrets_from_vault(self._default_secret_url)
+        except HTTPException:
+            stale_secrets = secrets_cache.get_stale(self._default_secret_url)
+            if not stale_secrets:
+                raise
+            logger.warning(
+                f"Vault unreachable, using cached {self._default_secret_url}"
+            )
+            return stale_secrets
+        self._cache_default_secrets(secrets)
+        return secrets
+
+    def _cache_default_secrets(self, secrets: typing.Optional[typing.Dict]):
+        if secrets:
+            get_secrets_cache().set(
+                self._default_secret_url,
+                secrets,
+                float(
+                    os.environ.get("SECRETS_CACHE_TTL_SECONDS")
+                    or constants.DEFAULT_SECRETS_CACHE_TTL_SECONDS
+                ),
+            )
+
+    def _load_sample_envs(self) -> typing.Dict:
+        # check for .env.sample in folder and load those sample .env vars in vault
+        for sample_env_filename in constants.SAMPLE_ENV_FILENAMES:
+            sample_env_path = os.path.join(self._project_path, sample_env_filename)
+            if os.path.exists(sample_env_path):
+                return dotenv_values(sample_env_path)
+        return {"key": "secret-value"}
+
     def _create_env_placeholder(self):
         # check whether we can copy env vars from the default-dev-secrets path
-        default_response = self._read_secrets_from_vault(self._default_secret_url)
+        default_response = self._read_default_secrets()
 
         if not default_response:
             logger.debug(
                 "Default secrets not found, ingesting secrets from sample envs"
             )
-            # check for .env.sample in folder and load those sample .env vars in vault
-            sample_envs = {"key": "secret-value"}
-            for sample_env_filename in constants.SAMPLE_ENV_FILENAMES:
-                sample_env_path = os.path.join(self._project_path, sample_env_filename)
-                if os.path.exists(sample_env_path):
-                    sample_envs = dotenv_values(sample_env_path)
-                    break
+            sample_envs = self._load_sample_envs()
             self._write_secrets_to_vault(self._default_secret_url, sample_envs)
             self._write_secrets_to_vault(self._secret_url, sample_envs)
             return sample_envs
@@ -444,13 +1276,18 @@ class SecretsHelper:
             secret_data = self._create_env_placeholder()
 
         logger.info(f"Found secrets for {self._secrets_namespace}")
+        self._write_env_file(project_path, secret_data)
+
+    @staticmethod
+    def _write_env_file(project_path: str, secret_data: typing.Dict):
         with open(os.path.join(project_path, ".env"), "w") as file:
             for key, value in secret_data.items():
                 file.write(f'{key}="{value}"\n')
 
+    @track_phase("vault_delete")
     def cleanup_deployment_variables(self):
         try:
-            response = requests.delete(
+            response = get_vault_session().delete(
                 url=self._secret_metadata_url, headers=self._headers
             )
             logger.debug(
@@ -458,19 +1295,248 @@ class SecretsHelper:
             )
             response.raise_for_status()
             return response
-        except requests.HTTPError as e:
+        except requests.RequestException as e:
             logger.error(f"Error removing deployment secrets {e}")
 
 
+class GitMirrorHelper:
+    """
+    Keeps one bare mirror per project under DEPLOYMENTS_MOUNT_DIR, branch checkouts are
+    cloned from it with --shared so they reuse its object database instead of keeping their own.
+    """
+
+    def __init__(self, config: DeploymentConfig, deployments_mount_dir: str):
+        self._config = config
+        mirror_name = (
+            f"{config.project_name}_{get_random_stub(config.project_name, 10)}.git"
+        )
+        self._mirror_path = os.path.join(
+            deployments_mount_dir, constants.GIT_MIRRORS_DIR, mirror_name
+        )
+        self._lock = filelock.FileLock(
+            os.path.join(
+                os.environ.get("LOCK_FILE_BASE_PATH") or "/tmp",
+                f"{mirror_name}.lock",
+            )
+        )
+
+    @property
+    def mirror_path(self) -> str:
+        return self._mirror_path
+
+    def _run_git_command(self, *args: str) -> str:
+        process = subprocess.run(
+            ["git", "--git-dir", self._mirror_path, *args],
+            check=True,
+            capture_output=True,
+            text=True,
+        )
+        return process.stdout
+
+    def sync(self, branch: str):
+        """
+        Fetch the branch from the project remote into the mirror, the remote URL is passed on every
+        fetch and never stored so rotated GitHub tokens don't break the mirror.
+        """
+        with self._lock:
+            try:
+                if not os.path.exists(self._mirror_path):
+                    os.makedirs(os.path.dirname(self._mirror_path), exist_ok=True)
+                    subprocess.run(
+                        ["git", "init", "--bare", self._mirror_path],
+                        check=True,
+                        capture_output=True,
+                    )
+                self._run_git_command(
+                    "fetch",
+                    "--prune",
+                    self._config.project_git_url,
+                    f"+refs/heads/{branch}:refs/heads/{branch}",
+                )
+            except subprocess.CalledProcessError as e:
+                logger.error(
+                    f"Error syncing mirror {self._mirror_path} for {branch}: {e.stderr}"
+                )
+                raise HTTPException(
+                    500,
+                    strip_credentials(
+                        f"Fetching the Git repo failed {self._config.project_git_url}:{branch} {e.stderr}"
+                    ),
+                )
+        logger.info(f"Synced mirror {self._mirror_path} for {branch}")
+
+    def release(self, branch: str):
+        """
+        Forget the branch in the mirror and remove the mirror once no branch of the project is deployed.
+        """
+        if not os.path.exists(self._mirror_path):
+            return
+        with self._lock:
+            try:
+                self._run_git_command("update-ref", "-d", f"refs/heads/{branch}")
+                remaining_branches = self._run_git_command(
+                    "for-each-ref", "--format=%(refname)", "refs/heads"
+                ).strip()
+            except subprocess.CalledProcessError as e:
+                logger.debug(f"Error releasing {branch} from mirror: {e.stderr}")
+                return
+            if remaining_branches:
+                return
+            logger.info(f"No deployments left, removing mirror {self._mirror_path}")
+            shutil.rmtree(self._mirror_path, ignore_errors=True)
+
+
 def get_random_stub(project_name: str, length: int = 64) -> str:
     hash_string = hashlib.md5(project_name.encode()).hexdigest()
     return hash_string[:length] if length else hash_string
 
 
+def get_image_repository(project_name: str, service_name: str) -> str:
+    # Repository path components are lowercase alphanumerics with single separators
+    components = [
+        re.sub(r"[^a-z0-9]+", "-", name.lower()).strip("-") or "default"
+        for name in [project_name, service_name]
+    ]
+    return "/".join([constants.IMAGE_REPOSITORY_PREFIX, *components])
+
+
+def get_service_host(deployment_namespace: str, service_name: str) -> str:
+    """
+    Network alias of an exposed service in direct routing mode, unique across deployments.
+    """
+    project_hash = deployment_namespace.rsplit("_", 1)[-1]
+    service = re.sub(r"[^a-z0-9-]+", "-", service_name.lower()).strip("-") or "default"
+    return f"sarthi-{project_hash}-{service}"
+
+
+def is_direct_routing() -> bool:
+    routing_mode = os.environ.get("ROUTING_MODE") or constants.ROUTING_MODE_PROXY
+    return routing_mode.lower() == constants.ROUTING_MODE_DIRECT
+
+
+def get_image_tag(branch_name: str) -> str:
+    tag = re.sub(r"[^a-zA-Z0-9_.-]", "-", branch_name).lstrip(".-")[:128]
+    return tag or "default"
+
+
+def parse_deployment_namespace(
+    namespace: str,
+) -> typing.Optional[typing.Tuple[str, str]]:
+    """
+    Recover (project_name, branch_name) from a project_branch_hash namespace.
+    Both names may contain underscores, so every split is tried against the hash.
+    """
+    names, _, project_hash = namespace.rpartition("_")
+    if len(project_hash) != constants.PROJECT_HASH_LENGTH:
+        return None
+    for i, char in enumerate(names):
+        if char != "_":
+            continue
+        project_name, branch_name = names[:i], names[i + 1 :]  # noqa: E203
+        if (
+            get_random_stub(
+                f"{project_name}:{branch_name}", constants.PROJECT_HASH_LENGTH
+            )
+            == project_hash
+        ):
+            return project_name, branch_name
+    return None
+
+
+def list_deployment_namespaces(deployments_mount_dir: str) -> typing.List[str]:
+    if not os.path.isdir(deployments_mount_dir):
+        return []
+    # Dot directories hold Sarthi's own state, like the port registry and git mirrors
+    return sorted(
+        entry.name
+        for entry in os.scandir(deployments_mount_dir)
+        if entry.is_dir() and not entry.name.startswith(".")
+    )
+
+
+def list_compose_stacks(
+    deployments_mount_dir: str,
+) -> typing.Dict[str, typing.Set[str]]:
+    """
+    Names of the compose projects with containers, running or not, per deployment namespace
+    their working directory is in. Stacks outside of the deployments directory are not Sarthi's.
+    """
+    mount_dir = os.path.abspath(deployments_mount_dir)
+    stacks: typing.Dict[str, typing.Set[str]] = {}
+    for container in get_docker_client().list_containers(
+        labels=["com.docker.compose.project"]
+    ):
+        labels = container.get("Labels") or {}
+        working_dir = labels.get("com.docker.compose.project.working_dir")
+        if not working_dir:
+            continue
+        relative_path = os.path.relpath(working_dir, mount_dir)
+        namespace = relative_path.split(os.sep)[0]
+        if namespace.startswith("."):
+            continue
+        stacks.setdefault(namespace, set()).add(labels["com.docker.compose.project"])
+    return stacks
+
+
+def _checkout_branch(checkout_path: str) -> typing.Optional[str]:
+    try:
+        with open(os.path.join(checkout_path, ".git", "HEAD")) as file:
+            head = file.read().strip()
+    except OSError:
+        return None
+    prefix = "ref: refs/heads/"
+    return head[len(prefix) :] if head.startswith(prefix) else None  # noqa: E203
+
+
+def get_deployment_config(
+    deployments_mount_dir: str, namespace: str
+) -> typing.Optional[DeploymentConfig]:
+    """
+    Config of an existing deployment, for acting on it without a request from its repository.
+    rest_action is DELETE, so a Deployer built from it does not sync the checkout.
+    """
+    names = parse_deployment_namespace(namespace)
+    if not names:
+        return None
+    project_name, branch_name = names
+    # Namespaces only keep the sanitised branch name, the checkout knows the real one
+    checkout_branch = _checkout_branch(os.path.join(deployments_mount_dir, namespace))
+    for branch in [checkout_branch, branch_name]:
+        if not branch:
+            continue
+        config = DeploymentConfig(
+            project_name=project_name,
+            branch_name=branch,
+            project_git_url="",
+            rest_action=constants.DELETE,
+        )
+        if config.get_deployment_namespace() == namespace:
+            return config
+    return None
+
+
+def parse_memory_size(size: str) -> int:
+    """
+    Bytes in a docker style memory size like 512m or 2g.
+    """
+    match = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([bkmgt]?)b?\s*", str(size).lower())
+    if not match:
+        raise ValueError(f"Invalid memory size {size}")
+    number, unit = match.groups()
+    return int(float(number) * 1024 ** "bkmgt".index(unit or "b"))
+
+
+def get_env_flag(name: str, default: bool = False) -> bool:
+    value = os.environ.get(name)
+    if not value:
+        return default
+    return value.strip().lower() in ["1", "true", "yes", "on"]
+
+
 def load_yaml_file(filename: str):
     try:
         with open(filename) as file:
-            return yaml.safe_load(file)
+            return load_yaml(file)
     except FileNotFoundError as e:
         logging.error(f"File not found: {filename}. Error: {str(e)}")
         raise HTTPException(
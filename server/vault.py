@@ -0,0 +1,247 @@
+import asyncio
+import collections
+import os
+import threading
+import time
+import typing
+import weakref
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import server.constants as constants
+
+from .metrics import VAULT_REQUEST_SECONDS, VAULT_REQUESTS
+
+
+class VaultSession(requests.Session):
+    """
+    requests.Session for talking to Vault - keeps connections alive, applies a default timeout
+    and retries connection errors and 5xx responses with exponential backoff.
+    """
+
+    def __init__(
+        self,
+        connect_timeout: float = constants.DEFAULT_VAULT_CONNECT_TIMEOUT_SECONDS,
+        read_timeout: float = constants.DEFAULT_VAULT_READ_TIMEOUT_SECONDS,
+        max_retries: int = constants.DEFAULT_VAULT_MAX_RETRIES,
+        backoff_factor: float = constants.DEFAULT_VAULT_RETRY_BACKOFF_SECONDS,
+        pool_size: int = constants.DEFAULT_VAULT_POOL_SIZE,
+    ):
+        super().__init__()
+        self._timeout = (connect_timeout, read_timeout)
+        retry = Retry(
+            total=max_retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=[500, 502, 503, 504],
+            allowed_methods=["GET", "POST", "DELETE"],
+            # Hand the last response back instead of raising, callers check status codes
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(
+            pool_connections=1, pool_maxsize=pool_size, max_retries=retry
+        )
+        self.mount("http://", adapter)
+        self.mount("https://", adapter)
+
+    def request(self, method, url, *args, **kwargs):
+        kwargs.setdefault("timeout", self._timeout)
+        start = time.perf_counter()
+        try:
+            response = super().request(method, url, *args, **kwargs)
+        except requests.RequestException:
+            VAULT_REQUESTS.labels(method, "error").inc()
+            raise
+        finally:
+            VAULT_REQUEST_SECONDS.labels(method).observe(time.perf_counter() - start)
+        VAULT_REQUESTS.labels(method, str(response.status_code)).inc()
+        return response
+
+
+class AsyncVaultClient:
+    """
+    asyncio counterpart of VaultSession built on httpx.AsyncClient, with the same timeouts,
+    connection pool size and retries of connection errors and 5xx responses.
+    """
+
+    RETRY_STATUSES: typing.Final[typing.FrozenSet[int]] = frozenset(
+        [500, 502, 503, 504]
+    )
+
+    def __init__(
+        self,
+        connect_timeout: float = constants.DEFAULT_VAULT_CONNECT_TIMEOUT_SECONDS,
+        read_timeout: float = constants.DEFAULT_VAULT_READ_TIMEOUT_SECONDS,
+        max_retries: int = constants.DEFAULT_VAULT_MAX_RETRIES,
+        backoff_factor: float = constants.DEFAULT_VAULT_RETRY_BACKOFF_SECONDS,
+        pool_size: int = constants.DEFAULT_VAULT_POOL_SIZE,
+    ):
+        self._max_retries = max_retries
+        self._backoff_factor = backoff_factor
+        self._client = httpx.AsyncClient(
+            timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+            limits=httpx.Limits(
+                max_connections=pool_size, max_keepalive_connections=pool_size
+            ),
+        )
+
+    async def request(self, method: str, url: str, **kwargs) -> httpx.Response:
+        start = time.perf_counter()
+        try:
+            for attempt in range(self._max_retries + 1):
+                if attempt:
+                    await asyncio.sleep(self._backoff_factor * 2 ** (attempt - 1))
+                try:
+                    response = await self._client.request(method, url, **kwargs)
+                except httpx.TransportError:
+                    if attempt == self._max_retries:
+                        VAULT_REQUESTS.labels(method, "error").inc()
+                        raise
+                    continue
+                if response.status_code not in self.RETRY_STATUSES:
+                    break
+        finally:
+            VAULT_REQUEST_SECONDS.labels(method).observe(time.perf_counter() - start)
+        VAULT_REQUESTS.labels(method, str(response.status_code)).inc()
+        return response
+
+    async def get(self, url: str, **kwargs) -> httpx.Response:
+        return await self.request("GET", url, **kwargs)
+
+    async def post(self, url: str, **kwargs) -> httpx.Response:
+        return await self.request("POST", url, **kwargs)
+
+    async def delete(self, url: str, **kwargs) -> httpx.Response:
+        return await self.request("DELETE", url, **kwargs)
+
+    async def aclose(self):
+        await self._client.aclose()
+
+
+class SecretsCache:
+    """
+    In-process LRU cache of secrets read from Vault, keyed by secret URL.
+    Entries are fresh for their TTL and are kept for stale_seconds longer so they can still
+    be served while Vault is unreachable.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = constants.DEFAULT_SECRETS_CACHE_MAX_ENTRIES,
+        stale_seconds: float = constants.DEFAULT_SECRETS_CACHE_STALE_SECONDS,
+    ):
+        self._max_entries = max_entries
+        self._stale_seconds = stale_seconds
+        # url -> (fresh until, secrets)
+        self._entries: typing.OrderedDict[
+            str, typing.Tuple[float, typing.Dict]
+        ] = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get(self, url: str, max_age_past_ttl: float) -> typing.Optional[typing.Dict]:
+        with self._lock:
+            entry = self._entries.get(url)
+            if not entry:
+                return None
+            fresh_until, secrets = entry
+            if time.monotonic() > fresh_until + max_age_past_ttl:
+                return None
+            self._entries.move_to_end(url)
+            return dict(secrets)
+
+    def get(self, url: str) -> typing.Optional[typing.Dict]:
+        return self._get(url, 0)
+
+    def get_stale(self, url: str) -> typing.Optional[typing.Dict]:
+        return self._get(url, self._stale_seconds)
+
+    def set(self, url: str, secrets: typing.Dict, ttl_seconds: float):
+        with self._lock:
+            self._entries[url] = (time.monotonic() + ttl_seconds, dict(secrets))
+            self._entries.move_to_end(url)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, url: str):
+        with self._lock:
+            self._entries.pop(url, None)
+
+    def clear(self) -> int:
+        with self._lock:
+            flushed = len(self._entries)
+            self._entries.clear()
+            return flushed
+
+
+def _vault_client_settings() -> typing.Dict:
+    return {
+        "connect_timeout": float(
+            os.environ.get("VAULT_CONNECT_TIMEOUT_SECONDS")
+            or constants.DEFAULT_VAULT_CONNECT_TIMEOUT_SECONDS
+        ),
+        "read_timeout": float(
+            os.environ.get("VAULT_READ_TIMEOUT_SECONDS")
+            or constants.DEFAULT_VAULT_READ_TIMEOUT_SECONDS
+        ),
+        "max_retries": int(
+            os.environ.get("VAULT_MAX_RETRIES") or constants.DEFAULT_VAULT_MAX_RETRIES
+        ),
+        "backoff_factor": float(
+            os.environ.get("VAULT_RETRY_BACKOFF_SECONDS")
+            or constants.DEFAULT_VAULT_RETRY_BACKOFF_SECONDS
+        ),
+        "pool_size": int(
+            os.environ.get("VAULT_POOL_SIZE") or constants.DEFAULT_VAULT_POOL_SIZE
+        ),
+    }
+
+
+_vault_session: typing.Optional[VaultSession] = None
+_vault_session_lock = threading.Lock()
+
+
+def get_vault_session() -> VaultSession:
+    global _vault_session
+    with _vault_session_lock:
+        if _vault_session is None:
+            _vault_session = VaultSession(**_vault_client_settings())
+        return _vault_session
+
+
+# httpx connections belong to the event loop they were opened on, so keep a client per loop
+_async_vault_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, AsyncVaultClient]" = (
+    weakref.WeakKeyDictionary()
+)
+
+
+def get_async_vault_client() -> AsyncVaultClient:
+    loop = asyncio.get_running_loop()
+    client = _async_vault_clients.get(loop)
+    if client is None:
+        client = _async_vault_clients[loop] = AsyncVaultClient(
+            **_vault_client_settings()
+        )
+    return client
+
+
+_secrets_cache: typing.Optional[SecretsCache] = None
+_secrets_cache_lock = threading.Lock()
+
+
+def get_secrets_cache() -> SecretsCache:
+    global _secrets_cache
+    with _secrets_cache_lock:
+        if _secrets_cache is None:
+            _secrets_cache = SecretsCache(
+                max_entries=int(
+                    os.environ.get("SECRETS_CACHE_MAX_ENTRIES")
+                    or constants.DEFAULT_SECRETS_CACHE_MAX_ENTRIES
+                ),
+                stale_seconds=float(
+                    os.environ.get("SECRETS_CACHE_STALE_SECONDS")
+                    or constants.DEFAULT_SECRETS_CACHE_STALE_SECONDS
+                ),
+            )
+        return _secrets_cache
@@ -1,6 +1,22 @@
 import pytest
 
+from server import state
 from server.utils import ComposeHelper, DeploymentConfig, NginxHelper, SecretsHelper
+from server.vault import get_secrets_cache
+
+
+@pytest.fixture(autouse=True)
+def clear_secrets_cache():
+    yield
+    get_secrets_cache().clear()
+
+
+@pytest.fixture(autouse=True)
+def deployment_store(monkeypatch):
+    store = state.DeploymentStore(":memory:")
+    monkeypatch.setattr(state, "_deployment_store", store)
+    yield store
+    store.close()
 
 
 @pytest.fixture
@@ -82,7 +98,8 @@ def deployment_config():
 
 
 @pytest.fixture
-def nginx_helper(deployment_config):
+def nginx_helper(deployment_config, tmp_path, monkeypatch):
+    monkeypatch.setenv("PORT_REGISTRY_PATH", str(tmp_path / "ports.json"))
     outer_conf_base_path = "/path/to/outer/conf"
     deployment_project_path = "/path/to/deployment/project"
     return NginxHelper(deployment_config, outer_conf_base_path, deployment_project_path)
@@ -0,0 +1,103 @@
+import asyncio
+import threading
+import time
+
+import pytest
+from fastapi import HTTPException
+
+from server.admission import AdmissionController
+from server.utils import DeploymentConfig
+
+
+def make_config(project_name, branch_name):
+    return DeploymentConfig(
+        project_name=project_name,
+        branch_name=branch_name,
+        project_git_url=f"https://github.com/tushar5526/{project_name}.git",
+    )
+
+
+def make_deployment(mount_dir, project_name, branch_name):
+    namespace = make_config(project_name, branch_name).get_deployment_namespace()
+    (mount_dir / namespace).mkdir()
+    return namespace
+
+
+def test_new_deployments_are_rejected_over_the_limit(tmp_path):
+    # Given
+    make_deployment(tmp_path, "project", "feature-1")
+    pending_namespace = make_config("project", "feature-2").get_deployment_namespace()
+    controller = AdmissionController(str(tmp_path), max_deployments=2)
+
+    # When / Then
+    with pytest.raises(HTTPException, match="maximum of 2 deployments") as e:
+        controller.check_new_deployment(
+            make_config("project", "feature-3"), [pending_namespace]
+        )
+    assert e.value.status_code == 429
+    controller.check_new_deployment(make_config("project", "feature-1"), [])
+    controller.check_new_deployment(make_config("project", "feature-3"), [])
+
+
+def test_new_deployments_are_rejected_over_the_project_limit(tmp_path):
+    # Given
+    make_deployment(tmp_path, "project", "feature-1")
+    make_deployment(tmp_path, "project_two", "feature-1")
+    controller = AdmissionController(str(tmp_path), max_deployments_per_project=1)
+
+    # When / Then
+    with pytest.raises(HTTPException, match="project already has the maximum of 1"):
+        controller.check_new_deployment(make_config("project", "feature-2"), [])
+    controller.check_new_deployment(make_config("other-project", "feature-2"), [])
+
+
+def test_build_slots_are_handed_out_in_arrival_order(tmp_path):
+    # Given
+    controller = AdmissionController(str(tmp_path), max_builds=1)
+    order = []
+
+    def build(namespace):
+        with controller.build_slot(namespace):
+            order.append(namespace)
+
+    # When
+    with controller.build_slot("first"):
+        second = threading.Thread(target=build, args=("second",))
+        second.start()
+        while controller.build_queue_position("second") is None:
+            time.sleep(0.01)
+        third = threading.Thread(target=build, args=("third",))
+        third.start()
+        while controller.build_queue_position("third") is None:
+            time.sleep(0.01)
+
+        # Then
+        assert controller.build_queue_position("second") == 1
+        assert controller.build_queue_position("third") == 2
+    second.join(5)
+    third.join(5)
+    assert order == ["second", "third"]
+    assert controller.build_queue_position("third") is None
+
+
+def test_async_build_slots_limit_concurrent_builds(tmp_path):
+    # Given
+    controller = AdmissionController(str(tmp_path), max_builds=2)
+    running = []
+    max_running = []
+
+    async def build(namespace):
+        async with controller.async_build_slot(namespace):
+            running.append(namespace)
+            max_running.append(len(running))
+            await asyncio.sleep(0.05)
+            running.remove(namespace)
+
+    async def build_all():
+        await asyncio.gather(*[build(f"namespace-{i}") for i in range(4)])
+
+    # When
+    asyncio.run(build_all())
+
+    # Then
+    assert max(max_running) == 2
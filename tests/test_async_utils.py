@@ -0,0 +1,132 @@
+import asyncio
+import socket
+
+import pytest
+
+from server.async_utils import (
+    AsyncComposeHelper,
+    AsyncNginxHelper,
+    AsyncSecretsHelper,
+    run_command,
+)
+from server.vault import get_secrets_cache
+
+
+def test_run_command_merges_output():
+    # When
+    return_code, output = asyncio.run(
+        run_command(["sh", "-c", "echo building; echo failed >&2; exit 3"])
+    )
+
+    # Then
+    assert return_code == 3
+    assert output == "building\nfailed\n"
+
+
+def test_find_free_port_skips_ports_in_use(deployment_config, tmp_path, monkeypatch):
+    # Given
+    monkeypatch.setenv("PORT_REGISTRY_PATH", str(tmp_path / "ports.json"))
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as busy_socket:
+        busy_socket.bind(("127.0.0.1", 0))
+        busy_socket.listen()
+        busy_port = busy_socket.getsockname()[1]
+        monkeypatch.setenv("DEPLOYMENT_PORT_START", str(busy_port))
+        monkeypatch.setenv("DEPLOYMENT_PORT_END", str(busy_port + 1))
+        nginx_helper = AsyncNginxHelper(
+            deployment_config, "/path/to/outer/conf", "/path/to/deployment/project"
+        )
+        nginx_helper._host_name = "127.0.0.1"
+
+        # When
+        port = asyncio.run(nginx_helper.find_free_port())
+
+    # Then
+    assert port == str(busy_port + 1)
+    assert asyncio.run(nginx_helper.find_free_port()) == port
+
+
+def test_inject_env_variables_copies_default_secrets(tmp_path, mocker, monkeypatch):
+    # Given
+    monkeypatch.setenv("VAULT_BASE_URL", "http://vault:8200")
+    monkeypatch.setenv("VAULT_TOKEN", "hvs.randomToken")
+    mocked_client = mocker.patch("server.async_utils.get_async_vault_client")
+    not_found = mocker.Mock(status_code=404)
+    default_secrets = mocker.Mock(status_code=200)
+    default_secrets.json.return_value = {"data": {"data": {"key": "secret-value"}}}
+    mocked_client.return_value.get = mocker.AsyncMock(
+        side_effect=[not_found, default_secrets]
+    )
+    mocked_client.return_value.post = mocker.AsyncMock(return_value=mocker.Mock())
+    secrets_helper = AsyncSecretsHelper("project_name", "branch_name", str(tmp_path))
+
+    # When
+    asyncio.run(secrets_helper.inject_env_variables(str(tmp_path)))
+
+    # Then
+    assert (tmp_path / ".env").read_text() == 'key="secret-value"\n'
+    mocked_client.return_value.post.assert_awaited_once()
+    assert get_secrets_cache().get(secrets_helper._default_secret_url) == {
+        "key": "secret-value"
+    }
+
+
+@pytest.fixture
+def mocked_docker_client(mocker):
+    mocked_client = mocker.patch("server.utils.get_docker_client").return_value
+    mocked_client.list_containers.return_value = [
+        {"Labels": {"com.docker.compose.project": "namespace"}}
+    ]
+    mocked_client.list_networks.return_value = [{"Id": "network-id"}]
+    return mocked_client
+
+
+@pytest.fixture
+def direct_compose_helper(tmp_path, monkeypatch, mocked_docker_client):
+    monkeypatch.setenv("ROUTING_MODE", "direct")
+    (tmp_path / "docker-compose.yml").write_text(
+        "services:\n  web:\n    image: nginx\n"
+    )
+    return AsyncComposeHelper(str(tmp_path / "docker-compose.yml"))
+
+
+def test_direct_routing_connects_outer_proxy_after_compose_up(
+    direct_compose_helper, mocked_docker_client, mocker
+):
+    # Given
+    mocker.patch.object(direct_compose_helper, "_prepare_compose_file")
+    mocker.patch("server.async_utils.stream_command", return_value=0)
+
+    # When
+    asyncio.run(
+        direct_compose_helper.start_services(None, "nginx.conf", "namespace", False)
+    )
+
+    # Then
+    mocked_docker_client.connect_network.assert_called_once_with(
+        "network-id", "sarthi_nginx"
+    )
+
+
+def test_direct_routing_disconnects_outer_proxy_before_compose_down(
+    direct_compose_helper, mocked_docker_client, mocker
+):
+    # Given
+    calls = []
+    mocked_docker_client.disconnect_network.side_effect = lambda *args: calls.append(
+        "disconnect"
+    )
+
+    async def run_command(command, cwd):
+        calls.append(" ".join(command))
+        return 0, ""
+
+    mocker.patch("server.async_utils.run_command", side_effect=run_command)
+
+    # When
+    asyncio.run(direct_compose_helper.remove_services())
+
+    # Then
+    assert calls == ["disconnect", "docker compose down -v"]
+    mocked_docker_client.disconnect_network.assert_called_once_with(
+        "network-id", "sarthi_nginx"
+    )
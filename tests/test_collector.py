@@ -0,0 +1,117 @@
+import collections
+import time
+
+import pytest
+
+from server import constants
+from server.collector import GarbageCollectionPolicy, GarbageCollector
+from server.utils import DeploymentConfig
+
+DAY = 24 * 3600
+
+
+def make_deployment(mount_dir, store, project_name, branch_name, deployed_at):
+    config = DeploymentConfig(
+        project_name=project_name,
+        branch_name=branch_name,
+        project_git_url="",
+    )
+    namespace = config.get_deployment_namespace()
+    git_dir = mount_dir / namespace / ".git"
+    git_dir.mkdir(parents=True)
+    (git_dir / "HEAD").write_text(f"ref: refs/heads/{branch_name}\n")
+    store.record_deploy_started(config)
+    store.record_deployed(namespace, "0" * 40, None, [], {})
+    store._execute(
+        "UPDATE deployments SET deployed_at = ? WHERE namespace = ?",
+        (deployed_at, namespace),
+    )
+    return namespace
+
+
+@pytest.fixture
+def mount_dir(tmp_path, monkeypatch):
+    monkeypatch.setenv("PORT_REGISTRY_PATH", str(tmp_path / "ports.json"))
+    mount_dir = tmp_path / "deployments"
+    mount_dir.mkdir()
+    return mount_dir
+
+
+@pytest.fixture
+def mocked_delete(mocker):
+    return mocker.patch(
+        "server.collector.BulkTeardown.delete",
+        autospec=True,
+        side_effect=lambda self, configs: {"deleted": list(configs), "failed": {}},
+    )
+
+
+def test_dry_run_reports_stale_deployments(
+    mount_dir, tmp_path, deployment_store, mocked_delete
+):
+    # Given
+    now = time.time()
+    old = make_deployment(mount_dir, deployment_store, "app", "old", now - 10 * DAY)
+    make_deployment(mount_dir, deployment_store, "app", "fresh", now)
+    make_deployment(mount_dir, deployment_store, "app", "main", now - 30 * DAY)
+    busy = make_deployment(mount_dir, deployment_store, "app", "busy", now - 9 * DAY)
+    make_deployment(mount_dir, deployment_store, "api", "a", now - 100)
+    make_deployment(mount_dir, deployment_store, "api", "b", now - 200)
+    oldest_api = make_deployment(mount_dir, deployment_store, "api", "c", now - 300)
+    collector = GarbageCollector(
+        str(mount_dir),
+        str(tmp_path / "nginx-confs"),
+        GarbageCollectionPolicy(
+            max_age_seconds=7 * DAY,
+            max_previews_per_project=2,
+            exclude_branches=["main"],
+        ),
+        is_busy=lambda namespace: namespace == busy,
+    )
+
+    # When
+    report = collector.collect(dry_run=True)
+
+    # Then
+    assert report["dry_run"]
+    assert [(d["namespace"], d["reasons"]) for d in report["stale"]] == [
+        (old, [constants.GC_MAX_AGE]),
+        (oldest_api, [constants.GC_MAX_PREVIEWS_PER_PROJECT]),
+    ]
+    assert report["stale"][0]["branch_name"] == "old"
+    mocked_delete.assert_not_called()
+
+
+def test_least_recently_used_are_deleted_above_disk_high_water(
+    mount_dir, tmp_path, deployment_store, mocked_delete, mocker
+):
+    # Given
+    now = time.time()
+    namespaces = [
+        make_deployment(mount_dir, deployment_store, "app", f"feature-{i}", now - i)
+        for i in range(3)
+    ]
+    for namespace in namespaces:
+        (mount_dir / namespace / "payload").write_bytes(b"0" * 60)
+    DiskUsage = collections.namedtuple("DiskUsage", "total used free")
+    mocker.patch(
+        "server.collector.shutil.disk_usage", return_value=DiskUsage(1000, 900, 100)
+    )
+    collector = GarbageCollector(
+        str(mount_dir),
+        str(tmp_path / "nginx-confs"),
+        GarbageCollectionPolicy(disk_high_water_percent=80),
+        batch_size=1,
+    )
+
+    # When
+    report = collector.collect()
+
+    # Then
+    # Every checkout is 86 bytes, two of them bring the usage under 800 bytes
+    assert report["deleted"] == [namespaces[2], namespaces[1]]
+    assert report["disk_usage_percent"] == 90
+    assert [list(call.args[1]) for call in mocked_delete.call_args_list] == [
+        [namespaces[2]],
+        [namespaces[1]],
+    ]
@@ -0,0 +1,82 @@
+import io
+
+import pytest
+import yaml
+from fastapi import HTTPException
+
+from server.compose import PortMapping, SafeLoader, dump_yaml, load_yaml, parse_ports
+from server.utils import ComposeHelper
+
+
+def test_parse_every_port_syntax():
+    # When
+    mappings = parse_ports(
+        "web",
+        [
+            "8080:80",
+            3000,
+            "127.0.0.1:5432:5432",
+            "8000-8001:9000-9001",
+            "53:53/udp",
+            {"target": 443, "published": "8443", "protocol": "tcp", "mode": "host"},
+        ],
+    )
+
+    # Then
+    assert mappings == [
+        PortMapping("80", "8080"),
+        PortMapping("3000", None),
+        PortMapping("5432", "5432", host_ip="127.0.0.1"),
+        PortMapping("9000", "8000"),
+        PortMapping("9001", "8001"),
+        PortMapping("53", "53", protocol="udp"),
+        PortMapping("443", "8443"),
+    ]
+    assert mappings[1].url_port == "3000"
+
+
+def test_invalid_port_is_refused():
+    with pytest.raises(HTTPException, match="Invalid port 80:abc of service web"):
+        parse_ports("web", ["80:abc"])
+
+
+def test_service_ports_config_skips_udp_ports(mocker):
+    # Given
+    compose_file = """
+services:
+  web:
+    image: nginx
+    ports:
+      - target: 80
+        published: 8080
+      - "53:53/udp"
+  dns:
+    image: coredns
+    ports:
+      - "5353:53/udp"
+"""
+    mocker.patch("builtins.open", mocker.mock_open(read_data=compose_file))
+
+    # When
+    compose_helper = ComposeHelper("docker-compose.yml")
+
+    # Then
+    assert compose_helper.get_service_ports_config() == {
+        "web": [("8080", "80")],
+        "dns": [],
+    }
+
+
+def test_yaml_round_trip():
+    # Given
+    compose = {"services": {"web": {"image": "nginx", "ports": ["8080:80"]}}}
+    stream = io.StringIO()
+
+    # When
+    dump_yaml(compose, stream)
+
+    # Then
+    assert load_yaml(stream.getvalue()) == compose
+    assert stream.getvalue() == yaml.dump(compose, default_flow_style=False)
+    if yaml.__with_libyaml__:
+        assert SafeLoader is yaml.CSafeLoader
@@ -0,0 +1,321 @@
+import asyncio
+import os
+import pathlib
+import subprocess
+import threading
+
+import pytest
+
+from server import async_deployer, constants
+from server.async_deployer import AsyncDeployer
+from server.deployer import Deployer
+from server.utils import DeploymentConfig
+
+
+def git(cwd, *args):
+    subprocess.run(["git", *args], cwd=cwd, check=True, capture_output=True)
+
+
+@pytest.fixture
+def upstream_repo(tmp_path, monkeypatch):
+    monkeypatch.setenv("GIT_AUTHOR_NAME", "sarthi")
+    monkeypatch.setenv("GIT_AUTHOR_EMAIL", "sarthi@localhost")
+    monkeypatch.setenv("GIT_COMMITTER_NAME", "sarthi")
+    monkeypatch.setenv("GIT_COMMITTER_EMAIL", "sarthi@localhost")
+    repo = tmp_path / "upstream"
+    repo.mkdir()
+    git(repo, "init", "-b", "main")
+    (repo / "docker-compose.yml").write_text("services: {}\n")
+    git(repo, "add", ".")
+    git(repo, "commit", "-m", "initial commit")
+    return repo
+
+
+@pytest.fixture
+def deployer_factory(tmp_path, monkeypatch, mocker, upstream_repo):
+    monkeypatch.setenv("DEPLOYMENTS_MOUNT_DIR", str(tmp_path / "deployments"))
+    monkeypatch.setenv("LOCK_FILE_BASE_PATH", str(tmp_path))
+    mocker.patch("server.deployer.ComposeHelper")
+    mocker.patch("server.deployer.SecretsHelper")
+    mocker.patch("server.deployer.NginxHelper")
+
+    def factory(rest_action=constants.POST, branch_name="main"):
+        config = DeploymentConfig(
+            project_name="test-project-name",
+            branch_name=branch_name,
+            project_git_url=f"file://{upstream_repo}",
+            rest_action=rest_action,
+        )
+        return Deployer(config)
+
+    return factory
+
+
+def test_first_deploy_clones_project(deployer_factory):
+    # When
+    deployer = deployer_factory()
+
+    # Then
+    assert os.path.exists(os.path.join(deployer._project_path, "docker-compose.yml"))
+
+
+def test_redeploy_fetches_into_existing_checkout(
+    deployer_factory, upstream_repo, mocker
+):
+    # Given
+    deployer = deployer_factory()
+    unchanged_file = os.path.join(deployer._project_path, "docker-compose.yml")
+    unchanged_mtime = os.path.getmtime(unchanged_file)
+    with open(os.path.join(deployer._project_path, ".env"), "w") as file:
+        file.write("stale=true")
+    (upstream_repo / "new-file.txt").write_text("new commit")
+    git(upstream_repo, "add", ".")
+    git(upstream_repo, "commit", "-m", "second commit")
+    mocked_clone = mocker.patch.object(Deployer, "_clone_project")
+
+    # When
+    deployer = deployer_factory()
+
+    # Then
+    mocked_clone.assert_not_called()
+    assert os.path.exists(os.path.join(deployer._project_path, "new-file.txt"))
+    assert not os.path.exists(os.path.join(deployer._project_path, ".env"))
+    assert os.path.getmtime(unchanged_file) == unchanged_mtime
+
+
+def test_corrupt_checkout_falls_back_to_clone(deployer_factory):
+    # Given
+    deployer = deployer_factory()
+    with open(os.path.join(deployer._project_path, ".git", "HEAD"), "w") as file:
+        file.write("garbage")
+
+    # When
+    deployer = deployer_factory()
+
+    # Then
+    assert os.path.exists(os.path.join(deployer._project_path, "docker-compose.yml"))
+    git(deployer._project_path, "status")
+
+
+def test_clone_sync_mode_always_clones(deployer_factory, monkeypatch, mocker):
+    # Given
+    deployer_factory()
+    monkeypatch.setenv("GIT_SYNC_MODE", constants.GIT_SYNC_CLONE)
+    mocked_fetch = mocker.patch.object(Deployer, "_fetch_project")
+
+    # When
+    deployer_factory()
+
+    # Then
+    mocked_fetch.assert_not_called()
+
+
+def test_mirror_sync_mode_shares_objects_between_branches(
+    deployer_factory, upstream_repo, monkeypatch
+):
+    # Given
+    monkeypatch.setenv("GIT_SYNC_MODE", constants.GIT_SYNC_MIRROR)
+    git(upstream_repo, "branch", "feature")
+
+    # When
+    main_deployer = deployer_factory()
+    feature_deployer = deployer_factory(branch_name="feature")
+
+    # Then
+    mirror_path = main_deployer._mirror_helper.mirror_path
+    assert mirror_path == feature_deployer._mirror_helper.mirror_path
+    for deployer in [main_deployer, feature_deployer]:
+        alternates = os.path.join(
+            deployer._project_path, ".git", "objects", "info", "alternates"
+        )
+        with open(alternates) as file:
+            assert file.read().strip() == os.path.join(mirror_path, "objects")
+
+
+def test_mirror_is_removed_with_last_branch(
+    deployer_factory, upstream_repo, monkeypatch
+):
+    # Given
+    monkeypatch.setenv("GIT_SYNC_MODE", constants.GIT_SYNC_MIRROR)
+    git(upstream_repo, "branch", "feature")
+    mirror_path = deployer_factory()._mirror_helper.mirror_path
+    deployer_factory(branch_name="feature")
+
+    # When / Then
+    deployer_factory(rest_action=constants.DELETE).delete_preview_environment()
+    assert os.path.exists(mirror_path)
+
+    deployer_factory(
+        rest_action=constants.DELETE, branch_name="feature"
+    ).delete_preview_environment()
+    assert not os.path.exists(mirror_path)
+
+
+def test_redeploy_of_unchanged_stack_is_skipped(deployer_factory, tmp_path):
+    # Given
+    secrets = {"API_KEY": "first"}
+    conf_file = tmp_path / "project.conf"
+    conf_file.write_text("server {}")
+    deployer = deployer_factory()
+    deployer._nginx_helper.generate_project_proxy_conf_file.return_value = (
+        str(conf_file),
+        ["http://some-url.localhost"],
+    )
+    deployer._nginx_helper.find_free_port.return_value = "15000"
+    deployer._compose_helper.is_running.return_value = True
+    deployer._secrets_helper.inject_env_variables.side_effect = lambda project_path: (
+        pathlib.Path(project_path) / ".env"
+    ).write_text(str(secrets))
+    deployer.deploy_preview_environment()
+
+    # When
+    urls = deployer_factory().deploy_preview_environment()
+
+    # Then
+    assert urls == ["http://some-url.localhost"]
+    deployer._compose_helper.start_services.assert_called_once_with(
+        "15000", str(conf_file), deployer._deployment_namespace
+    )
+    deployer._nginx_helper.generate_outer_proxy_conf_file.assert_called_once()
+
+    # When
+    secrets["API_KEY"] = "second"
+    deployer_factory().deploy_preview_environment()
+
+    # Then
+    deployer._compose_helper.start_services.assert_called_with(
+        "15000", str(conf_file), deployer._deployment_namespace, build=False
+    )
+    assert deployer._nginx_helper.generate_outer_proxy_conf_file.call_count == 2
+
+
+@pytest.fixture
+def async_deployer_factory(tmp_path, monkeypatch, mocker, upstream_repo):
+    monkeypatch.setenv("DEPLOYMENTS_MOUNT_DIR", str(tmp_path / "deployments"))
+    monkeypatch.setenv("LOCK_FILE_BASE_PATH", str(tmp_path))
+    mocked_compose_helper = mocker.patch(
+        "server.async_deployer.AsyncComposeHelper", autospec=True
+    )
+    mocked_compose_helper.return_value.is_running.return_value = False
+    mocker.patch("server.async_deployer.AsyncSecretsHelper", autospec=True)
+    mocked_nginx_helper = mocker.patch(
+        "server.async_deployer.AsyncNginxHelper", autospec=True
+    )
+    mocked_nginx_helper.return_value.generate_project_proxy_conf_file.return_value = (
+        "project.conf",
+        ["http://some-url.localhost"],
+    )
+    mocked_nginx_helper.return_value.find_free_port.return_value = "15000"
+
+    def factory(rest_action=constants.POST, branch_name="main"):
+        config = DeploymentConfig(
+            project_name="test-project-name",
+            branch_name=branch_name,
+            project_git_url=f"file://{upstream_repo}",
+            rest_action=rest_action,
+        )
+        return AsyncDeployer(config)
+
+    return factory
+
+
+def test_async_deploy_clones_then_fetches(async_deployer_factory, upstream_repo):
+    # Given
+    deployer = async_deployer_factory()
+    urls = asyncio.run(deployer.deploy_preview_environment())
+    (upstream_repo / "new-file.txt").write_text("new commit")
+    git(upstream_repo, "add", ".")
+    git(upstream_repo, "commit", "-m", "second commit")
+
+    # When
+    deployer = async_deployer_factory()
+    asyncio.run(deployer.deploy_preview_environment())
+
+    # Then
+    assert urls == ["http://some-url.localhost"]
+    assert os.path.exists(os.path.join(deployer._project_path, "new-file.txt"))
+    deployer._compose_helper.start_services.assert_awaited_with(
+        "15000", "project.conf", deployer._deployment_namespace
+    )
+    deployer._nginx_helper.reload_nginx.assert_awaited_with(new_outer_proxy=True)
+
+
+def test_async_pipeline_writes_files_off_the_event_loop(async_deployer_factory):
+    # Given
+    loop_thread = threading.current_thread()
+    threads = {}
+
+    def record_thread(name, return_value=None):
+        def side_effect(*args):
+            threads[name] = threading.current_thread()
+            return return_value
+
+        return side_effect
+
+    compose_helper = async_deployer.AsyncComposeHelper.return_value
+    nginx_helper = async_deployer.AsyncNginxHelper.return_value
+    compose_helper.prepare_services.side_effect = record_thread("prepare_services")
+    nginx_helper.generate_project_proxy_conf_file.side_effect = record_thread(
+        "generate_project_proxy_conf_file",
+        ("project.conf", ["http://some-url.localhost"]),
+    )
+    nginx_helper.generate_outer_proxy_conf_file.side_effect = record_thread(
+        "generate_outer_proxy_conf_file"
+    )
+    nginx_helper.remove_outer_proxy.side_effect = record_thread("remove_outer_proxy")
+
+    # When
+    asyncio.run(async_deployer_factory().deploy_preview_environment())
+    asyncio.run(
+        async_deployer_factory(
+            rest_action=constants.DELETE
+        ).delete_preview_environment()
+    )
+
+    # Then
+    assert len(threads) == 4
+    assert loop_thread not in threads.values()
+
+
+def test_async_deploys_of_a_namespace_run_one_at_a_time(async_deployer_factory):
+    # Given
+    running = []
+    overlapping = []
+
+    async def start_services(*args):
+        overlapping.append(bool(running))
+        running.append(True)
+        await asyncio.sleep(0.05)
+        running.pop()
+
+    async def deploy_twice():
+        await asyncio.gather(
+            async_deployer_factory().deploy_preview_environment(),
+            async_deployer_factory().deploy_preview_environment(),
+        )
+
+    async_deployer.AsyncComposeHelper.return_value.start_services.side_effect = (
+        start_services
+    )
+
+    # When
+    asyncio.run(deploy_twice())
+
+    # Then
+    assert overlapping == [False, False]
+
+
+def test_async_delete_removes_deployment(async_deployer_factory):
+    # Given
+    deployer = async_deployer_factory()
+    asyncio.run(deployer.deploy_preview_environment())
+
+    # When
+    deployer = async_deployer_factory(rest_action=constants.DELETE)
+    asyncio.run(deployer.delete_preview_environment())
+
+    # Then
+    assert not os.path.exists(deployer._project_path)
+    deployer._compose_helper.remove_services.assert_awaited_once()
+    deployer._nginx_helper.release_port.assert_awaited_once()
+    deployer._secrets_helper.cleanup_deployment_variables.assert_awaited_once()
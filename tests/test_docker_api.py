@@ -0,0 +1,199 @@
+import json
+import socketserver
+import struct
+import threading
+from http.server import BaseHTTPRequestHandler
+
+import pytest
+
+from server.docker_api import DockerEngineClient, DockerEngineError
+
+
+class FakeDockerHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def address_string(self):
+        return "docker.sock"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        self.server.requests.append(("GET", self.path))
+        if self.path == "/exec/exec-id/json":
+            self._send_json(200, {"ExitCode": self.server.exit_code})
+        elif self.path.startswith("/containers/json"):
+            self._send_json(200, [{"Id": "container-id", "State": "running"}])
+        elif self.path.startswith("/images/json"):
+            self._send_json(200, [{"Id": "sha256:image-id", "RepoTags": []}])
+        elif self.path.startswith("/networks"):
+            self._send_json(200, [{"Id": "network-id", "Name": "project_default"}])
+        else:
+            self._send_json(404, {"message": "not found"})
+
+    def do_POST(self):
+        self.server.requests.append(("POST", self.path))
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        if self.path == "/containers/sarthi_nginx/exec":
+            self.server.commands.append(json.loads(body)["Cmd"])
+            self._send_json(201, {"Id": "exec-id"})
+        elif "/tag?" in self.path:
+            self.send_response(201)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+        elif self.path.startswith("/networks/network-id/"):
+            self.server.commands.append(json.loads(body))
+            if self.server.commands.count(json.loads(body)) > 1:
+                self._send_json(
+                    403, {"message": "endpoint with name sarthi_nginx already exists"}
+                )
+            else:
+                self.send_response(200)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+        elif self.path == "/exec/exec-id/start":
+            # Hijacked raw stream, framed per stdout / stderr and closed at the end
+            self.send_response(200)
+            self.send_header("Content-Type", "application/vnd.docker.raw-stream")
+            self.end_headers()
+            for stream, text in [(1, b"syntax is ok\n"), (2, b"test is successful\n")]:
+                self.wfile.write(struct.pack(">BxxxL", stream, len(text)) + text)
+            self.close_connection = True
+        else:
+            self._send_json(404, {"message": "No such container"})
+
+    def do_DELETE(self):
+        self.server.requests.append(("DELETE", self.path))
+        self._send_json(200, [{"Untagged": self.path}])
+
+
+class FakeDockerServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path):
+        super().__init__(socket_path, FakeDockerHandler)
+        self.requests = []
+        self.commands = []
+        self.connections = 0
+        self.exit_code = 0
+
+    def process_request(self, request, client_address):
+        self.connections += 1
+        super().process_request(request, client_address)
+
+
+@pytest.fixture
+def fake_docker(tmp_path):
+    server = FakeDockerServer(str(tmp_path / "docker.sock"))
+    thread = threading.Thread(
+        target=server.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True
+    )
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def docker_client(fake_docker):
+    client = DockerEngineClient(socket_path=fake_docker.server_address, timeout=5)
+    yield client
+    client.close()
+
+
+def test_exec_run(docker_client, fake_docker):
+    # When
+    exit_code, output = docker_client.exec_run("sarthi_nginx", ["nginx", "-t"])
+
+    # Then
+    assert exit_code == 0
+    assert output == "syntax is ok\ntest is successful\n"
+    assert fake_docker.commands == [["nginx", "-t"]]
+    assert fake_docker.requests == [
+        ("POST", "/containers/sarthi_nginx/exec"),
+        ("POST", "/exec/exec-id/start"),
+        ("GET", "/exec/exec-id/json"),
+    ]
+
+
+def test_exec_run_returns_failed_exit_code(docker_client, fake_docker):
+    # Given
+    fake_docker.exit_code = 1
+
+    # When
+    exit_code, _ = docker_client.exec_run("sarthi_nginx", ["nginx", "-t"])
+
+    # Then
+    assert exit_code == 1
+
+
+def test_connections_are_reused(docker_client, fake_docker):
+    # When
+    for _ in range(5):
+        docker_client.list_containers(labels=["com.docker.compose.project=test"])
+
+    # Then
+    assert fake_docker.connections == 1
+
+
+def test_image_requests(docker_client, fake_docker):
+    # When
+    images = docker_client.list_images(labels=["sarthi.namespace=ns"], dangling=True)
+    docker_client.tag_image("sarthi/project/web:main", "sarthi/project/web", "cache")
+    docker_client.remove_image("sarthi/project/web:main")
+
+    # Then
+    assert images == [{"Id": "sha256:image-id", "RepoTags": []}]
+    assert fake_docker.requests == [
+        (
+            "GET",
+            "/images/json?filters=%7B%22label%22%3A+%5B%22sarthi.namespace%3Dns%22%5D%2C"
+            "+%22dangling%22%3A+%5B%22true%22%5D%7D",
+        ),
+        (
+            "POST",
+            "/images/sarthi/project/web:main/tag?repo=sarthi%2Fproject%2Fweb&tag=cache",
+        ),
+        ("DELETE", "/images/sarthi/project/web:main"),
+    ]
+
+
+def test_network_requests(docker_client, fake_docker):
+    # When
+    networks = docker_client.list_networks(labels=["com.docker.compose.project=ns"])
+    docker_client.connect_network("network-id", "sarthi_nginx")
+    # Connecting twice is not an error
+    docker_client.connect_network("network-id", "sarthi_nginx")
+    docker_client.disconnect_network("network-id", "sarthi_nginx")
+
+    # Then
+    assert networks == [{"Id": "network-id", "Name": "project_default"}]
+    assert fake_docker.requests == [
+        (
+            "GET",
+            "/networks?filters=%7B%22label%22%3A+%5B%22com.docker.compose.project%3Dns%22%5D%7D",
+        ),
+        ("POST", "/networks/network-id/connect"),
+        ("POST", "/networks/network-id/connect"),
+        ("POST", "/networks/network-id/disconnect"),
+    ]
+    assert fake_docker.commands[-1] == {"Container": "sarthi_nginx", "Force": True}
+
+
+def test_exec_run_in_unknown_container(docker_client):
+    with pytest.raises(DockerEngineError, match="404"):
+        docker_client.exec_run("random-container", ["nginx", "-t"])
+
+
+def test_docker_socket_missing(tmp_path):
+    client = DockerEngineClient(socket_path=str(tmp_path / "missing.sock"))
+    with pytest.raises(DockerEngineError):
+        client.list_containers()
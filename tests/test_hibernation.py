@@ -0,0 +1,163 @@
+import os
+import threading
+import time
+
+import pytest
+
+from server import constants
+from server.deployer import Deployer
+from server.hibernation import HibernationManager
+from server.routing import RoutingTable
+from server.utils import DeploymentConfig
+
+
+@pytest.fixture
+def deployment(tmp_path, monkeypatch, mocker):
+    monkeypatch.setenv("HIBERNATE_IDLE_MINUTES", "30")
+    monkeypatch.setenv("DEPLOYMENTS_MOUNT_DIR", str(tmp_path / "deployments"))
+    monkeypatch.setenv("NGINX_PROXY_CONF_LOCATION", str(tmp_path / "nginx-confs"))
+    monkeypatch.setenv("LOCK_FILE_BASE_PATH", str(tmp_path))
+    monkeypatch.setenv("PORT_REGISTRY_PATH", str(tmp_path / "ports.json"))
+    monkeypatch.setenv("DEPLOYMENT_HOST", "127.0.0.1")
+    (tmp_path / "nginx-confs").mkdir()
+    mocker.patch("server.deployer.ComposeHelper")
+    mocker.patch("server.deployer.SecretsHelper")
+    mocker.patch("server.utils.NginxHelper.reload_nginx")
+    mocker.patch("server.utils.NginxHelper.wait_for_port")
+
+    config = DeploymentConfig(
+        project_name="test-project-name",
+        branch_name="test-branch-name",
+        project_git_url="",
+        rest_action=constants.DELETE,
+    )
+    deployer = Deployer(config)
+    os.makedirs(deployer._project_path)
+    deployer._nginx_helper.generate_project_proxy_conf_file({"web": [(8080, 80)]})
+    port = deployer._nginx_helper.find_free_port()
+    deployer._nginx_helper.generate_outer_proxy_conf_file(port)
+    return deployer
+
+
+def make_idle(deployer, seconds):
+    access_log = deployer._nginx_helper._access_log_path
+    os.utime(access_log, (time.time() - seconds, time.time() - seconds))
+
+
+def routing_table(deployer):
+    return RoutingTable(deployer._nginx_helper._outer_conf_base_path).render()
+
+
+def test_outer_proxy_conf_logs_access(deployment):
+    # When
+    conf = routing_table(deployment)
+
+    # Then
+    # nginx opens static log paths as root on reload, its workers could not open paths with variables
+    assert (
+        """
+    server_name test-proje-test-branch-name-8080-c7866191e5.localhost;
+    access_log /var/log/nginx/access.log combined;
+    access_log /etc/nginx/conf.d/access-logs/test-proje-c7866191e5.log combined;
+"""
+        in conf
+    )
+    assert "$sarthi_access_log" not in conf
+    assert deployment._nginx_helper.last_access() == pytest.approx(time.time(), abs=5)
+
+
+def test_recently_accessed_deployment_is_not_hibernated(deployment):
+    # Given
+    make_idle(deployment, 60)
+
+    # When / Then
+    assert not deployment.hibernate_preview_environment(idle_seconds=1800)
+    deployment._compose_helper.stop_services.assert_not_called()
+
+
+def test_idle_deployment_is_hibernated_and_woken_up(deployment):
+    # Given
+    make_idle(deployment, 3600)
+
+    # When
+    hibernated = deployment.hibernate_preview_environment(idle_seconds=1800)
+
+    # Then
+    assert hibernated
+    deployment._compose_helper.stop_services.assert_called_once()
+    assert deployment._nginx_helper.is_hibernated()
+    assert (
+        "test-proje-test-branch-name-8080-c7866191e5.localhost "
+        "sarthi-wake/deployments/test-project-name_test-branch-name_c7866191e5/wake;"
+        in routing_table(deployment)
+    )
+    assert not deployment.hibernate_preview_environment(idle_seconds=1800)
+
+    # When
+    deployment.wake_preview_environment(timeout_seconds=1)
+
+    # Then
+    deployment._compose_helper.resume_services.assert_called_once()
+    assert not deployment._nginx_helper.is_hibernated()
+    conf = routing_table(deployment)
+    assert "server host.docker.internal:" in conf
+    assert "sarthi-wake" not in conf
+
+
+def test_manager_hibernates_idle_deployments(tmp_path, mocker):
+    # Given
+    namespace = "test-project-name_test-branch-name_c7866191e5"
+    (tmp_path / namespace).mkdir()
+    (tmp_path / constants.SARTHI_STATE_DIR).mkdir()
+    (tmp_path / "not-a-deployment").mkdir()
+    mocked_deployer = mocker.patch("server.hibernation.Deployer")
+    mocked_deployer.return_value.hibernate_preview_environment.return_value = True
+    manager = HibernationManager(str(tmp_path), idle_seconds=1800)
+
+    # When
+    hibernated = manager.hibernate_idle_deployments()
+
+    # Then
+    assert hibernated == [namespace]
+    mocked_deployer.assert_called_once()
+    mocked_deployer.return_value.hibernate_preview_environment.assert_called_once_with(
+        1800
+    )
+
+
+def test_manager_skips_deployments_with_active_jobs(tmp_path, mocker):
+    # Given
+    busy = "test-project-name_test-branch-name_c7866191e5"
+    (tmp_path / busy).mkdir()
+    mocked_deployer = mocker.patch("server.hibernation.Deployer")
+    manager = HibernationManager(
+        str(tmp_path), idle_seconds=1800, is_busy=lambda namespace: namespace == busy
+    )
+
+    # When
+    hibernated = manager.hibernate_idle_deployments()
+
+    # Then
+    assert hibernated == []
+    mocked_deployer.assert_not_called()
+
+
+def test_manager_wakes_a_deployment_once(tmp_path, mocker):
+    # Given
+    namespace = "test-project-name_test-branch-name_c7866191e5"
+    release = threading.Event()
+    mocked_deployer = mocker.patch("server.hibernation.Deployer")
+    mocked_deployer.return_value.wake_preview_environment.side_effect = (
+        lambda timeout: release.wait(5)
+    )
+    manager = HibernationManager(str(tmp_path), idle_seconds=1800)
+
+    # When
+    assert manager.wake(namespace)
+    assert manager.wake(namespace)
+    release.set()
+    manager.stop()
+
+    # Then
+    assert not manager.wake("unknown")
+    mocked_deployer.assert_called_once()
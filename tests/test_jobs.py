@@ -0,0 +1,377 @@
+import asyncio
+import threading
+import time
+
+import pytest
+from fastapi import HTTPException
+
+from server import constants
+from server.deployer import DeploymentCancelled
+from server.jobs import AsyncDeploymentQueue, DeploymentQueue
+from server.utils import DeploymentConfig
+
+
+def wait_for_job(queue, job_id, timeout=5):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        job = queue.get(job_id)
+        if job.status in constants.JOB_FINISHED_STATES:
+            return job
+        time.sleep(0.01)
+    raise AssertionError(f"Job {job_id} did not finish in {timeout}s")
+
+
+@pytest.fixture
+def deployment_queue():
+    queue = DeploymentQueue(max_workers=2, history_size=10)
+    yield queue
+    queue.shutdown()
+
+
+def test_submit_deploy_job_success(deployment_queue, deployment_config, mocker):
+    # Given
+    mocked_deployer = mocker.patch("server.jobs.Deployer")
+    mocked_deployer.return_value.deploy_preview_environment.return_value = [
+        "http://some-url.localhost"
+    ]
+
+    # When
+    job = deployment_queue.submit(deployment_config)
+    job = wait_for_job(deployment_queue, job.id)
+
+    # Then
+    assert job.status == constants.JOB_SUCCEEDED
+    assert job.result == {"urls": ["http://some-url.localhost"]}
+    assert job.started_at >= job.created_at
+    assert job.finished_at >= job.started_at
+    mocked_deployer.assert_called_once_with(deployment_config, job.cancel_event)
+
+
+def test_submit_delete_job_success(deployment_queue, mocker):
+    # Given
+    mocked_deployer = mocker.patch("server.jobs.Deployer")
+    config = DeploymentConfig(
+        project_name="test-project-name",
+        branch_name="test-branch-name",
+        project_git_url="https://github.com/tushar5526/test-project-name.git",
+        rest_action=constants.DELETE,
+    )
+
+    # When
+    job = deployment_queue.submit(config)
+    job = wait_for_job(deployment_queue, job.id)
+
+    # Then
+    assert job.status == constants.JOB_SUCCEEDED
+    mocked_deployer.return_value.delete_preview_environment.assert_called_once()
+    mocked_deployer.return_value.deploy_preview_environment.assert_not_called()
+
+
+def test_failed_job_records_error(deployment_queue, deployment_config, mocker):
+    # Given
+    mocked_deployer = mocker.patch("server.jobs.Deployer")
+    mocked_deployer.side_effect = HTTPException(500, "Cloning the Git repo failed")
+
+    # When
+    job = deployment_queue.submit(deployment_config)
+    job = wait_for_job(deployment_queue, job.id)
+
+    # Then
+    assert job.status == constants.JOB_FAILED
+    assert job.error == "Cloning the Git repo failed"
+    assert job.to_dict()["error"] == "Cloning the Git repo failed"
+
+
+def test_deployment_state_is_recorded(
+    deployment_queue, deployment_config, deployment_store, mocker
+):
+    # Given
+    mocked_deployer = mocker.patch("server.jobs.Deployer")
+    mocked_deployer.return_value.deploy_preview_environment.side_effect = HTTPException(
+        500, "Docker Compose up failed"
+    )
+
+    # When
+    job = deployment_queue.submit(deployment_config)
+    wait_for_job(deployment_queue, job.id)
+
+    # Then
+    deployment = deployment_store.get(job.namespace)
+    assert deployment["status"] == constants.DEPLOYMENT_FAILED
+    assert deployment["error"] == "Docker Compose up failed"
+
+
+def test_failed_clone_does_not_expose_the_github_token(
+    deployment_queue, deployment_store, tmp_path, monkeypatch, mocker
+):
+    # Given
+    monkeypatch.setenv("DEPLOYMENTS_MOUNT_DIR", str(tmp_path / "deployments"))
+    monkeypatch.setenv("LOCK_FILE_BASE_PATH", str(tmp_path))
+    for helper in ["ComposeHelper", "SecretsHelper", "NginxHelper"]:
+        mocker.patch(f"server.deployer.{helper}")
+    config = DeploymentConfig(
+        project_name="test-project-name",
+        branch_name="test-branch-name",
+        # Nothing listens on port 1, so the clone fails right away
+        project_git_url="https://127.0.0.1:1/tushar5526/test-project-name.git",
+        gh_token="ghp_secretToken",
+    )
+
+    # When
+    job = deployment_queue.submit(config)
+    job = wait_for_job(deployment_queue, job.id)
+
+    # Then
+    assert job.status == constants.JOB_FAILED
+    assert "127.0.0.1:1/tushar5526/test-project-name.git" in job.error
+    assert "ghp_secretToken" not in job.error
+    assert "ghp_secretToken" not in deployment_store.get(job.namespace)["error"]
+    assert "ghp_secretToken" not in repr(config)
+
+
+def test_get_unknown_job(deployment_queue):
+    assert deployment_queue.get("random-job-id") is None
+
+
+def test_finished_jobs_are_evicted_from_history(deployment_config, mocker):
+    # Given
+    mocker.patch("server.jobs.Deployer")
+    queue = DeploymentQueue(max_workers=1, history_size=2)
+
+    # When
+    jobs = []
+    for _ in range(4):
+        job = queue.submit(deployment_config)
+        wait_for_job(queue, job.id)
+        jobs.append(job)
+    queue.shutdown()
+
+    # Then
+    assert queue.get(jobs[0].id) is None
+    assert queue.get(jobs[-1].id) is not None
+
+
+def test_queued_deploys_of_same_namespace_are_superseded(deployment_config, mocker):
+    # Given
+    release = threading.Event()
+    mocked_deployer = mocker.patch("server.jobs.Deployer")
+    mocked_deployer.return_value.deploy_preview_environment.side_effect = (
+        lambda: release.wait(5) and []
+    )
+    queue = DeploymentQueue(max_workers=1)
+
+    # When
+    running_job = queue.submit(deployment_config)
+    pending_job = queue.submit(deployment_config)
+    latest_job = queue.submit(deployment_config)
+    release.set()
+    wait_for_job(queue, latest_job.id)
+    queue.shutdown()
+
+    # Then
+    assert running_job.status == constants.JOB_SUCCEEDED
+    assert pending_job.status == constants.JOB_SUPERSEDED
+    assert pending_job.superseded_by == latest_job.id
+    assert latest_job.status == constants.JOB_SUCCEEDED
+    assert mocked_deployer.call_count == 2
+
+
+def test_jobs_of_same_namespace_run_in_order(deployment_config, mocker):
+    # Given
+    started = []
+    release = threading.Event()
+
+    def deployer(config, cancel_event):
+        started.append(config.rest_action)
+        release.wait(5)
+        return mocker.MagicMock()
+
+    mocker.patch("server.jobs.Deployer", side_effect=deployer)
+    delete_config = DeploymentConfig(
+        project_name=deployment_config.project_name,
+        branch_name=deployment_config.branch_name,
+        project_git_url=deployment_config.project_git_url,
+        rest_action=constants.DELETE,
+    )
+    queue = DeploymentQueue(max_workers=4)
+
+    # When
+    jobs = [queue.submit(deployment_config)]
+    # Queued deploys would be superseded by the delete
+    while jobs[0].status != constants.JOB_RUNNING:
+        time.sleep(0.01)
+    jobs += [queue.submit(delete_config), queue.submit(deployment_config)]
+    time.sleep(0.1)
+    started_before_release = list(started)
+    release.set()
+    for job in jobs:
+        wait_for_job(queue, job.id)
+    queue.shutdown()
+
+    # Then
+    # Free workers don't start the later jobs while the first one is running
+    assert started_before_release == [constants.POST]
+    assert started == [constants.POST, constants.DELETE, constants.POST]
+    assert [job.status for job in jobs] == [constants.JOB_SUCCEEDED] * 3
+    assert jobs[1].started_at >= jobs[0].finished_at
+    assert jobs[2].started_at >= jobs[1].finished_at
+
+
+def test_queue_position_of_waiting_jobs(deployment_config, mocker):
+    # Given
+    release = threading.Event()
+    mocked_deployer = mocker.patch("server.jobs.Deployer")
+    mocked_deployer.return_value.deploy_preview_environment.side_effect = (
+        lambda: release.wait(5) and []
+    )
+    other_config = DeploymentConfig(
+        project_name=deployment_config.project_name,
+        branch_name="other-branch",
+        project_git_url=deployment_config.project_git_url,
+    )
+    queue = DeploymentQueue(max_workers=1)
+
+    # When
+    running_job = queue.submit(deployment_config)
+    while running_job.status != constants.JOB_RUNNING:
+        time.sleep(0.01)
+    first_waiting_job = queue.submit(other_config)
+    second_waiting_job = queue.submit(deployment_config)
+
+    # Then
+    assert queue.queue_position(running_job) is None
+    assert queue.queue_position(first_waiting_job) == 1
+    assert queue.queue_position(second_waiting_job) == 2
+    release.set()
+    wait_for_job(queue, second_waiting_job.id)
+    queue.shutdown()
+
+
+def test_running_deploy_is_cancelled_when_enabled(deployment_config, mocker):
+    # Given
+    started = threading.Event()
+
+    def deploy(config, cancel_event):
+        if started.is_set():
+            return mocker.MagicMock()
+        started.set()
+        if cancel_event.wait(5):
+            raise DeploymentCancelled("cancelled by a newer request")
+        return mocker.MagicMock()
+
+    mocker.patch("server.jobs.Deployer", side_effect=deploy)
+    queue = DeploymentQueue(max_workers=2, cancel_running=True)
+
+    # When
+    running_job = queue.submit(deployment_config)
+    started.wait(5)
+    latest_job = queue.submit(deployment_config)
+    wait_for_job(queue, running_job.id)
+    wait_for_job(queue, latest_job.id)
+    queue.shutdown()
+
+    # Then
+    assert running_job.status == constants.JOB_CANCELLED
+    assert running_job.superseded_by == latest_job.id
+    assert latest_job.status == constants.JOB_SUCCEEDED
+
+
+def test_async_queue_runs_jobs_on_the_event_loop(deployment_config, mocker):
+    # Given
+    release = asyncio.Event()
+    mocked_deployer = mocker.patch("server.jobs.AsyncDeployer", autospec=True)
+
+    async def deploy():
+        await release.wait()
+        return ["http://some-url.localhost"]
+
+    mocked_deployer.return_value.deploy_preview_environment.side_effect = deploy
+
+    async def submit_jobs():
+        queue = AsyncDeploymentQueue(max_workers=1)
+        running_job = queue.submit(deployment_config)
+        await asyncio.sleep(0)
+        pending_job = queue.submit(deployment_config)
+        latest_job = queue.submit(deployment_config)
+        release.set()
+        # Jobs of a namespace get a task when the one before them is done
+        while queue._tasks:
+            await asyncio.gather(*queue._tasks)
+        return running_job, pending_job, latest_job
+
+    # When
+    running_job, pending_job, latest_job = asyncio.run(submit_jobs())
+
+    # Then
+    assert running_job.status == constants.JOB_SUCCEEDED
+    assert running_job.result == {"urls": ["http://some-url.localhost"]}
+    assert pending_job.status == constants.JOB_SUPERSEDED
+    assert latest_job.status == constants.JOB_SUCCEEDED
+    assert mocked_deployer.call_count == 2
+
+
+def test_async_queue_runs_jobs_of_same_namespace_in_order(deployment_config, mocker):
+    # Given
+    started = []
+    release = asyncio.Event()
+    mocked_deployer = mocker.patch("server.jobs.AsyncDeployer", autospec=True)
+
+    async def deploy():
+        started.append(constants.POST)
+        await release.wait()
+        return []
+
+    async def delete():
+        started.append(constants.DELETE)
+
+    mocked_deployer.return_value.deploy_preview_environment.side_effect = deploy
+    mocked_deployer.return_value.delete_preview_environment.side_effect = delete
+    delete_config = DeploymentConfig(
+        project_name=deployment_config.project_name,
+        branch_name=deployment_config.branch_name,
+        project_git_url=deployment_config.project_git_url,
+        rest_action=constants.DELETE,
+    )
+
+    async def submit_jobs():
+        queue = AsyncDeploymentQueue(max_workers=4)
+        queue.submit(deployment_config)
+        await asyncio.sleep(0)
+        queue.submit(delete_config)
+        await asyncio.sleep(0.05)
+        started_before_release = list(started)
+        release.set()
+        while queue._tasks:
+            await asyncio.gather(*queue._tasks)
+        return started_before_release
+
+    # When
+    started_before_release = asyncio.run(submit_jobs())
+
+    # Then
+    assert started_before_release == [constants.POST]
+    assert started == [constants.POST, constants.DELETE]
+
+
+def test_async_queue_shutdown_cancels_running_jobs(deployment_config, mocker):
+    # Given
+    mocked_deployer = mocker.patch("server.jobs.AsyncDeployer", autospec=True)
+
+    async def deploy():
+        await asyncio.sleep(5)
+
+    mocked_deployer.return_value.deploy_preview_environment.side_effect = deploy
+
+    async def submit_and_shutdown():
+        queue = AsyncDeploymentQueue(max_workers=1)
+        job = queue.submit(deployment_config)
+        await asyncio.sleep(0.01)
+        queue.shutdown(wait=False)
+        await asyncio.gather(*queue._tasks, return_exceptions=True)
+        return job
+
+    # When
+    job = asyncio.run(submit_and_shutdown())
+
+    # Then
+    assert job.status == constants.JOB_CANCELLED
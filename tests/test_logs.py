@@ -0,0 +1,115 @@
+import asyncio
+import threading
+
+from server.logs import BuildLogBuffer, BuildLogRegistry
+
+
+def test_build_log_buffer_keeps_last_lines():
+    # Given
+    build_log = BuildLogBuffer(max_lines=3)
+
+    # When
+    for i in range(5):
+        build_log.append(f"line {i}\n")
+
+    # Then
+    assert build_log.lines() == ["line 2", "line 3", "line 4"]
+
+
+def test_follow_tails_until_closed():
+    # Given
+    build_log = BuildLogBuffer()
+    build_log.append("Building webapp")
+
+    def write():
+        build_log.append("Started webapp")
+        build_log.close()
+
+    # When
+    lines = []
+    for line in build_log.follow(poll_seconds=0.05):
+        lines.append(line)
+        if line == "Building webapp":
+            threading.Thread(target=write).start()
+
+    # Then
+    assert [line for line in lines if line] == ["Building webapp", "Started webapp"]
+
+
+def test_follow_yields_keep_alives_without_output():
+    # Given
+    build_log = BuildLogBuffer()
+    follower = build_log.follow(poll_seconds=0.01)
+
+    # When / Then
+    assert next(follower) is None
+    build_log.close()
+    assert list(follower) == []
+
+
+def test_registry_drops_oldest_buffers():
+    # Given
+    registry = BuildLogRegistry(max_buffers=2)
+
+    # When
+    for namespace in ["first", "second", "third"]:
+        registry.start(namespace).append(namespace)
+
+    # Then
+    assert registry.get("first") is None
+    assert registry.get("third").lines() == ["third"]
+
+
+def test_restarting_a_build_clears_old_logs():
+    # Given
+    registry = BuildLogRegistry()
+    build_log = registry.start("namespace")
+    build_log.append("old build")
+    build_log.close()
+
+    # When
+    build_log = registry.start("namespace")
+
+    # Then
+    assert build_log.lines() == []
+    assert not build_log.closed
+
+
+def test_follow_async_tails_lines_written_from_threads():
+    # Given
+    build_log = BuildLogBuffer()
+    build_log.append("Building webapp")
+
+    def write():
+        build_log.append("Started webapp")
+        build_log.close()
+
+    async def follow():
+        lines = []
+        async for line in build_log.follow_async(poll_seconds=5):
+            lines.append(line)
+            if line == "Building webapp":
+                threading.Thread(target=write).start()
+        return lines
+
+    # When
+    lines = asyncio.run(asyncio.wait_for(follow(), 2))
+
+    # Then
+    # New lines wake the follower up right away, without waiting for a keep-alive
+    assert lines == ["Building webapp", "Started webapp"]
+    assert not build_log._async_waiters
+
+
+def test_follow_async_yields_keep_alives_without_output():
+    # Given
+    build_log = BuildLogBuffer()
+
+    async def follow():
+        follower = build_log.follow_async(poll_seconds=0.01)
+        keep_alive = await follower.__anext__()
+        build_log.close()
+        return keep_alive, [line async for line in follower]
+
+    # When / Then
+    assert asyncio.run(follow()) == (None, [])
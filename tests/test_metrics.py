@@ -0,0 +1,40 @@
+import pytest
+from prometheus_client import REGISTRY
+
+from server.metrics import track_phase
+
+
+def sample(name, phase):
+    return REGISTRY.get_sample_value(name, {"phase": phase}) or 0
+
+
+def test_track_phase_records_duration():
+    # Given
+    count = sample("sarthi_deployment_phase_seconds_count", "test_phase")
+
+    # When
+    with track_phase("test_phase"):
+        pass
+
+    # Then
+    assert sample("sarthi_deployment_phase_seconds_count", "test_phase") == count + 1
+
+
+def test_track_phase_counts_errors():
+    # Given
+    errors = sample("sarthi_deployment_phase_errors_total", "test_failing_phase")
+
+    @track_phase("test_failing_phase")
+    def failing_phase():
+        raise ValueError("Random error")
+
+    # When
+    with pytest.raises(ValueError):
+        failing_phase()
+
+    # Then
+    assert (
+        sample("sarthi_deployment_phase_errors_total", "test_failing_phase")
+        == errors + 1
+    )
+    assert sample("sarthi_deployment_phase_seconds_count", "test_failing_phase") == 1
@@ -0,0 +1,116 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from fastapi import HTTPException
+
+from server.ports import PortRegistry
+
+
+@pytest.fixture
+def port_registry(tmp_path):
+    return PortRegistry(str(tmp_path / "state" / "ports.json"), 15000, 15009)
+
+
+def test_allocate_reuses_port_of_namespace(port_registry):
+    # Given
+    port = port_registry.allocate("project_branch_hash")
+
+    # When / Then
+    assert port == 15000
+    assert port_registry.allocate("project_branch_hash") == port
+    assert port_registry.get("project_branch_hash") == port
+
+
+def test_released_port_is_handed_out_again(port_registry):
+    # Given
+    first_port = port_registry.allocate("first")
+    port_registry.allocate("second")
+
+    # When
+    port_registry.release("first")
+
+    # Then
+    assert port_registry.get("first") is None
+    assert port_registry.allocate("third") == first_port
+
+
+def test_allocate_skips_ports_used_outside_sarthi(port_registry):
+    # When
+    port = port_registry.allocate("namespace", lambda port: port != 15000)
+
+    # Then
+    assert port == 15001
+
+
+def test_skipped_ports_are_retried_once_the_range_runs_out(port_registry):
+    # Given
+    busy_ports = {15000, 15001}
+    probed_ports = []
+
+    def is_port_free(port):
+        probed_ports.append(port)
+        return port not in busy_ports
+
+    port_registry.allocate("first", is_port_free)
+    probed_ports.clear()
+
+    # When
+    second_port = port_registry.allocate("second", is_port_free)
+
+    # Then
+    assert port_registry.get("first") == 15002
+    # Ports that stay busy are not probed again on every allocation
+    assert second_port == 15003
+    assert probed_ports == [15003]
+
+    # Given
+    for i in range(6):
+        port_registry.allocate(f"namespace-{i}")
+    busy_ports.clear()
+
+    # When / Then
+    assert port_registry.allocate("later", is_port_free) == 15000
+    assert port_registry.allocate("latest", is_port_free) == 15001
+
+
+def test_register_port_of_legacy_deployment(port_registry):
+    # When
+    registered = port_registry.register("legacy", 15001)
+
+    # Then
+    assert registered
+    assert port_registry.get("legacy") == 15001
+    assert not port_registry.register("legacy", 15005)
+    assert not port_registry.register("other", 15001)
+    assert port_registry.allocate("first") == 15000
+    assert port_registry.allocate("second") == 15002
+
+
+def test_allocate_fails_when_range_is_exhausted(port_registry):
+    # Given
+    for i in range(10):
+        port_registry.allocate(f"namespace-{i}")
+
+    # Then
+    with pytest.raises(
+        HTTPException, match="Could not find a free port in the specified range"
+    ):
+        # When
+        port_registry.allocate("one-too-many")
+
+
+def test_concurrent_allocations_do_not_collide(port_registry):
+    # When
+    with ThreadPoolExecutor(max_workers=10) as executor:
+        ports = list(
+            executor.map(lambda i: port_registry.allocate(f"namespace-{i}"), range(10))
+        )
+
+    # Then
+    assert sorted(ports) == list(range(15000, 15010))
+
+
+def test_release_unknown_namespace(port_registry):
+    port_registry.release("unknown")
+    port_registry.allocate("known")
+    port_registry.release("unknown")
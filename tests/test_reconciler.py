@@ -0,0 +1,225 @@
+import os
+
+import pytest
+
+from server import constants
+from server.docker_api import DockerEngineError
+from server.fingerprint import DeploymentFingerprint, FingerprintStore
+from server.ports import get_port_registry
+from server.reconciler import Reconciler
+from server.utils import DeploymentConfig, NginxHelper
+
+
+@pytest.fixture
+def mount_dir(tmp_path, monkeypatch, mocker):
+    mount_dir = tmp_path / "deployments"
+    mount_dir.mkdir()
+    (tmp_path / "nginx-confs").mkdir()
+    monkeypatch.setenv("DEPLOYMENTS_MOUNT_DIR", str(mount_dir))
+    monkeypatch.setenv("NGINX_PROXY_CONF_LOCATION", str(tmp_path / "nginx-confs"))
+    monkeypatch.setenv("LOCK_FILE_BASE_PATH", str(tmp_path))
+    monkeypatch.setenv("PORT_REGISTRY_PATH", str(tmp_path / "ports.json"))
+    monkeypatch.setenv("DEPLOYMENT_HOST", "127.0.0.1")
+    mocker.patch("server.deployer.SecretsHelper")
+    return mount_dir
+
+
+@pytest.fixture
+def mocked_docker_client(mocker):
+    return mocker.patch("server.utils.get_docker_client").return_value
+
+
+def make_deployment(mount_dir, tmp_path, branch_name):
+    config = DeploymentConfig(
+        project_name="project", branch_name=branch_name, project_git_url=""
+    )
+    namespace = config.get_deployment_namespace()
+    (mount_dir / namespace).mkdir()
+    nginx_helper = NginxHelper(
+        config, str(tmp_path / "nginx-confs"), str(mount_dir / namespace)
+    )
+    return namespace, nginx_helper
+
+
+def stack_container(working_dir, project_name):
+    return {
+        "Labels": {
+            "com.docker.compose.project": project_name,
+            "com.docker.compose.project.working_dir": str(working_dir),
+        }
+    }
+
+
+def test_reconcile_repairs_drift(
+    mount_dir, tmp_path, mocked_docker_client, deployment_store, mocker
+):
+    # Given
+    running, running_nginx = make_deployment(mount_dir, tmp_path, "running")
+    running_nginx.generate_outer_proxy_conf_file("15005")
+    running_nginx.find_free_port()
+    stackless, stackless_nginx = make_deployment(mount_dir, tmp_path, "stackless")
+    stackless_nginx.find_free_port()
+    stackless_nginx.generate_outer_proxy_conf_file(stackless_nginx.reserved_port())
+    busy, _ = make_deployment(mount_dir, tmp_path, "busy")
+    get_port_registry().allocate("project_deleted_0123456789")
+    (tmp_path / "nginx-confs" / "routes" / "deleted-0123456789.json").write_text("{}")
+    (tmp_path / "nginx-confs" / "legacy-0123456789.conf").write_text("server {}")
+    (tmp_path / "nginx-confs" / "sarthi.conf").write_text("server {}")
+    deployment_store.record_deploy_started(
+        DeploymentConfig(
+            project_name="project", branch_name="running", project_git_url=""
+        )
+    )
+    mocked_docker_client.list_containers.return_value = [
+        stack_container(mount_dir / running, running),
+        stack_container(mount_dir / "project_deleted_0123456789", "deleted"),
+        stack_container(tmp_path, "sarthi"),
+    ]
+    mocked_remove_project = mocker.patch(
+        "server.reconciler.ComposeHelper.remove_project"
+    )
+    mocked_reload = mocker.patch("server.reconciler.NginxHelper.reload_outer_nginx")
+    reconciler = Reconciler(
+        str(mount_dir),
+        str(tmp_path / "nginx-confs"),
+        is_busy=lambda namespace: namespace == busy,
+    )
+
+    # When
+    report = reconciler.reconcile(startup=True)
+
+    # Then
+    assert report == {
+        "removed_confs": ["legacy-0123456789.conf", "deleted-0123456789.json"],
+        "removed_stacks": ["deleted"],
+        "released_ports": ["project_deleted_0123456789"],
+        "registered_ports": [],
+        "removed_checkouts": [stackless],
+        "repaired_confs": [running],
+        "interrupted_deploys": [running],
+    }
+    mocked_remove_project.assert_called_once_with("deleted")
+    mocked_reload.assert_called_once_with(str(tmp_path / "nginx-confs"))
+    assert running_nginx.outer_proxy_port() == running_nginx.reserved_port()
+    assert not os.path.exists(mount_dir / stackless)
+    assert not os.path.exists(stackless_nginx._outer_proxy_path)
+    assert stackless_nginx.reserved_port() is None
+    assert os.path.exists(mount_dir / busy)
+    assert os.path.exists(tmp_path / "nginx-confs" / "sarthi.conf")
+    assert deployment_store.get(running)["status"] == constants.DEPLOYMENT_FAILED
+
+
+def test_reconcile_is_skipped_without_docker(mount_dir, tmp_path, mocked_docker_client):
+    # Given
+    stackless, _ = make_deployment(mount_dir, tmp_path, "stackless")
+    mocked_docker_client.list_containers.side_effect = DockerEngineError(
+        "docker.sock not found"
+    )
+
+    # When
+    report = Reconciler(str(mount_dir), str(tmp_path / "nginx-confs")).reconcile()
+
+    # Then
+    assert report == {}
+    assert os.path.exists(mount_dir / stackless)
+
+
+def test_reconcile_leaves_busy_deployment_without_checkout_alone(
+    mount_dir, tmp_path, mocked_docker_client, mocker
+):
+    # Given
+    recloning, nginx_helper = make_deployment(mount_dir, tmp_path, "recloning")
+    nginx_helper.find_free_port()
+    nginx_helper.generate_outer_proxy_conf_file(nginx_helper.reserved_port())
+    fingerprints = FingerprintStore(
+        str(mount_dir / constants.SARTHI_STATE_DIR / constants.FINGERPRINTS_DIR)
+    )
+    fingerprints.save(recloning, DeploymentFingerprint("build", "env", []))
+    # The redeploy removed the checkout and has not cloned it again yet
+    os.rmdir(mount_dir / recloning)
+    mocked_docker_client.list_containers.return_value = [
+        stack_container(mount_dir / recloning, recloning)
+    ]
+    mocked_remove_project = mocker.patch(
+        "server.reconciler.ComposeHelper.remove_project"
+    )
+    mocked_reload = mocker.patch("server.reconciler.NginxHelper.reload_outer_nginx")
+    reconciler = Reconciler(
+        str(mount_dir),
+        str(tmp_path / "nginx-confs"),
+        is_busy=lambda namespace: namespace == recloning,
+    )
+
+    # When
+    report = reconciler.reconcile()
+
+    # Then
+    assert not any(report.values())
+    mocked_remove_project.assert_not_called()
+    mocked_reload.assert_not_called()
+    assert os.path.exists(nginx_helper._outer_proxy_path)
+    assert nginx_helper.reserved_port() is not None
+    assert fingerprints.get(recloning) is not None
+
+
+def test_reconcile_keeps_failed_deploys_and_stacks_it_does_not_know(
+    mount_dir, tmp_path, mocked_docker_client, deployment_store, mocker
+):
+    # Given
+    failed, _ = make_deployment(mount_dir, tmp_path, "failed")
+    deployment_store.record_deploy_started(
+        DeploymentConfig(
+            project_name="project", branch_name="failed", project_git_url=""
+        )
+    )
+    deployment_store.record_deploy_failed(failed, "Docker Compose up failed")
+    stackless, _ = make_deployment(mount_dir, tmp_path, "stackless")
+    # Started by hand from a directory under the deployments dir
+    (mount_dir / "monitoring").mkdir()
+    mocked_docker_client.list_containers.return_value = [
+        stack_container(mount_dir / "monitoring", "monitoring")
+    ]
+    mocked_remove_project = mocker.patch(
+        "server.reconciler.ComposeHelper.remove_project"
+    )
+    mocked_secrets_helper = mocker.patch("server.deployer.SecretsHelper")
+    mocker.patch("server.reconciler.NginxHelper.reload_outer_nginx")
+
+    # When
+    report = Reconciler(str(mount_dir), str(tmp_path / "nginx-confs")).reconcile()
+
+    # Then
+    assert report["removed_stacks"] == []
+    assert report["removed_checkouts"] == [stackless]
+    mocked_remove_project.assert_not_called()
+    assert os.path.exists(mount_dir / failed)
+    assert deployment_store.get(failed)["error"] == "Docker Compose up failed"
+    mocked_secrets_helper.return_value.cleanup_deployment_variables.assert_not_called()
+
+
+def test_reconcile_registers_ports_of_legacy_deployments(
+    mount_dir, tmp_path, mocked_docker_client, mocker
+):
+    # Given
+    legacy, nginx_helper = make_deployment(mount_dir, tmp_path, "legacy")
+    proxy_container = {
+        **stack_container(mount_dir / legacy, legacy),
+        "Ports": [{"PrivatePort": 80, "PublicPort": 15003, "Type": "tcp"}],
+    }
+
+    def list_containers(labels):
+        if labels == [f"com.docker.compose.service=nginx_{legacy}"]:
+            return [proxy_container]
+        return [stack_container(mount_dir / legacy, legacy)]
+
+    mocked_docker_client.list_containers.side_effect = list_containers
+    mocker.patch("server.reconciler.NginxHelper.reload_outer_nginx")
+
+    # When
+    report = Reconciler(str(mount_dir), str(tmp_path / "nginx-confs")).reconcile()
+
+    # Then
+    assert report["registered_ports"] == [legacy]
+    assert report["repaired_confs"] == [legacy]
+    assert nginx_helper.reserved_port() == "15003"
+    assert nginx_helper.outer_proxy_port() == "15003"
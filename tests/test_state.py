@@ -0,0 +1,84 @@
+from server import constants
+from server.utils import DeploymentConfig
+
+
+def make_config(project_name, branch_name):
+    return DeploymentConfig(
+        project_name=project_name,
+        branch_name=branch_name,
+        project_git_url=f"https://token:@github.com/tushar5526/{project_name}.git",
+    )
+
+
+def test_deployment_lifecycle_is_recorded(deployment_store):
+    # Given
+    config = make_config("project", "feature/login")
+    namespace = config.get_deployment_namespace()
+
+    # When
+    deployment_store.record_deploy_started(config)
+    deployment_store.record_deployed(
+        namespace, "abc123", "15000", ["http://login.localhost"], {"compose_up": 2.5}
+    )
+
+    # Then
+    deployment = deployment_store.get(namespace)
+    assert deployment["status"] == constants.DEPLOYMENT_RUNNING
+    assert deployment["branch_name_raw"] == "feature/login"
+    assert deployment["project_git_url"] == "https://github.com/tushar5526/project.git"
+    assert deployment["commit_sha"] == "abc123"
+    assert deployment["port"] == 15000
+    assert deployment["urls"] == ["http://login.localhost"]
+    assert deployment["phase_durations"] == {"compose_up": 2.5}
+    assert deployment["deployed_at"]
+
+    # When
+    deployment_store.record_deploy_started(config)
+    deployment_store.record_deploy_failed(namespace, "Docker Compose up failed")
+
+    # Then
+    deployment = deployment_store.get(namespace)
+    assert deployment["status"] == constants.DEPLOYMENT_FAILED
+    assert deployment["error"] == "Docker Compose up failed"
+    assert deployment["commit_sha"] == "abc123"
+
+    # When
+    deployment_store.remove(namespace)
+
+    # Then
+    assert deployment_store.get(namespace) is None
+
+
+def test_list_deployments_is_filtered_and_paginated(deployment_store):
+    # Given
+    for project_name, branch_name in [
+        ("project", "main"),
+        ("project", "feature/a"),
+        ("project", "feature/b"),
+        ("other", "main"),
+    ]:
+        deployment_store.record_deploy_started(make_config(project_name, branch_name))
+    deployment_store.set_status(
+        make_config("project", "feature/a").get_deployment_namespace(),
+        constants.DEPLOYMENT_HIBERNATED,
+    )
+
+    # When
+    first_page, total = deployment_store.list(project_name="project", limit=2)
+    second_page, _ = deployment_store.list(project_name="project", limit=2, offset=2)
+    hibernated, hibernated_total = deployment_store.list(
+        status=constants.DEPLOYMENT_HIBERNATED
+    )
+    main_branches, _ = deployment_store.list(branch_name="main")
+
+    # Then
+    assert total == 3
+    assert len(first_page) == 2
+    assert len(second_page) == 1
+    assert first_page[0]["branch_name_raw"] == "feature/a"
+    assert hibernated_total == 1
+    assert [deployment["branch_name_raw"] for deployment in hibernated] == ["feature/a"]
+    assert sorted(deployment["project_name"] for deployment in main_branches) == [
+        "other",
+        "project",
+    ]
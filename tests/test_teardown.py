@@ -0,0 +1,96 @@
+import pytest
+from fastapi import HTTPException
+
+from server import constants
+from server.teardown import BulkTeardown
+from server.utils import DeploymentConfig
+
+
+def make_deployment(mount_dir, project_name, branch_name):
+    config = DeploymentConfig(
+        project_name=project_name,
+        branch_name=branch_name,
+        project_git_url="",
+    )
+    git_dir = mount_dir / config.get_deployment_namespace() / ".git"
+    git_dir.mkdir(parents=True)
+    (git_dir / "HEAD").write_text(f"ref: refs/heads/{branch_name}\n")
+    return config.get_deployment_namespace()
+
+
+@pytest.fixture
+def bulk_teardown(tmp_path):
+    return BulkTeardown(str(tmp_path), max_workers=4)
+
+
+def test_select_by_project_and_branch_pattern(bulk_teardown, tmp_path):
+    # Given
+    release_fix = make_deployment(tmp_path, "my_project", "release/fix-login")
+    release_docs = make_deployment(tmp_path, "my_project", "release/docs")
+    make_deployment(tmp_path, "my_project", "main")
+    make_deployment(tmp_path, "other_project", "release/fix-login")
+    (tmp_path / constants.SARTHI_STATE_DIR).mkdir()
+
+    # When
+    configs = bulk_teardown.select(
+        project_name="my_project", branch_pattern="release/*"
+    )
+
+    # Then
+    assert sorted(configs) == sorted([release_fix, release_docs])
+    assert configs[release_fix].branch_name_raw == "release/fix-login"
+    assert configs[release_fix].rest_action == constants.DELETE
+
+
+def test_select_explicit_namespaces(bulk_teardown, tmp_path):
+    # Given
+    namespace = make_deployment(tmp_path, "my_project", "feature")
+
+    # When
+    configs = bulk_teardown.select(namespaces=[namespace, "not_a_namespace"])
+
+    # Then
+    assert configs[namespace].project_name == "my_project"
+    assert configs["not_a_namespace"] is None
+
+
+def test_delete_reloads_nginx_once(bulk_teardown, tmp_path, mocker):
+    # Given
+    namespaces = [
+        make_deployment(tmp_path, "my_project", f"feature-{i}") for i in range(5)
+    ]
+    mocked_deployer = mocker.patch("server.teardown.Deployer")
+    configs = bulk_teardown.select(namespaces=[*namespaces, "unknown"])
+
+    # When
+    result = bulk_teardown.delete(configs)
+
+    # Then
+    assert result == {
+        "deleted": namespaces,
+        "failed": {"unknown": "Unknown deployment namespace"},
+    }
+    assert mocked_deployer.call_count == 5
+    mocked_deployer.return_value.delete_preview_environment.assert_called_with(
+        reload_nginx=False
+    )
+    mocked_deployer.return_value.reload_nginx.assert_called_once()
+
+
+def test_delete_reports_failed_deployments(bulk_teardown, tmp_path, mocker):
+    # Given
+    namespace = make_deployment(tmp_path, "my_project", "feature")
+    mocked_deployer = mocker.patch("server.teardown.Deployer")
+    mocked_deployer.return_value.delete_preview_environment.side_effect = HTTPException(
+        500, "An unexpected error occurred while starting services"
+    )
+
+    # When
+    result = bulk_teardown.delete(bulk_teardown.select(namespaces=[namespace]))
+
+    # Then
+    assert result == {
+        "deleted": [],
+        "failed": {namespace: "An unexpected error occurred while starting services"},
+    }
+    mocked_deployer.return_value.reload_nginx.assert_not_called()
@@ -1,4 +1,8 @@
+import os
 import pathlib
+import subprocess
+import threading
+import time
 from unittest.mock import MagicMock, call, patch
 
 import pytest
@@ -6,7 +10,18 @@ import requests
 from fastapi import HTTPException
 
 from server import constants
-from server.utils import ComposeHelper, DeploymentConfig
+from server.docker_api import DockerEngineError
+from server.logs import build_logs
+from server.routing import RoutingTable
+from server.utils import (
+    ComposeHelper,
+    DeploymentConfig,
+    NginxHelper,
+    NginxReloadCoordinator,
+    get_image_repository,
+    get_service_host,
+    parse_deployment_namespace,
+)
 
 
 # Compose Helper Tests
@@ -26,7 +41,9 @@ def test_dont_load_compose_file_in_compose_helper():
 
 def test_start_services_success(compose_helper, mocker):
     # Given
-    mocked_run = mocker.patch("subprocess.run")
+    mocked_popen = mocker.patch("subprocess.Popen")
+    mocked_popen.return_value.stdout = ["Building webapp\n", "Started webapp\n"]
+    mocked_popen.return_value.wait.return_value = 0
 
     conf_file_path = "conf-file-path/some-nginx.conf"
     deployment_namespace = "deployment-namespace"
@@ -61,16 +78,24 @@ def test_start_services_success(compose_helper, mocker):
         assert "restart" in service_config, f"Restart clause missing in {service_name}"
 
         assert (
-            service_config["restart"] == "always"
+            service_config["restart"] == "unless-stopped"
         ), f"Incorrect restart policy in {service_name}"
 
     assert (
         is_deployment_proxy_service
     ), "Deployment (Nginx) Proxy is missing in processed services"
 
-    mocked_run.assert_called_once_with(
-        ["docker", "compose", "up", "-d", "--build"], check=True, cwd=pathlib.Path(".")
+    mocked_popen.assert_called_once_with(
+        ["docker", "compose", "up", "-d", "--build"],
+        cwd=pathlib.Path("."),
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        text=True,
+        errors="replace",
     )
+    build_log = build_logs.get(deployment_namespace)
+    assert build_log.closed
+    assert build_log.lines() == ["Building webapp", "Started webapp"]
 
 
 def test_start_services_failure_on_processing_compose_file(compose_helper, mocker):
@@ -90,8 +115,8 @@ def test_start_services_failure_on_processing_compose_file(compose_helper, mocke
 
 def test_start_services_failure_on_docker_compose_up(compose_helper, mocker):
     # Given
-    mocked_run = mocker.patch("subprocess.run")
-    mocked_run.side_effect = Exception("Random error")
+    mocked_popen = mocker.patch("subprocess.Popen")
+    mocked_popen.side_effect = Exception("Random error")
 
     conf_file_path = "conf-file-path/some-nginx.conf"
     deployment_namespace = "deployment-namespace"
@@ -101,6 +126,18 @@ def test_start_services_failure_on_docker_compose_up(compose_helper, mocker):
         compose_helper.start_services(5000, conf_file_path, deployment_namespace)
 
 
+def test_start_services_failure_reports_build_output(compose_helper, mocker):
+    # Given
+    mocked_popen = mocker.patch("subprocess.Popen")
+    mocked_popen.return_value.stdout = ["failed to solve: npm install\n"]
+    mocked_popen.return_value.wait.return_value = 17
+
+    # Then
+    with pytest.raises(HTTPException, match="exit code 17: failed to solve"):
+        # When
+        compose_helper.start_services(5000, "some-nginx.conf", "deployment-namespace")
+
+
 def test_remove_services_success(compose_helper, mocker):
     # Given
     mocked_run = mocker.patch("subprocess.run")
@@ -148,7 +185,7 @@ def test_write_compose_file(compose_helper, mocker):
     # Given
     conf_file_path = "conf-file-path/some-nginx.conf"
     deployment_namespace = "deployment-namespace"
-    mocker.patch("subprocess.run")
+    mocker.patch("subprocess.Popen").return_value.wait.return_value = 0
     mock_yaml_dump = mocker.patch("server.utils.yaml.dump")
 
     # When
@@ -173,6 +210,23 @@ def test_find_free_port_pass(nginx_helper, mocker):
     assert isinstance(port, str)
 
 
+def test_find_free_port_is_stable_until_released(nginx_helper, mocker):
+    # Given
+    mock_socket = mocker.patch("server.utils.socket.socket")
+    mock_socket.return_value.__enter__.return_value.connect.side_effect = (
+        ConnectionRefusedError
+    )
+    port = nginx_helper.find_free_port()
+
+    # When / Then
+    assert nginx_helper.find_free_port() == port
+    nginx_helper.release_port()
+    assert (
+        nginx_helper._port_registry.get("test-project-name_test-branch-name_c7866191e5")
+        is None
+    )
+
+
 def test_find_free_port_fails(nginx_helper, mocker):
     # Given
     mocker.patch("server.utils.socket.socket")
@@ -186,34 +240,93 @@ def test_find_free_port_fails(nginx_helper, mocker):
         nginx_helper.find_free_port()
 
 
-def test_generate_outer_proxy_conf_file(nginx_helper, mocker):
+def test_generate_outer_proxy_conf_file(deployment_config, tmp_path, monkeypatch):
     # Given
-    port = "12345"
-    mock_open = mocker.patch("builtins.open")
-    mocker.patch.object(nginx_helper, "_test_nginx_config", return_value=True)
+    monkeypatch.setenv("PORT_REGISTRY_PATH", str(tmp_path / "ports.json"))
+    (tmp_path / "project").mkdir()
+    nginx_helper = NginxHelper(
+        deployment_config, str(tmp_path / "nginx-confs"), str(tmp_path / "project")
+    )
+    nginx_helper.generate_project_proxy_conf_file({"web": [(8080, 80)]})
 
     # When
-    conf = nginx_helper.generate_outer_proxy_conf_file(port)
+    route = nginx_helper.generate_outer_proxy_conf_file("12345")
+    conf = RoutingTable(str(tmp_path / "nginx-confs")).write()
 
     # Then
+    assert route == {
+        "namespace": "test-project-name_test-branch-name_c7866191e5",
+        "hosts": ["test-proje-test-branch-name-8080-c7866191e5.localhost"],
+        "host": "host.docker.internal",
+        "port": "12345",
+    }
+    assert nginx_helper.outer_proxy_port() == "12345"
     assert (
-        conf
-        == """
-    server {
-        listen 80;
-        server_name ~c7866191e5.localhost;
-
-        location / {
-            proxy_pass http://host.docker.internal:12345;
-            proxy_set_header Host $host;
-            proxy_set_header X-Real-IP $remote_addr;
-            proxy_set_header X-Forwarded-For $proxy_add_x_forwarded_for;
-            proxy_set_header X-Forwarded-Proto $scheme;
-        }
+        """
+upstream sarthi-test-proje-c7866191e5 {
+    server host.docker.internal:12345;
+    keepalive 16;
+}
+"""
+        in conf
+    )
+    assert (
+        "test-proje-test-branch-name-8080-c7866191e5.localhost sarthi-test-proje-c7866191e5;"
+        in conf
+    )
+    assert conf == (tmp_path / "nginx-confs" / "sarthi-routes.conf").read_text()
+
+
+def test_direct_route_to_services(deployment_config, tmp_path, monkeypatch):
+    # Given
+    monkeypatch.setenv("PORT_REGISTRY_PATH", str(tmp_path / "ports.json"))
+    monkeypatch.setenv("ROUTING_MODE", "direct")
+    (tmp_path / "project").mkdir()
+    nginx_helper = NginxHelper(
+        deployment_config, str(tmp_path / "nginx-confs"), str(tmp_path / "project")
+    )
+    nginx_helper.generate_project_proxy_conf_file({"web_app": [(8080, 80)]})
+
+    # When
+    route = nginx_helper.generate_outer_proxy_conf_file()
+    conf = RoutingTable(str(tmp_path / "nginx-confs")).write()
+
+    # Then
+    assert route["servers"] == {
+        "test-proje-test-branch-name-8080-c7866191e5.localhost": "sarthi-c7866191e5-web-app:80"
     }
-    """
+    assert nginx_helper.outer_proxy_port() is None
+    assert "upstream sarthi-" not in conf
+    assert "resolver 127.0.0.11 valid=10s ipv6=off;" in conf
+    assert (
+        "test-proje-test-branch-name-8080-c7866191e5.localhost sarthi-c7866191e5-web-app:80;"
+        in conf
     )
-    mock_open.assert_called_with("/path/to/outer/conf/test-proje-c7866191e5.conf", "w")
+
+
+def test_direct_routing_aliases_services_instead_of_adding_a_proxy(
+    compose_helper, deployment_config, mocker
+):
+    # Given
+    compose_helper._direct_routing = True
+    namespace = deployment_config.get_deployment_namespace()
+    services = compose_helper._compose["services"]
+    services["api"]["networks"] = ["backend"]
+    mocker.patch.object(compose_helper, "_write_compose_file")
+
+    # When
+    compose_helper._generate_processed_compose_file(None, "nginx.conf", namespace)
+
+    # Then
+    assert f"nginx_{namespace}" not in services
+    assert services["webapp"]["networks"] == {
+        "default": {"aliases": [get_service_host(namespace, "webapp")]}
+    }
+    assert services["api"]["networks"] == {
+        "backend": None,
+        "default": {"aliases": ["sarthi-c7866191e5-api"]},
+    }
+    assert "networks" not in services["database"]
 
 
 def test_generate_project_proxy_conf_file(nginx_helper, mocker):
@@ -235,39 +348,111 @@ def test_generate_project_proxy_conf_file(nginx_helper, mocker):
     ]
 
 
+def test_proxy_settings_from_service_labels(compose_helper):
+    # Given
+    services = compose_helper._compose["services"]
+    services["webapp"]["labels"] = {
+        "sarthi.proxy.buffering": False,
+        "sarthi.proxy.read_timeout": "300s",
+        "traefik.enable": "true",
+    }
+    services["api"]["labels"] = ["sarthi.proxy.buffers=8 16k"]
+
+    # When
+    settings = compose_helper.get_service_proxy_settings()
+
+    # Then
+    assert settings == {
+        "webapp": {"proxy_buffering": "off", "proxy_read_timeout": "300s"},
+        "api": {"proxy_buffers": "8 16k"},
+    }
+
+    # Given
+    services["api"]["labels"] = {"sarthi.proxy.read_timeout": "1s; return 200"}
+
+    # When / Then
+    with pytest.raises(HTTPException, match="Invalid proxy setting"):
+        compose_helper.get_service_proxy_settings()
+
+
+def test_proxy_settings_and_keepalive_in_both_proxies(
+    deployment_config, tmp_path, monkeypatch
+):
+    # Given
+    monkeypatch.setenv("PORT_REGISTRY_PATH", str(tmp_path / "ports.json"))
+    (tmp_path / "project").mkdir()
+    host = "test-proje-test-branch-name-8080-c7866191e5.localhost"
+    NginxHelper(
+        deployment_config, str(tmp_path / "nginx-confs"), str(tmp_path / "project")
+    ).generate_project_proxy_conf_file(
+        {"web": [(8080, 80)], "api": [(3000, 3000)]},
+        {"web": {"proxy_buffering": "off", "proxy_read_timeout": "300s"}},
+    )
+    # Helpers like the hibernation manager's read the project proxy conf
+    nginx_helper = NginxHelper(
+        deployment_config, str(tmp_path / "nginx-confs"), str(tmp_path / "project")
+    )
+
+    # When
+    route = nginx_helper.generate_outer_proxy_conf_file("12345")
+    conf = RoutingTable(str(tmp_path / "nginx-confs")).render()
+    project_conf = (tmp_path / "project" / "test-proje-c7866191e5.conf").read_text()
+
+    # Then
+    assert route["proxy"] == {
+        host: {"proxy_buffering": "off", "proxy_read_timeout": "300s"}
+    }
+    assert (
+        "upstream sarthi_web_80 {\n        server web:80;\n        keepalive 16;"
+        in (project_conf)
+    )
+    assert "proxy_pass http://sarthi_api_3000;" in project_conf
+    assert project_conf.count("proxy_read_timeout 300s;") == 1
+    assert f"server_name {host};" in conf
+    assert "server_names_hash_bucket_size 128;" in conf
+    assert conf.count("proxy_buffering off;") == 1
+    assert "proxy_set_header Connection $sarthi_connection_upgrade;" in conf
+
+
 def test_test_nginx_config(nginx_helper, mocker):
     # Given
-    mocked_run = mocker.patch("subprocess.run")
+    mocked_client = mocker.patch("server.utils.get_docker_client").return_value
+    mocked_client.exec_run.return_value = (0, "syntax is ok")
 
     # When
     nginx_helper._test_nginx_config()
 
     # Then
-    mocked_run.assert_called_with(
-        ["docker", "exec", "sarthi_nginx", "nginx", "-t"],
-        check=True,
-        capture_output=True,
-        text=True,
-    )
+    mocked_client.exec_run.assert_called_with("sarthi_nginx", ["nginx", "-t"])
+
+
+def test_test_nginx_config_with_invalid_config(nginx_helper, mocker):
+    # Given
+    mocked_client = mocker.patch("server.utils.get_docker_client").return_value
+    mocked_client.exec_run.return_value = (1, "emerg: unknown directive")
+
+    # Then
+    with pytest.raises(HTTPException, match="Error in generated Nginx configs"):
+        # When
+        nginx_helper._test_nginx_config()
 
 
 def test_reload_nginx_success(nginx_helper, mocker):
     # Given
-    mocked_run = mocker.patch("subprocess.run")
+    mocked_client = mocker.patch("server.utils.get_docker_client").return_value
+    mocked_client.exec_run.return_value = (0, "")
 
     # When
     nginx_helper.reload_nginx()
 
     # Then
-    mocked_run.assert_called_with(
-        ["docker", "exec", "sarthi_nginx", "nginx", "-s", "reload"], check=True
-    )
+    mocked_client.exec_run.assert_called_with("sarthi_nginx", ["nginx", "-s", "reload"])
 
 
 def test_reload_nginx_failure(nginx_helper, mocker):
     # Given
-    mocked_run = mocker.patch("subprocess.run")
-    mocked_run.side_effect = Exception("Random Error")
+    mocked_client = mocker.patch("server.utils.get_docker_client").return_value
+    mocked_client.exec_run.side_effect = DockerEngineError("Random Error")
 
     # Then
     with pytest.raises(HTTPException):
@@ -282,6 +467,77 @@ def test_reload_nginx_failure(nginx_helper, mocker):
         nginx_helper.reload_nginx()
 
 
+def test_concurrent_nginx_reloads_are_batched(monkeypatch):
+    # Given
+    monkeypatch.setenv("NGINX_RELOAD_DEBOUNCE_SECONDS", "0.05")
+    coordinator = NginxReloadCoordinator()
+    nginx_helper = MagicMock()
+    nginx_helper._reload_nginx.side_effect = lambda: time.sleep(0.1)
+
+    # When
+    threads = [
+        threading.Thread(target=coordinator.reload, args=(nginx_helper,))
+        for _ in range(10)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # Then
+    assert 1 <= nginx_helper._reload_nginx.call_count <= 2
+    assert (
+        nginx_helper._test_nginx_config.call_count
+        == nginx_helper._reload_nginx.call_count
+    )
+
+
+def test_nginx_reload_rejects_only_invalid_confs(tmp_path, monkeypatch):
+    # Given
+    monkeypatch.setenv("NGINX_RELOAD_DEBOUNCE_SECONDS", "0")
+    good_conf, bad_conf = tmp_path / "good.conf", tmp_path / "bad.conf"
+    good_conf.write_text("good")
+    bad_conf.write_text("bad")
+
+    def test_nginx_config():
+        if bad_conf.exists():
+            raise HTTPException(500, "Error in generated Nginx configs")
+        return True
+
+    nginx_helper = MagicMock()
+    nginx_helper._test_nginx_config.side_effect = test_nginx_config
+    coordinator = NginxReloadCoordinator()
+    coordinator._reloading = True
+    errors = {}
+
+    def reload(conf):
+        try:
+            coordinator.reload(nginx_helper, str(conf))
+        except HTTPException as e:
+            errors[conf.name] = e
+
+    threads = [
+        threading.Thread(target=reload, args=(conf,)) for conf in [good_conf, bad_conf]
+    ]
+    for thread in threads:
+        thread.start()
+    while len(coordinator._pending) < 2:
+        time.sleep(0.01)
+
+    # When
+    with coordinator._condition:
+        coordinator._reloading = False
+        coordinator._condition.notify_all()
+    for thread in threads:
+        thread.join()
+
+    # Then
+    assert list(errors) == ["bad.conf"]
+    assert os.path.exists(good_conf)
+    assert not os.path.exists(bad_conf)
+    nginx_helper._reload_nginx.assert_called_once()
+
+
 def test_remove_outer_proxy(nginx_helper, mocker):
     # Given
     mocker.patch("os.path.exists", return_value=True)
@@ -291,7 +547,9 @@ def test_remove_outer_proxy(nginx_helper, mocker):
     nginx_helper.remove_outer_proxy()
 
     # Then
-    mock_remove.assert_called_with("/path/to/outer/conf/test-proje-c7866191e5.conf")
+    mock_remove.assert_called_with(
+        "/path/to/outer/conf/routes/test-proje-c7866191e5.json"
+    )
 
 
 def test_remove_outer_proxy_when_file_is_deleted_already(nginx_helper, mocker):
@@ -339,11 +597,13 @@ def test_create_deployment_config_for_private_repos():
 
 
 @patch("server.utils.os")
-@patch("server.utils.requests")
+@patch("server.utils.get_vault_session")
 def test_create_env_placeholder_with_sample_env_file(
-    mock_requests, mock_os, secrets_helper_instance
+    mock_get_vault_session, mock_os, secrets_helper_instance
 ):
+    mock_requests = mock_get_vault_session.return_value
     # Mocking necessary dependencies
+    mock_requests.get.return_value.status_code = 404
     mock_os.path.exists.return_value = True
     mock_dotenv_values = MagicMock(return_value={"key": "secret-value"})
     with patch("server.utils.dotenv_values", mock_dotenv_values):
@@ -371,11 +631,13 @@ def test_create_env_placeholder_with_sample_env_file(
 
 
 @patch("server.utils.os")
-@patch("server.utils.requests")
+@patch("server.utils.get_vault_session")
 def test_create_env_placeholder_with_sample_env_file_missing(
-    mock_requests, mock_os, secrets_helper_instance
+    mock_get_vault_session, mock_os, secrets_helper_instance
 ):
+    mock_requests = mock_get_vault_session.return_value
     # Mocking necessary dependencies
+    mock_requests.get.return_value.status_code = 404
     mock_os.path.join.return_value = "/path/to/project/.env.sample"
     mock_os.path.exists.return_value = False
 
@@ -392,10 +654,11 @@ def test_create_env_placeholder_with_sample_env_file_missing(
 
 
 @patch("server.utils.os")
-@patch("server.utils.requests")
+@patch("server.utils.get_vault_session")
 def test_inject_env_variables_with_secrets_found(
-    mock_requests, mock_os, secrets_helper_instance
+    mock_get_vault_session, mock_os, secrets_helper_instance
 ):
+    mock_requests = mock_get_vault_session.return_value
     # Mocking necessary dependencies
     mock_response = MagicMock()
     mock_response.status_code = 200
@@ -418,10 +681,11 @@ def test_inject_env_variables_with_secrets_found(
 
 
 @patch("server.utils.os")
-@patch("server.utils.requests")
+@patch("server.utils.get_vault_session")
 def test_inject_env_variables_with_default_secrets_found(
-    mock_requests, mock_os, secrets_helper_instance, mocker
+    mock_get_vault_session, mock_os, secrets_helper_instance, mocker
 ):
+    mock_requests = mock_get_vault_session.return_value
     # Mocking necessary dependencies
     mock_response1 = MagicMock()
     mock_response1.status_code = 200
@@ -455,10 +719,11 @@ def test_inject_env_variables_with_default_secrets_found(
 
 
 @patch("server.utils.os")
-@patch("server.utils.requests")
+@patch("server.utils.get_vault_session")
 def test_inject_env_variables_with_no_secrets(
-    mock_requests, mock_os, secrets_helper_instance
+    mock_get_vault_session, mock_os, secrets_helper_instance
 ):
+    mock_requests = mock_get_vault_session.return_value
     # Mocking necessary dependencies
     mock_response = MagicMock()
     mock_response.status_code = 404
@@ -484,10 +749,11 @@ def test_inject_env_variables_with_no_secrets(
             mock_open.assert_called_once_with("/path/to/project/.env", "w")
 
 
-@patch("server.utils.requests.delete", autospec=True)
+@patch("server.utils.get_vault_session")
 def test_cleanup_deployment_variables_success(
-    mock_requests_delete, secrets_helper_instance
+    mock_get_vault_session, secrets_helper_instance
 ):
+    mock_requests_delete = mock_get_vault_session.return_value.delete
     # Mocking necessary dependencies
     mock_response = MagicMock()
     mock_response.status_code = 204
@@ -504,10 +770,11 @@ def test_cleanup_deployment_variables_success(
     assert result.status_code == 204
 
 
-@patch("server.utils.requests.delete", autospec=True)
+@patch("server.utils.get_vault_session")
 def test_cleanup_deployment_variables_failure(
-    mock_requests_delete, secrets_helper_instance
+    mock_get_vault_session, secrets_helper_instance
 ):
+    mock_requests_delete = mock_get_vault_session.return_value.delete
     # Mocking necessary dependencies
     mock_response = MagicMock()
     mock_response.status_code = 500
@@ -524,3 +791,160 @@ def test_cleanup_deployment_variables_failure(
         url="http://vault:8200/v1/kv/metadata/project_name/branch_name",
         headers={"X-Vault-Token": "hvs.randomToken"},
     )
+
+
+def test_parse_deployment_namespace_with_underscores():
+    # Given
+    config = DeploymentConfig(
+        project_name="my_project",
+        branch_name="fix_some_bug",
+        project_git_url="https://github.com/tushar5526/my_project.git",
+    )
+
+    # When / Then
+    assert parse_deployment_namespace(config.get_deployment_namespace()) == (
+        "my_project",
+        "fix_some_bug",
+    )
+    assert parse_deployment_namespace("my_project_fix_some_bug_0123456789") is None
+    assert parse_deployment_namespace(".sarthi") is None
+
+
+def test_stack_resource_limits_are_split_over_services(
+    compose_helper, mocker, monkeypatch
+):
+    # Given
+    monkeypatch.setenv("STACK_MEMORY_LIMIT", "7g")
+    monkeypatch.setenv("STACK_CPU_LIMIT", "3.5")
+    compose_helper._compose["services"]["database"]["mem_limit"] = "2g"
+    compose_helper._compose["services"]["redis"]["deploy"] = {
+        "resources": {"limits": {"cpus": "0.5"}}
+    }
+    mocker.patch.object(compose_helper, "_write_compose_file")
+
+    # When
+    compose_helper._generate_processed_compose_file(
+        "8080", "nginx.conf", "project_branch_hash"
+    )
+
+    # Then
+    services = compose_helper._compose["services"]
+    assert services["database"]["mem_limit"] == "2g"
+    assert services["webapp"]["mem_limit"] == 7 * 1024**3 // 6
+    assert "cpus" not in services["redis"]
+    assert services["webapp"]["cpus"] == 0.58
+    assert "mem_limit" not in services["nginx_project_branch_hash"]
+
+
+def test_built_services_share_the_project_build_cache(
+    compose_helper, deployment_config, mocker, monkeypatch
+):
+    # Given
+    monkeypatch.setenv("BUILD_CACHE_DIR", "/build-cache")
+    namespace = deployment_config.get_deployment_namespace()
+    repository = get_image_repository(deployment_config.project_name, "python_app")
+    services = compose_helper._compose["services"]
+    del services["python_app"]["image"]
+    services["python_app"]["build"] = "./python_app"
+    services["api"]["build"] = {"context": "./api", "args": ["NODE_ENV=production"]}
+    mocker.patch.object(compose_helper, "_write_compose_file")
+
+    # When
+    compose_helper._generate_processed_compose_file("8080", "nginx.conf", namespace)
+
+    # Then
+    assert (
+        services["python_app"]["image"]
+        == f"{repository}:{deployment_config.branch_name}"
+    )
+    assert services["python_app"]["build"] == {
+        "context": "./python_app",
+        "cache_from": [
+            services["python_app"]["image"],
+            f"{repository}:{constants.BUILD_CACHE_TAG}",
+            f"type=local,src=/build-cache/{deployment_config.project_name}/python_app",
+        ],
+        "cache_to": [
+            f"type=local,dest=/build-cache/{deployment_config.project_name}/python_app,mode=max"
+        ],
+        "args": {"BUILDKIT_INLINE_CACHE": "1"},
+        "labels": {constants.BUILD_NAMESPACE_LABEL: namespace},
+    }
+    assert services["api"]["image"] == "node:14"
+    assert services["api"]["build"]["args"] == [
+        "NODE_ENV=production",
+        "BUILDKIT_INLINE_CACHE=1",
+    ]
+    assert "build" not in services["webapp"]
+
+
+def test_build_cache_is_tagged_and_replaced_images_are_pruned(compose_helper, mocker):
+    # Given
+    mocked_docker_client = mocker.patch("server.utils.get_docker_client").return_value
+    mocked_docker_client.tag_image.side_effect = [
+        DockerEngineError("No such image"),
+        None,
+    ]
+    mocked_docker_client.list_images.return_value = [
+        {"Id": "sha256:old", "RepoTags": ["<none>:<none>"]}
+    ]
+    compose_helper._built_images = [
+        ("sarthi/project/api:main", "sarthi/project/api:sarthi-cache"),
+        ("sarthi/project/web:main", "sarthi/project/web:sarthi-cache"),
+    ]
+
+    # When
+    compose_helper._share_build_cache("project_main_hash")
+
+    # Then
+    mocked_docker_client.tag_image.assert_called_with(
+        "sarthi/project/web:main", "sarthi/project/web", "sarthi-cache"
+    )
+    mocked_docker_client.list_images.assert_called_once_with(
+        labels=[f"{constants.BUILD_NAMESPACE_LABEL}=project_main_hash"], dangling=True
+    )
+    mocked_docker_client.remove_image.assert_called_once_with("sha256:old")
+
+
+def test_removing_images_keeps_the_project_build_cache(compose_helper, mocker):
+    # Given
+    mocked_docker_client = mocker.patch("server.utils.get_docker_client").return_value
+    mocked_docker_client.list_images.return_value = [
+        {
+            "Id": "sha256:shared",
+            "RepoTags": ["sarthi/project/api:main", "sarthi/project/api:sarthi-cache"],
+        },
+        {"Id": "sha256:branch", "RepoTags": ["sarthi/project/web:main"]},
+    ]
+
+    # When
+    compose_helper.remove_images("project_main_hash")
+
+    # Then
+    assert mocked_docker_client.remove_image.call_args_list == [
+        call("sarthi/project/api:main"),
+        call("sarthi/project/web:main"),
+    ]
+
+
+def test_stack_is_running_only_if_every_service_is_up(compose_helper, mocker):
+    # Given
+    mocked_docker_client = mocker.patch("server.utils.get_docker_client").return_value
+    services = list(compose_helper._compose["services"])
+    containers = [
+        {
+            "Labels": {"com.docker.compose.service": service},
+            "State": "running",
+            "Status": "Up 5 minutes",
+        }
+        for service in services
+    ]
+    mocked_docker_client.list_containers.return_value = containers
+
+    # When / Then
+    assert compose_helper.is_running()
+    containers[0]["Status"] = "Up 5 minutes (unhealthy)"
+    assert not compose_helper.is_running()
+    containers[0]["Status"] = "Up 5 minutes"
+    containers[1]["State"] = "exited"
+    assert not compose_helper.is_running()
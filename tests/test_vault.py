@@ -0,0 +1,254 @@
+import asyncio
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import httpx
+import pytest
+import requests
+from fastapi import HTTPException
+
+from server.vault import AsyncVaultClient, SecretsCache, VaultSession
+
+
+class FakeVaultHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.server.requests += 1
+        if self.server.delay:
+            time.sleep(self.server.delay)
+        if self.server.failures > 0:
+            self.server.failures -= 1
+            status, body = 503, {"errors": ["Vault is sealed"]}
+        else:
+            status, body = 200, {"data": {"data": {"key": "secret-value"}}}
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class FakeVaultServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), FakeVaultHandler)
+        self.requests = 0
+        self.connections = 0
+        self.failures = 0
+        self.delay = 0
+
+    def process_request(self, request, client_address):
+        self.connections += 1
+        super().process_request(request, client_address)
+
+
+@pytest.fixture
+def fake_vault():
+    server = FakeVaultServer()
+    thread = threading.Thread(
+        target=server.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True
+    )
+    thread.start()
+    server.url = (
+        f"http://127.0.0.1:{server.server_address[1]}/v1/kv/data/project/branch"
+    )
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_vault_session_reuses_connections(fake_vault):
+    # Given
+    session = VaultSession()
+
+    # When
+    for _ in range(5):
+        assert session.get(fake_vault.url).status_code == 200
+
+    # Then
+    assert fake_vault.connections == 1
+
+
+def test_vault_session_retries_server_errors(fake_vault):
+    # Given
+    fake_vault.failures = 2
+    session = VaultSession(backoff_factor=0)
+
+    # When
+    response = session.get(fake_vault.url)
+
+    # Then
+    assert response.status_code == 200
+    assert fake_vault.requests == 3
+
+
+def test_vault_session_gives_up_after_max_retries(fake_vault):
+    # Given
+    fake_vault.failures = 10
+    session = VaultSession(max_retries=2, backoff_factor=0)
+
+    # When
+    response = session.get(fake_vault.url)
+
+    # Then
+    assert response.status_code == 503
+    assert fake_vault.requests == 3
+
+
+def test_vault_session_times_out(fake_vault):
+    # Given
+    fake_vault.delay = 0.5
+    session = VaultSession(read_timeout=0.05, max_retries=0)
+
+    # Then
+    with pytest.raises(requests.RequestException, match="Read timed out"):
+        # When
+        session.get(fake_vault.url)
+
+
+def test_read_secrets_when_vault_is_unreachable(secrets_helper_instance, mocker):
+    # Given
+    mocked_session = mocker.patch("server.utils.get_vault_session").return_value
+    mocked_session.get.side_effect = requests.ConnectionError("Connection refused")
+
+    # Then
+    with pytest.raises(HTTPException, match="Cannot read secrets from vault"):
+        # When
+        secrets_helper_instance._read_secrets_from_vault(
+            "http://vault:8200/v1/kv/data/project_name/branch_name"
+        )
+
+
+def test_secrets_cache_expires_entries(mocker):
+    # Given
+    mocked_monotonic = mocker.patch("server.vault.time.monotonic", return_value=100)
+    cache = SecretsCache(stale_seconds=30)
+    cache.set("url", {"key": "secret-value"}, ttl_seconds=10)
+
+    # When / Then
+    assert cache.get("url") == {"key": "secret-value"}
+    mocked_monotonic.return_value = 120
+    assert cache.get("url") is None
+    assert cache.get_stale("url") == {"key": "secret-value"}
+    mocked_monotonic.return_value = 150
+    assert cache.get_stale("url") is None
+
+
+def test_secrets_cache_evicts_least_recently_used():
+    # Given
+    cache = SecretsCache(max_entries=2)
+    cache.set("first", {"key": "1"}, ttl_seconds=60)
+    cache.set("second", {"key": "2"}, ttl_seconds=60)
+    cache.get("first")
+
+    # When
+    cache.set("third", {"key": "3"}, ttl_seconds=60)
+
+    # Then
+    assert cache.get("second") is None
+    assert cache.get("first") == {"key": "1"}
+    assert cache.clear() == 2
+
+
+def test_default_secrets_are_read_from_cache(secrets_helper_instance, mocker):
+    # Given
+    mocked_session = mocker.patch("server.utils.get_vault_session").return_value
+    mocked_session.get.return_value.status_code = 200
+    mocked_session.get.return_value.json.return_value = {
+        "data": {"data": {"key": "secret-value"}}
+    }
+
+    # When
+    for _ in range(3):
+        secrets = secrets_helper_instance._read_default_secrets()
+
+    # Then
+    assert secrets == {"key": "secret-value"}
+    mocked_session.get.assert_called_once()
+
+
+def test_default_secrets_are_invalidated_on_write(secrets_helper_instance, mocker):
+    # Given
+    mocked_session = mocker.patch("server.utils.get_vault_session").return_value
+    mocked_session.get.return_value.status_code = 200
+    mocked_session.get.return_value.json.return_value = {
+        "data": {"data": {"key": "secret-value"}}
+    }
+    secrets_helper_instance._read_default_secrets()
+
+    # When
+    secrets_helper_instance._write_secrets_to_vault(
+        secrets_helper_instance._default_secret_url, {"key": "new-value"}
+    )
+    secrets_helper_instance._read_default_secrets()
+
+    # Then
+    assert mocked_session.get.call_count == 2
+
+
+def test_stale_default_secrets_are_used_when_vault_is_down(
+    secrets_helper_instance, mocker
+):
+    # Given
+    mocked_session = mocker.patch("server.utils.get_vault_session").return_value
+    mocked_session.get.return_value.status_code = 200
+    mocked_session.get.return_value.json.return_value = {
+        "data": {"data": {"key": "secret-value"}}
+    }
+    mocked_monotonic = mocker.patch("server.vault.time.monotonic", return_value=100)
+    secrets_helper_instance._read_default_secrets()
+    mocked_monotonic.return_value = 200
+    mocked_session.get.side_effect = requests.ConnectionError("Connection refused")
+
+    # When
+    secrets = secrets_helper_instance._read_default_secrets()
+
+    # Then
+    assert secrets == {"key": "secret-value"}
+    assert mocked_session.get.call_count == 2
+
+
+def test_async_vault_client_retries_server_errors(fake_vault):
+    # Given
+    fake_vault.failures = 2
+
+    async def get_secrets():
+        client = AsyncVaultClient(backoff_factor=0)
+        try:
+            return await client.get(fake_vault.url)
+        finally:
+            await client.aclose()
+
+    # When
+    response = asyncio.run(get_secrets())
+
+    # Then
+    assert response.status_code == 200
+    assert response.json()["data"]["data"] == {"key": "secret-value"}
+    assert fake_vault.requests == 3
+    assert fake_vault.connections == 1
+
+
+def test_async_vault_client_times_out(fake_vault):
+    # Given
+    fake_vault.delay = 0.5
+
+    async def get_secrets():
+        client = AsyncVaultClient(read_timeout=0.05, max_retries=0)
+        try:
+            return await client.get(fake_vault.url)
+        finally:
+            await client.aclose()
+
+    # Then
+    with pytest.raises(httpx.ReadTimeout):
+        # When
+        asyncio.run(get_secrets())